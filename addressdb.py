@@ -0,0 +1,134 @@
+"""
+Persistent dictionary of addresses with compact integer IDs.
+
+Every address gets an ID the first time it is seen. Relationship files then reference the ID instead of the full
+address string, and every address node is written exactly once, so the address file does not need to be deduplicated
+before the import.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import collections
+import struct
+
+import rocksdb
+
+# Key under which the next free ID is stored. Cannot collide with an address, as addresses do not contain underscores.
+NEXT_ID_KEY = b'__next_id__'
+# Number of addresses whose IDs are kept in memory
+CACHE_SIZE = 4 * 1024 ** 2
+# Number of rows buffered by writerow before their addresses are looked up together
+ROW_BUFFER = 10000
+
+_ID = struct.Struct('<Q')
+
+
+class AddressBook:
+    """
+    Assigns IDs to addresses and stores them in a RocksDB. Recently used IDs are cached in memory.
+    """
+
+    def __init__(self, db, replay_from=None):
+        """
+        :param db:          rocksdb.DB, the address database
+        :param replay_from: int, addresses with this or a higher ID are reported as new once more. Used when resuming
+                            a run whose address rows have been cut off after the last checkpoint.
+        """
+        self.db = db
+        record = db.get(NEXT_ID_KEY)
+        self.next_id = _ID.unpack(record)[0] if record is not None else 0
+        self._cache = collections.OrderedDict()
+        self.replay_from = self.next_id if replay_from is None else replay_from
+        self._replayed = set()
+
+    def __len__(self):
+        return self.next_id
+
+    def intern(self, addresses):
+        """
+        Returns the IDs of several addresses, assigning new IDs to addresses that have not been seen before
+
+        :param addresses:   iterable, the addresses
+        :return:            tuple, a dict mapping each address to its ID and a list of [ID, address] rows, one for each
+                            new address
+        """
+        ids = {}
+        missing = []
+        for address in set(addresses):
+            if address in self._cache:
+                self._cache.move_to_end(address)
+                ids[address] = self._cache[address]
+            else:
+                missing.append(address)
+
+        new = []
+        if missing:
+            # All addresses that are not cached are looked up at once
+            keys = {address: address.encode('utf-8') for address in missing}
+            records = self.db.multi_get(list(keys.values()))
+            batch = rocksdb.WriteBatch()
+            for address, key in keys.items():
+                record = records.get(key)
+                if record is None:
+                    ids[address] = self.next_id
+                    new.append([self.next_id, address])
+                    batch.put(key, _ID.pack(self.next_id))
+                    self.next_id += 1
+                else:
+                    ids[address] = _ID.unpack(record)[0]
+                    if ids[address] >= self.replay_from and ids[address] not in self._replayed:
+                        self._replayed.add(ids[address])
+                        new.append([ids[address], address])
+            if new:
+                batch.put(NEXT_ID_KEY, _ID.pack(self.next_id))
+                self.db.write(batch)
+
+            for address in missing:
+                self._cache[address] = ids[address]
+            while len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return ids, new
+
+
+class InterningWriter:
+    """
+    Wraps a csv writer and replaces the address in one column of every row by its ID. Rows of addresses that are new
+    are written to the address file.
+    """
+
+    def __init__(self, writer, column, book, address_writer):
+        """
+        :param writer:          csv.writer, the writer of the relationship file
+        :param column:          int, the column holding the address
+        :param book:            AddressBook, the address dictionary
+        :param address_writer:  csv.writer, the writer of the address file. None if new addresses are not to be written.
+        """
+        self.writer = writer
+        self.column = column
+        self.book = book
+        self.address_writer = address_writer
+        self._pending = []
+
+    def writerows(self, rows):
+        if self._pending:
+            self.flush()
+        ids, new = self.book.intern(row[self.column] for row in rows)
+        if self.address_writer is not None:
+            self.address_writer.writerows(new)
+        for row in rows:
+            row[self.column] = ids[row[self.column]]
+        self.writer.writerows(rows)
+
+    def writerow(self, row):
+        # Single rows are collected, so their addresses can be looked up together
+        self._pending.append(row)
+        if len(self._pending) >= ROW_BUFFER:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all rows collected by writerow
+        """
+        rows = self._pending
+        self._pending = []
+        self.writerows(rows)
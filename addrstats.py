@@ -0,0 +1,91 @@
+"""
+Per-address aggregates computed while parsing.
+
+Every worker counts the RECEIVES and SENDS relationships of the addresses in its chunk and writes them to a run sorted
+by address. Once all chunks have been processed, the runs are merged and every address is written to the address file
+once, together with its aggregates. This replaces the computation of the degrees in feature-construction.cqd.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import os
+
+from sortjoin import ADDRESS_STATS, merge_runs, run_path
+
+# Columns of the address file after the address
+COLUMNS = ('inDegree', 'outDegree', 'received', 'sent', 'firstSeen', 'lastSeen')
+
+
+class ChunkAddressStats:
+    """
+    Aggregates of the addresses in one chunk of blocks
+    """
+
+    def __init__(self):
+        # Address -> [in-degree, out-degree, received, sent, first height, last height]
+        self.stats = {}
+
+    def _get(self, address, height):
+        entry = self.stats.get(address)
+        if entry is None:
+            entry = self.stats[address] = [0, 0, 0, 0, height, height]
+        else:
+            entry[4] = min(entry[4], height)
+            entry[5] = max(entry[5], height)
+        return entry
+
+    def receive(self, address, value, height):
+        """
+        Counts an output received by an address (RECEIVES relationship)
+        """
+        entry = self._get(address, height)
+        entry[0] += 1
+        entry[2] += value
+
+    def send(self, address, value, height):
+        """
+        Counts an output spent by an address (SENDS relationship)
+        """
+        entry = self._get(address, height)
+        entry[1] += 1
+        entry[3] += value
+
+    def write(self, run_dir, start):
+        """
+        Writes the aggregates as run sorted by address. The run is renamed into place once complete.
+
+        :param run_dir: str, the directory to store the run in
+        :param start:   int, the block height the chunk starts at
+        """
+        path = run_path(run_dir, 'addrstats', start)
+        ADDRESS_STATS.write(path + ".tmp", sorted((address.encode('utf-8'), *entry)
+                                                  for address, entry in self.stats.items()))
+        os.replace(path + ".tmp", path)
+        self.stats.clear()
+
+
+def merge_address_stats(run_dir, starts):
+    """
+    Merges the aggregates of all chunks
+
+    :param run_dir: str, the directory the runs are stored in
+    :param starts:  list, the start heights of all chunks
+    :return:        iterator, one list per address: address followed by the values of COLUMNS
+    """
+    records = merge_runs(ADDRESS_STATS, [run_path(run_dir, 'addrstats', s) for s in starts], run_dir, 'addrstats',
+                         key=lambda r: r[0])
+    current = None
+    for address, in_degree, out_degree, received, sent, first, last in records:
+        if current is not None and current[0] == address:
+            current[1] += in_degree
+            current[2] += out_degree
+            current[3] += received
+            current[4] += sent
+            current[5] = min(current[5], first)
+            current[6] = max(current[6], last)
+            continue
+        if current is not None:
+            yield [current[0].decode('utf-8')] + current[1:]
+        current = [address, in_degree, out_degree, received, sent, first, last]
+    if current is not None:
+        yield [current[0].decode('utf-8')] + current[1:]
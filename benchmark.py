@@ -0,0 +1,200 @@
+#!/usr/local/bin/python3
+
+"""
+Benchmark of the exporters on a synthetic chain written by fixtures.py.
+
+Runs the block reader in process and both exporters (btc-to-csv.py and btc_parallel.py) as subprocesses, each with a
+fresh database and output directory, for every combination of --cores and --mem. For every run, blocks/s,
+transactions/s, prevout lookups/s, peak RSS and output MB/s are reported per stage and saved as JSON, e.g.:
+`python3 fixtures.py --outdir fixture --blocks 5000`
+`python3 benchmark.py --fixture fixture --cores 2,4 --mem 1024 --output before.json`
+Results of an earlier benchmark can be passed with --compare to print the change of every run.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from blkreader import iter_blocks
+from fixtures import FIXTURE_FILE
+
+SOURCE_PATH = os.path.dirname(os.path.abspath(__file__))
+ENTRY_POINTS = {'single': 'btc-to-csv.py', 'parallel': 'btc_parallel.py'}
+
+
+def _rate(count, seconds):
+    return round(count / seconds, 1) if seconds > 0 else None
+
+
+def _directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SOURCE_PATH,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_reader(fixture_path, summary):
+    """
+    Measures how fast the blocks of the fixture are read and decoded
+
+    :param fixture_path:    str, the fixture directory
+    :param summary:         dict, the summary of the fixture
+    :return:                dict, the results
+    """
+    started = time.perf_counter()
+    transactions = 0
+    for block in iter_blocks(os.path.join(fixture_path, "block_index.bin"), os.path.join(fixture_path, "blocks"), 0,
+                             summary['blocks']):
+        transactions += len(block.transactions)
+    seconds = time.perf_counter() - started
+    return {'seconds': round(seconds, 3), 'blocks_s': _rate(summary['blocks'], seconds),
+            'tx_s': _rate(transactions, seconds), 'mb_s': _rate(summary['bytes'] / 1024 ** 2, seconds)}
+
+
+def bench_run(entry, fixture_path, summary, work_path, cores, mem, extra):
+    """
+    Runs an exporter on the fixture
+
+    :param entry:           str, the exporter (single or parallel)
+    :param fixture_path:    str, the fixture directory
+    :param summary:         dict, the summary of the fixture
+    :param work_path:       str, the directory for database, output and log of the run. Emptied before the run.
+    :param cores:           int, the value of --cores (parallel only), 0 for the default
+    :param mem:             int, the value of --mem, 0 for the default
+    :param extra:           list, further arguments of the exporter
+    :return:                dict, the results
+    """
+    if os.path.exists(work_path):
+        shutil.rmtree(work_path)
+    os.makedirs(work_path)
+    out_path = os.path.join(work_path, "csv")
+    stats_path = os.path.join(work_path, "stats.json")
+    cmd = [sys.executable, os.path.join(SOURCE_PATH, ENTRY_POINTS[entry]), '--btcdir', fixture_path,
+           '--blockindex', os.path.join(fixture_path, "block_index.bin"), '--outdir', out_path,
+           '--dbdir', os.path.join(work_path, "transaction_db"), '--endblock', str(summary['blocks']),
+           '--statsfile', stats_path]
+    if entry == 'parallel':
+        cmd += ['--rundir', os.path.join(work_path, "runs"), '--addrdb', os.path.join(work_path, "address_db")]
+        if cores > 0:
+            cmd += ['--cores', str(cores)]
+    if mem > 0:
+        cmd += ['--mem', str(mem)]
+    cmd += extra
+
+    started = time.perf_counter()
+    with open(os.path.join(work_path, "log.txt"), 'w') as log:
+        process = subprocess.Popen(cmd, cwd=work_path, stdout=log, stderr=subprocess.STDOUT)
+        # Unlike Popen.wait, wait4 reports the resource usage, which includes all worker processes
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - started
+
+    result = {'entry': entry, 'cores': cores, 'mem': mem, 'extra': extra, 'returncode': process.returncode,
+              'wall': round(wall, 3), 'peak_rss_mb': round(usage.ru_maxrss / 1024, 1)}
+    if process.returncode != 0 or not os.path.exists(stats_path):
+        print("Run failed, see " + os.path.join(work_path, "log.txt"))
+        return result
+    with open(stats_path) as f:
+        stats = json.load(f)
+    output_mb = _directory_size(out_path) / 1024 ** 2
+    stages = {}
+    for name, seconds in stats['stages'].items():
+        stages[name] = {'seconds': round(seconds, 3)}
+    csv_seconds = stats['stages'].get('csv', 0.0)
+    stages.setdefault('csv', {}).update({
+        'blocks_s': _rate(stats['blocks'], csv_seconds), 'tx_s': _rate(stats['transactions'], csv_seconds),
+        'lookups_s': _rate(stats['lookups'], csv_seconds), 'output_mb_s': _rate(output_mb, csv_seconds)})
+    if stats.get('lookup_time'):
+        stages['csv']['lookups_s_per_worker'] = _rate(stats['lookups'], stats['lookup_time'])
+    result.update({'blocks_s': _rate(stats['blocks'], wall), 'tx_s': _rate(stats['transactions'], wall),
+                   'output_mb': round(output_mb, 1), 'stages': stages})
+    return result
+
+
+def _key(run):
+    return run['entry'], run['cores'], run['mem'], tuple(run['extra'])
+
+
+def compare(old, new):
+    """
+    Prints the change in throughput of every run that is part of both results
+
+    :param old: dict, the earlier results
+    :param new: dict, the current results
+    """
+    previous = {_key(run): run for run in old['runs']}
+    for run in new['runs']:
+        before = previous.get(_key(run))
+        if before is None or not before.get('tx_s') or not run.get('tx_s'):
+            continue
+        print(run['entry'] + " cores=" + str(run['cores']) + " mem=" + str(run['mem']) + ": " + str(before['tx_s']) +
+              " -> " + str(run['tx_s']) + " tx/s (" + "%+.1f" % (100 * (run['tx_s'] / before['tx_s'] - 1)) + "%), " +
+              str(before['peak_rss_mb']) + " -> " + str(run['peak_rss_mb']) + " MB peak RSS")
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Benchmarks the exporters on a synthetic chain written by fixtures.py")
+    ap.add_argument("--fixture", help="Directory of the fixture", type=str, required=True)
+    ap.add_argument("--entry", help="Exporters to run, comma separated: single (btc-to-csv.py), parallel "
+                                    "(btc_parallel.py). Defaults to both", type=str, default="single,parallel")
+    ap.add_argument("--cores", help="Values of --cores for the parallel exporter, comma separated. Defaults to its "
+                                    "default", type=str, default="0")
+    ap.add_argument("--mem", help="Values of --mem (in MB), comma separated. Defaults to the default of the exporters",
+                    type=str, default="0")
+    ap.add_argument("--extra", help="Further arguments passed to the exporters, e.g. '--prune'", type=str, default="")
+    ap.add_argument("--workdir", help="Directory for databases and outputs of the runs. Defaults to bench in current "
+                                      "working directory", type=str, default="")
+    ap.add_argument("--output", help="JSON file to save the results to. Defaults to benchmark-<time>.json", type=str,
+                    default="")
+    ap.add_argument("--compare", help="Results of an earlier benchmark to compare with", type=str, default="")
+    ap.add_argument("--keep", help="Keep databases and outputs of the runs", action="store_true")
+    args = vars(ap.parse_args())
+
+    fixture = os.path.abspath(args['fixture'])
+    with open(os.path.join(fixture, FIXTURE_FILE)) as f:
+        fixture_summary = json.load(f)
+    work = os.path.abspath(args['workdir'] or os.path.join(os.getcwd(), "bench"))
+    entries = [e for e in args['entry'].split(',') if e]
+    for e in entries:
+        if e not in ENTRY_POINTS:
+            ap.error("unknown exporter " + e)
+
+    results = {'revision': _revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'fixture': fixture_summary, 'reader': bench_reader(fixture, fixture_summary), 'runs': []}
+    print("Reader: " + str(results['reader']['blocks_s']) + " blocks/s, " + str(results['reader']['tx_s']) + " tx/s")
+
+    for e in entries:
+        # btc-to-csv.py runs in a single process, so --cores does not apply
+        for c in ([0] if e == 'single' else [int(v) for v in args['cores'].split(',')]):
+            for m in [int(v) for v in args['mem'].split(',')]:
+                path = os.path.join(work, e + "-cores%d-mem%d" % (c, m))
+                run = bench_run(e, fixture, fixture_summary, path, c, m, args['extra'].split())
+                results['runs'].append(run)
+                print(e + " cores=" + str(c) + " mem=" + str(m) + ": " + str(run.get('tx_s')) + " tx/s, " +
+                      str(run['peak_rss_mb']) + " MB peak RSS, " + str(run.get('output_mb')) + " MB output")
+                # The log of a failed run is kept
+                if not args['keep'] and run['returncode'] == 0:
+                    shutil.rmtree(path)
+
+    output = args['output'] or "benchmark-" + time.strftime('%Y%m%dT%H%M%S', time.gmtime()) + ".json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results saved to " + output + ".")
+
+    if args['compare']:
+        with open(args['compare']) as f:
+            compare(json.load(f), results)
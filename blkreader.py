@@ -0,0 +1,479 @@
+#!/usr/local/bin/python3
+
+"""
+Lean reader for the blk*.dat files of Bitcoin Core.
+
+Blocks are decoded in place from the memory-mapped blk files or from the spans read by a ReadAhead. Only the fields
+needed by the exporter are extracted: block hash, previous block hash and timestamp, and for every transaction its
+txid, the value and receiving address of its outputs and the outpoints spent by its inputs. Scripts that do not belong
+to an output and witness data are skipped without being copied.
+
+Run this file directly to compare its results with those of blockchain_parser for a range of blocks of a node. The
+tests compare them on a synthetic chain.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import collections
+import hashlib
+import struct
+import time
+
+from blockindex import BlockIndex
+from readahead import ReadAhead
+from txdb import UNKNOWN_ADDRESS
+
+Block = collections.namedtuple('Block', ['height', 'hash', 'prev_hash', 'timestamp', 'transactions'])
+# outputs: list of (value, address) tuples, inputs: list of (txid, output number) tuples of the spent outputs
+Transaction = collections.namedtuple('Transaction', ['txid', 'outputs', 'inputs', 'coinbase'])
+
+_UINT16 = struct.Struct('<H')
+_UINT32 = struct.Struct('<I')
+_UINT64 = struct.Struct('<Q')
+
+_BASE58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+_BECH32 = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+_COINBASE_TXID = '0' * 64
+
+# Script opcodes
+_OP_DUP = 0x76
+_OP_HASH160 = 0xa9
+_OP_EQUAL = 0x87
+_OP_EQUALVERIFY = 0x88
+_OP_CHECKSIG = 0xac
+_OP_CHECKMULTISIG = 0xae
+_OP_1 = 0x51
+_OP_16 = 0x60
+
+# Script types of the payloads returned by script_payload
+PAYLOAD_P2PKH = 1
+PAYLOAD_P2SH = 2
+PAYLOAD_P2WPKH = 3
+PAYLOAD_P2WSH = 4
+PAYLOAD_P2TR = 5
+_P2PKH = bytes([PAYLOAD_P2PKH])
+_P2SH = bytes([PAYLOAD_P2SH])
+_P2WPKH = bytes([PAYLOAD_P2WPKH])
+_P2WSH = bytes([PAYLOAD_P2WSH])
+_P2TR = bytes([PAYLOAD_P2TR])
+# Number of addresses kept in the cache of an AddressEncoder
+CACHE_SIZE = 200000
+# Minimum number of addresses not found in the cache for a batch to be encoded by the process pool
+POOL_BATCH = 4096
+
+
+def _varint(buf, pos):
+    """
+    Reads a variable length integer as used in the serialization of blocks and transactions
+
+    :return:    tuple, the value and the position after the integer
+    """
+    n = buf[pos]
+    if n < 0xfd:
+        return n, pos + 1
+    if n == 0xfd:
+        return _UINT16.unpack_from(buf, pos + 1)[0], pos + 3
+    if n == 0xfe:
+        return _UINT32.unpack_from(buf, pos + 1)[0], pos + 5
+    return _UINT64.unpack_from(buf, pos + 1)[0], pos + 9
+
+
+def _sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def _hash160(data):
+    return hashlib.new('ripemd160', hashlib.sha256(data).digest()).digest()
+
+
+def base58check(version, payload):
+    """
+    Encodes a payload as Base58Check string (legacy addresses)
+
+    :param version: int, the version byte (0 for P2PKH, 5 for P2SH)
+    :param payload: bytes, the hash to encode
+    :return:        str, the encoded address
+    """
+    data = bytes([version]) + payload
+    data += _sha256d(data)[:4]
+    n = int.from_bytes(data, 'big')
+    encoded = ''
+    while n:
+        n, r = divmod(n, 58)
+        encoded = _BASE58[r] + encoded
+    # Leading zero bytes are encoded as ones
+    return '1' * (len(data) - len(data.lstrip(b'\0'))) + encoded
+
+
+def _bech32_polymod(values):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for v in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ v
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+
+def bech32(version, program, hrp='bc'):
+    """
+    Encodes a witness program as Bech32 (version 0) or Bech32m (version 1 and later) string
+
+    :param version: int, the witness version
+    :param program: bytes, the witness program
+    :param hrp:     str, the human readable part
+    :return:        str, the encoded address
+    """
+    # Convert 8 bit bytes to 5 bit groups
+    data = [version]
+    acc = 0
+    bits = 0
+    for b in program:
+        acc = (acc << 8) | b
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            data.append((acc >> bits) & 31)
+    if bits:
+        data.append((acc << (5 - bits)) & 31)
+    constant = 1 if version == 0 else 0x2bc830a3
+    expanded = [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+    polymod = _bech32_polymod(expanded + data + [0] * 6) ^ constant
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(_BECH32[d] for d in data + checksum)
+
+
+def script_payload(script):
+    """
+    Classifies an output script and extracts what its address is encoded from, without encoding it. Public keys (P2PK
+    and bare multisig) are hashed to the P2PKH payload of the (first) key, like blockchain_parser does.
+
+    :param script:  bytes, the output script
+    :return:        bytes, the script type (one of the PAYLOAD_* constants) followed by the 20 or 32 byte hash or
+                    witness program. Empty for non-standard scripts.
+    """
+    length = len(script)
+    if length == 25 and script[0] == _OP_DUP and script[1] == _OP_HASH160 and script[2] == 20 and \
+            script[23] == _OP_EQUALVERIFY and script[24] == _OP_CHECKSIG:
+        return _P2PKH + bytes(script[3:23])
+    if length == 23 and script[0] == _OP_HASH160 and script[1] == 20 and script[22] == _OP_EQUAL:
+        return _P2SH + bytes(script[2:22])
+    if length == 22 and script[0] == 0 and script[1] == 20:
+        return _P2WPKH + bytes(script[2:])
+    if length == 34 and script[0] == 0 and script[1] == 32:
+        return _P2WSH + bytes(script[2:])
+    if length == 34 and script[0] == _OP_1 and script[1] == 32:
+        return _P2TR + bytes(script[2:])
+    if (length == 35 or length == 67) and script[0] == length - 2 and script[-1] == _OP_CHECKSIG:
+        return _P2PKH + _hash160(bytes(script[1:-1]))
+    if length > 3 and script[-1] == _OP_CHECKMULTISIG and _OP_1 <= script[0] <= _OP_16 and \
+            _OP_1 <= script[-2] <= _OP_16 and script[1] in (33, 65) and length >= script[1] + 4:
+        return _P2PKH + _hash160(bytes(script[2:2 + script[1]]))
+    return b''
+
+
+def encode_payload(payload):
+    """
+    Encodes a payload returned by script_payload as address
+
+    :param payload: bytes, the script type followed by the hash or witness program
+    :return:        str, the address or UNKNOWN_ADDRESS for non-standard scripts
+    """
+    if not payload:
+        return UNKNOWN_ADDRESS
+    kind = payload[0]
+    if kind == PAYLOAD_P2PKH:
+        return base58check(0, payload[1:])
+    if kind == PAYLOAD_P2SH:
+        return base58check(5, payload[1:])
+    if kind == PAYLOAD_P2TR:
+        return bech32(1, payload[1:])
+    return bech32(0, payload[1:])
+
+
+def script_address(script):
+    """
+    Returns the receiving address of an output script
+
+    :param script:  bytes, the output script
+    :return:        str, the address or UNKNOWN_ADDRESS for non-standard scripts
+    """
+    return encode_payload(script_payload(script))
+
+
+class AddressEncoder:
+    """
+    Encodes the payloads of the outputs of a block in one batch. Addresses that have been encoded recently are taken
+    from an LRU cache, as hot addresses receive outputs over and over again. Batches with many addresses that are not
+    cached can be encoded by a pool of processes. With raw addresses, the hex string of the payload is used instead of
+    the address, which is unique as well but needs no encoding.
+    """
+
+    def __init__(self, cache_size=CACHE_SIZE, processes=0, raw=False):
+        """
+        :param cache_size:  int, the number of addresses kept in the cache
+        :param processes:   int, the number of processes encoding large batches, 0 to encode in this process
+        :param raw:         bool, whether to use the hex string of the payload instead of the address
+        """
+        self.cache_size = cache_size
+        self.raw = raw
+        self._cache = collections.OrderedDict()
+        self._pool = None
+        if processes > 0 and not raw:
+            # Imported here, as most processes using the reader never start a pool
+            import multiprocessing
+            import signal
+            # CTRL+C is handled by the process using the encoder, which finishes the current block first
+            self._pool = multiprocessing.Pool(processes, signal.signal, (signal.SIGINT, signal.SIG_IGN))
+
+    def encode(self, payloads):
+        """
+        Encodes a batch of payloads
+
+        :param payloads:    list, payloads returned by script_payload
+        :return:            dict, the address of every payload
+        """
+        if self.raw:
+            return {p: p.hex() if p else UNKNOWN_ADDRESS for p in payloads}
+        cache = self._cache
+        addresses = {}
+        missing = []
+        for p in payloads:
+            if p in addresses:
+                continue
+            address = cache.get(p)
+            if address is None:
+                missing.append(p)
+                # Placeholder, so the payload is only encoded once per batch
+                addresses[p] = None
+            else:
+                cache.move_to_end(p)
+                addresses[p] = address
+        if not missing:
+            return addresses
+        if self._pool is not None and len(missing) >= POOL_BATCH:
+            encoded = self._pool.map(encode_payload, missing, chunksize=POOL_BATCH // 4)
+        else:
+            encoded = [encode_payload(p) for p in missing]
+        for p, address in zip(missing, encoded):
+            addresses[p] = address
+            cache[p] = address
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return addresses
+
+    def encode_block(self, block):
+        """
+        Replaces the payloads of all outputs of a block, as decoded with address=script_payload, by their addresses
+
+        :param block:   Block, the block. Its output lists are modified in place.
+        :return:        Block, the block
+        """
+        addresses = self.encode([payload for tx in block.transactions for _, payload in tx.outputs])
+        for tx in block.transactions:
+            tx.outputs[:] = [(value, addresses[payload]) for value, payload in tx.outputs]
+        return block
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+
+def parse_transaction(buf, pos, address=script_address):
+    """
+    Decodes a serialized transaction
+
+    :param buf:     memoryview, the buffer holding the transaction
+    :param pos:     int, the position of the transaction within the buffer
+    :param address: function, returns the address of an output script
+    :return:        tuple, the decoded Transaction and the position after the transaction
+    """
+    start = pos
+    pos += 4
+    # Segwit transactions have a marker (0) and a flag byte after the version. They do not count towards the txid.
+    segwit = buf[pos] == 0 and buf[pos + 1] != 0
+    if segwit:
+        pos += 2
+    body = pos
+
+    n_in, pos = _varint(buf, pos)
+    inputs = []
+    for _ in range(n_in):
+        inputs.append((bytes(buf[pos:pos + 32])[::-1].hex(), _UINT32.unpack_from(buf, pos + 32)[0]))
+        script_length, pos = _varint(buf, pos + 36)
+        # Skip script and sequence number
+        pos += script_length + 4
+
+    n_out, pos = _varint(buf, pos)
+    outputs = []
+    for _ in range(n_out):
+        value = _UINT64.unpack_from(buf, pos)[0]
+        script_length, pos = _varint(buf, pos + 8)
+        outputs.append((value, address(buf[pos:pos + script_length])))
+        pos += script_length
+    body_end = pos
+
+    if segwit:
+        # Skip the witness data of every input
+        for _ in range(n_in):
+            n_items, pos = _varint(buf, pos)
+            for _ in range(n_items):
+                item_length, pos = _varint(buf, pos)
+                pos += item_length
+
+    # txid is the double SHA-256 of version, inputs, outputs and lock time
+    h = hashlib.sha256(buf[start:start + 4])
+    h.update(buf[body:body_end])
+    h.update(buf[pos:pos + 4])
+    txid = hashlib.sha256(h.digest()).digest()[::-1].hex()
+    pos += 4
+
+    coinbase = n_in == 1 and inputs[0][0] == _COINBASE_TXID
+    return Transaction(txid, outputs, inputs, coinbase), pos
+
+
+def parse_block(buf, height, address=script_address):
+    """
+    Decodes a serialized block
+
+    :param buf:     memoryview, the serialized block
+    :param height:  int, the block height
+    :param address: function, returns the address of an output script
+    :return:        Block, the decoded block
+    """
+    block_hash = _sha256d(buf[:80])[::-1].hex()
+    prev_hash = bytes(buf[4:36])[::-1].hex()
+    timestamp = _UINT32.unpack_from(buf, 68)[0]
+    n_tx, pos = _varint(buf, 80)
+    transactions = []
+    for _ in range(n_tx):
+        tx, pos = parse_transaction(buf, pos, address)
+        transactions.append(tx)
+    return Block(height, block_hash, prev_hash, timestamp, transactions)
+
+
+# Block indexes opened by this process
+_opened = {}
+
+
+def iter_blocks(path, block_path, start, end, timer=None, encoder=None, readahead=0, lock=None):
+    """
+    Iterates over the blocks of the main chain in a range of heights
+
+    :param path:        str, the block index file
+    :param block_path:  str, the path to the Bitcoin blocks
+    :param start:       int, the block height to start at
+    :param end:         int, the block height to stop at (exclusive)
+    :param timer:       metrics.StageTimer, adds up the time spent reading blocks, decoding them and encoding addresses.
+                        None to skip timing.
+    :param encoder:     AddressEncoder, encodes the addresses of every block in one batch. None to encode every address
+                        while decoding.
+    :param readahead:   int, the memory (in bytes) for blocks read ahead by a background thread, see ReadAhead. 0 to
+                        decode the blocks from the memory-mapped blk files.
+    :param lock:        multiprocessing.Lock, shared by all processes reading from the same disk, so only one of them
+                        reads ahead at a time. None to read without waiting for other processes.
+    :return:            iterator, decoded Block tuples in order of height
+    """
+    if path not in _opened:
+        _opened[path] = BlockIndex(path)
+    index = _opened[path]
+    if readahead > 0:
+        views = iter(ReadAhead(index, block_path, start, end, readahead, lock))
+    else:
+        views = ((height, index.block_view(block_path, height)) for height in range(start, min(end, len(index))))
+    if timer is None:
+        for height, view in views:
+            if encoder is None:
+                yield parse_block(view, height)
+            else:
+                yield encoder.encode_block(parse_block(view, height, script_payload))
+        return
+
+    address = timer.timed('address', script_address)
+    while True:
+        started = time.perf_counter()
+        # Memory-mapped blocks are mostly read by page faults while decoding, blocks read ahead are only waited for
+        # if the disk cannot keep up
+        item = next(views, None)
+        if item is None:
+            return
+        height, view = item
+        read = time.perf_counter()
+        timer.add('read', read - started)
+        if encoder is None:
+            encoding = timer.seconds['address']
+            block = parse_block(view, height, address)
+            # Address encoding is a stage of its own
+            timer.add('decode', time.perf_counter() - read - (timer.seconds['address'] - encoding))
+        else:
+            block = parse_block(view, height, script_payload)
+            decoded = time.perf_counter()
+            timer.add('decode', decoded - read)
+            encoder.encode_block(block)
+            timer.add('address', time.perf_counter() - decoded)
+        yield block
+
+
+def parser_block(raw, height):
+    """
+    Decodes a serialized block with blockchain_parser into the same tuple as parse_block. The reference the lean reader
+    is checked against.
+
+    :param raw:     bytes, the serialized block
+    :param height:  int, the block height
+    :return:        Block, the decoded block
+    """
+    # Only needed to check the reader
+    import calendar
+    from blockchain_parser.block import Block as ParserBlock
+
+    reference = ParserBlock(raw, height)
+    transactions = []
+    for tx in reference.transactions:
+        outputs = []
+        for o in tx.outputs:
+            try:
+                outputs.append((o.value, o.addresses[0].address))
+            except Exception:
+                outputs.append((o.value, UNKNOWN_ADDRESS))
+        inputs = [(i.transaction_hash, i.transaction_index) for i in tx.inputs]
+        transactions.append(Transaction(tx.txid, outputs, inputs, tx.is_coinbase()))
+    # blockchain_parser returns the timestamp as naive datetime in UTC
+    return Block(height, reference.hash, reference.header.previous_block_hash,
+                 calendar.timegm(reference.header.timestamp.utctimetuple()), transactions)
+
+
+if __name__ == '__main__':
+    # Differential test against blockchain_parser
+    import argparse
+    import os
+    import sys
+
+    ap = argparse.ArgumentParser(description="Compares the lean reader with blockchain_parser")
+    ap.add_argument("--btcdir", help="Installation path of Bitcoin Core", type=str,
+                    default=os.path.expanduser("~/.bitcoin"))
+    ap.add_argument("--blockindex", help="Block index file", type=str, default="block_index.bin")
+    ap.add_argument("--startblock", help="Block to start with, defaults to 0", type=int, default=0)
+    ap.add_argument("--endblock", help="Block to stop at, defaults to 1000", type=int, default=1000)
+    args = vars(ap.parse_args())
+
+    BLOCK_PATH = os.path.join(args['btcdir'], "blocks")
+    index = BlockIndex(args['blockindex'])
+    mismatches = 0
+    for height in range(args['startblock'], min(args['endblock'], len(index))):
+        raw = index.read_block(BLOCK_PATH, height)
+        lean = parse_block(memoryview(raw), height)
+        expected = parser_block(raw, height)
+        if lean != expected:
+            mismatches += 1
+            print("Mismatch in block " + str(height))
+            for field in Block._fields[:-1]:
+                if getattr(lean, field) != getattr(expected, field):
+                    print("  " + field + ": " + str(getattr(lean, field)) + " != " + str(getattr(expected, field)))
+            for a, b in zip(lean.transactions, expected.transactions):
+                if a != b:
+                    print("  tx " + b.txid + ": " + str(a) + " != " + str(b))
+    print(str(mismatches) + " mismatching blocks.")
+    sys.exit(1 if mismatches else 0)
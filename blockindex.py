@@ -0,0 +1,266 @@
+"""
+Persistent index of the location of every block of the main chain.
+
+Reading the LevelDB block index of Bitcoin Core and ordering it takes seconds to minutes. The index built here maps
+every height of the main chain to the blk file, offset, size, transaction count and hash of its block. It is written
+once to a flat file of fixed-width records, which is memory-mapped by every process that needs to read blocks.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import mmap
+import os
+import struct
+
+# File header: magic, number of blocks
+_HEADER = struct.Struct('<8sI')
+_MAGIC = b'BLKIDX01'
+# Block record: blk file number, offset of the block within the file, block size, transaction count, block hash
+_RECORD = struct.Struct('<IIII32s')
+# Bitcoin Core block status flag, set if the full block is stored in a blk file
+_BLOCK_HAVE_DATA = 8
+# Number of blk files kept open while reading blocks
+_OPEN_FILES = 8
+
+
+def block_file(block_path, file_number):
+    """
+    Returns the path of a blk file
+
+    :param block_path:  str, the path to the Bitcoin blocks
+    :param file_number: int, the number of the blk file
+    :return:            str, the path
+    """
+    return os.path.join(block_path, "blk%05d.dat" % file_number)
+
+
+def main_chain(index_path):
+    """
+    Reads the LevelDB block index of Bitcoin Core and returns the blocks of the main chain
+
+    :param index_path:  str, the path to the LevelDB Bitcoin index
+    :return:            list, the DBBlockIndex entry of every block of the main chain in order of height
+    """
+    # Only needed to build or check the index, so readers do not depend on LevelDB
+    import plyvel
+    from blockchain_parser.index import DBBlockIndex
+
+    db = plyvel.DB(index_path, compression=None)
+    entries = {}
+    for key, value in db.iterator(prefix=b'b'):
+        entry = DBBlockIndex(key[1:][::-1].hex(), value)
+        if entry.status & _BLOCK_HAVE_DATA:
+            entries[entry.hash] = entry
+    db.close()
+    if not entries:
+        raise ValueError("No blocks found in " + index_path)
+
+    # Walk back from the highest block to the genesis block, which drops all blocks of stale forks
+    tip = max(entries.values(), key=lambda e: e.height)
+    chain = [None] * (tip.height + 1)
+    entry = tip
+    while entry is not None:
+        chain[entry.height] = entry
+        entry = entries.get(entry.prev_hash)
+    if chain[0] is None:
+        raise ValueError("Block index does not lead back to the genesis block. Is the blockchain fully downloaded?")
+    return chain
+
+
+def build_index(path, index_path, block_path, chain=None, previous=None):
+    """
+    Reads the LevelDB block index of Bitcoin Core and writes the locations of all blocks of the main chain
+
+    :param path:        str, the file to write the index to
+    :param index_path:  str, the path to the LevelDB Bitcoin index
+    :param block_path:  str, the path to the Bitcoin blocks
+    :param chain:       list, the main chain as returned by main_chain. None to read it from index_path.
+    :param previous:    BlockIndex, an earlier index. The blocks it shares with the main chain are taken from it, so
+                        only the sizes of the other blocks are looked up in the blk files. None to look up all of them.
+    :return:            int, the number of blocks in the index
+    """
+    if chain is None:
+        chain = main_chain(index_path)
+
+    locations = [previous.location(h) for h in range(shared_blocks(previous, chain))] if previous is not None else []
+    handles = {}
+    for entry in chain[len(locations):]:
+        if entry.file not in handles:
+            handles[entry.file] = open(block_file(block_path, entry.file), 'rb')
+        # The block size precedes the block in the blk file
+        blk = handles[entry.file]
+        blk.seek(entry.data_pos - 4)
+        size = struct.unpack('<I', blk.read(4))[0]
+        locations.append((entry.file, entry.data_pos, size, entry.n_tx, entry.hash))
+    for blk in handles.values():
+        blk.close()
+    return write_index(path, locations)
+
+
+def shared_blocks(index, chain):
+    """
+    Returns the number of blocks an index shares with the main chain. As every block commits to the one before it,
+    these are the blocks up to the highest one whose hash is the same in both.
+
+    :param index:   BlockIndex, the index
+    :param chain:   list, the main chain as returned by main_chain
+    :return:        int, the number of blocks from the genesis block on that are the same in both
+    """
+    # Reorganizations only replace a few blocks below the tip, so the search starts there
+    for height in range(min(len(index), len(chain)) - 1, -1, -1):
+        if index.location(height)[4] == chain[height].hash:
+            return height + 1
+    return 0
+
+
+def write_index(path, locations):
+    """
+    Writes a block index file
+
+    :param path:        str, the file to write the index to
+    :param locations:   list, blk file number, offset, size, transaction count and hash (as hex string) of every block
+                        in order of height
+    :return:            int, the number of blocks in the index
+    """
+    with open(path + ".tmp", 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, len(locations)))
+        for file_number, offset, size, n_tx, block_hash in locations:
+            f.write(_RECORD.pack(file_number, offset, size, n_tx, bytes.fromhex(block_hash)))
+    os.replace(path + ".tmp", path)
+    return len(locations)
+
+
+class BlockIndex:
+    """
+    Memory-mapped block index as written by build_index
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC:
+            raise ValueError(path + " is not a block index")
+        self._files = {}
+
+    def __len__(self):
+        return self._count
+
+    def location(self, height):
+        """
+        Returns the location of a block
+
+        :param height:  int, the block height
+        :return:        tuple, blk file number, offset, size, transaction count and hash (as hex string) of the block
+        """
+        if not 0 <= height < self._count:
+            raise IndexError("Block " + str(height) + " is not in the index")
+        file_number, offset, size, n_tx, block_hash = _RECORD.unpack_from(self._map,
+                                                                           _HEADER.size + height * _RECORD.size)
+        return file_number, offset, size, n_tx, block_hash.hex()
+
+    def tx_count(self, start, end):
+        """
+        Returns the number of transactions in a range of blocks
+
+        :param start:   int, the first block height
+        :param end:     int, the block height to stop at (exclusive)
+        :return:        int, the number of transactions
+        """
+        return sum(self.location(h)[3] for h in range(max(start, 0), min(end, self._count)))
+
+    def byte_count(self, start, end):
+        """
+        Returns the size of the blocks in a range
+
+        :param start:   int, the first block height
+        :param end:     int, the block height to stop at (exclusive)
+        :return:        int, the size in bytes
+        """
+        return sum(self.location(h)[2] for h in range(max(start, 0), min(end, self._count)))
+
+    def chunks(self, end, chunk_tx):
+        """
+        Splits the blocks up to a height into chunks of consecutive blocks holding about the same number of
+        transactions. Early chunks span many blocks, late chunks only a few. A chunk ends with the first block that
+        takes it to chunk_tx transactions or more, so chunks may hold more than chunk_tx transactions, but a block is
+        never split.
+
+        :param end:         int, the block height to stop at (exclusive)
+        :param chunk_tx:    int, the number of transactions per chunk
+        :return:            list, a tuple of first block height and block height to stop at (exclusive) per chunk in
+                            order of height
+        """
+        end = min(end, self._count)
+        chunks = []
+        start = 0
+        tx = 0
+        for height in range(end):
+            tx += self.location(height)[3]
+            if tx >= chunk_tx:
+                chunks.append((start, height + 1))
+                start = height + 1
+                tx = 0
+        if start < end:
+            chunks.append((start, end))
+        return chunks
+
+    def block_view(self, block_path, height):
+        """
+        Returns the serialized block at a given height without copying it
+
+        :param block_path:  str, the path to the Bitcoin blocks
+        :param height:      int, the block height
+        :return:            memoryview, the serialized block within the memory-mapped blk file
+        """
+        file_number, offset, size, _, _ = self.location(height)
+        if file_number not in self._files:
+            if len(self._files) >= _OPEN_FILES:
+                # Not closed explicitly, the file is unmapped once no view of it is left
+                del self._files[next(iter(self._files))]
+            with open(block_file(block_path, file_number), 'rb') as f:
+                self._files[file_number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._files[file_number])[offset:offset + size]
+
+    def read_block(self, block_path, height):
+        """
+        Returns a copy of the serialized block at a given height
+
+        :param block_path:  str, the path to the Bitcoin blocks
+        :param height:      int, the block height
+        :return:            bytes, the serialized block
+        """
+        return bytes(self.block_view(block_path, height))
+
+
+def load_index(path, index_path, block_path, end=None):
+    """
+    Opens the block index, building it first if it does not exist, does not reach the requested height or no longer
+    matches the main chain. Blocks near the tip may have been replaced by a reorg since the index was built. As every
+    block commits to the one before it, the index still matches if its last block is on the main chain. An existing
+    index is only extended from the last block it shares with the main chain.
+
+    :param path:        str, the block index file
+    :param index_path:  str, the path to the LevelDB Bitcoin index
+    :param block_path:  str, the path to the Bitcoin blocks
+    :param end:         int, the block height the index has to reach. If None, the index has to cover the entire chain.
+    :return:            BlockIndex, the opened index
+    """
+    if not os.path.exists(path):
+        print("Building block index in " + path + ". This is only done once.")
+        build_index(path, index_path, block_path)
+        return BlockIndex(path)
+
+    index = BlockIndex(path)
+    # Much cheaper than looking up the size of every block in the blk files
+    chain = main_chain(index_path)
+    shared = shared_blocks(index, chain)
+    if shared == len(index) and shared >= (len(chain) if end is None else end):
+        return index
+    if shared < len(index):
+        print("Block index in " + path + " does not match the main chain anymore, there has been a reorg. Updating it "
+              "from block " + str(shared) + " on.")
+    else:
+        print("Block index in " + path + " only covers " + str(len(index)) + " blocks. Extending it.")
+    build_index(path, index_path, block_path, chain, index)
+    return BlockIndex(path)
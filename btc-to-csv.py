@@ -11,14 +11,28 @@ daemon must NOT be running during conversion.
 
 import argparse
 import csv
+import json
 import os
-import pickle
 import platform
+import signal
+import sys
+import time
 
 import psutil
 import rocksdb
 import tqdm
-from blockchain_parser.blockchain import Blockchain
+
+from blkreader import iter_blocks, AddressEncoder, CACHE_SIZE
+from readahead import READAHEAD_BYTES
+from blockindex import load_index
+from txdb import UNKNOWN_ADDRESS, txid_key, outpoint_key, encode_outputs, decode_output, encode_outpoint, \
+    decode_outpoint, check_layout, LAYOUT_TRANSACTIONS, LAYOUT_OUTPOINTS
+from follow import new_state, load_state, save_state, find_fork, rollback, BlockBatch, REORG_DEPTH
+from cypher import write_delta_cypher
+from sinks import CSV_FILES
+from budget import MemoryBudget, memory_total, WRITE_BUFFERS, MB
+from outputcache import OutputCache, FLUSH_BLOCKS
+from shardeddb import ShardedDB, shard_paths
 
 # Parse command-line arguments
 ap = argparse.ArgumentParser()
@@ -29,17 +43,51 @@ ap.add_argument("--btcdir", help="Installation path of Bitcoin Core",
                 type=str, default="")
 ap.add_argument("--outdir", help="Directory to store the CSVs in. Defaults to current working directory",
                 type=str, default="")
-ap.add_argument("--dbdir", help="Directory for the RocksDB to reside in. Defaults to current working directory",
+ap.add_argument("--dbdir", help="Directory for the RocksDB to reside in. Defaults to current working directory. "
+                                "Several directories separated by commas spread the shards of --dbshards over them",
                 type=str, default="")
+ap.add_argument("--dbshards", help="Number of RocksDB instances the transaction database is split into by txid, "
+                                  "defaults to 1", type=int, default=1)
 ap.add_argument("--mem", help="Maximum memory (in MB) the parser is allowed to use",
                 type=int, default=-1)
+ap.add_argument("--prune", help="Delete spent outputs, so the database only holds the UTXO set",
+                action="store_true")
+ap.add_argument("--blockindex", help="File to store the block index in. Defaults to block_index.bin in current "
+                                    "working directory", type=str, default="")
+ap.add_argument("--follow", help="Export only the blocks added since the last run with --follow to a delta directory "
+                                "in --outdir", action="store_true")
+ap.add_argument("--statsfile", help="Write the duration of every stage and lookup statistics to this JSON file",
+                type=str, default="")
+ap.add_argument("--addrcache", help="Number of recently used addresses whose encoding is cached, defaults to " +
+                                   str(CACHE_SIZE), type=int, default=CACHE_SIZE)
+ap.add_argument("--flushblocks", help="Number of blocks whose outputs are written to the database at once, defaults "
+                                     "to " + str(FLUSH_BLOCKS), type=int, default=FLUSH_BLOCKS)
+ap.add_argument("--readahead", help="Memory (in MB) for blocks read ahead by a background thread, defaults to " +
+                                   str(READAHEAD_BYTES // MB) + ". 0 reads the memory-mapped blk files while decoding",
+                type=int, default=READAHEAD_BYTES // MB)
+ap.add_argument("--encoders", help="Number of processes encoding addresses, defaults to 0 (encoded by the parser "
+                                  "itself)", type=int, default=0)
 args = vars(ap.parse_args())
 
 # Initialize global constants from CLI arguments
 START_BLOCK: int = args['startblock']
+PRUNE: bool = args['prune']
+FOLLOW: bool = args['follow']
+STATS_FILE: str = args['statsfile']
+ADDR_CACHE: int = max(args['addrcache'], 0)
+ENCODERS: int = max(args['encoders'], 0)
+FLUSH: int = max(args['flushblocks'], 1)
+DB_SHARDS: int = max(args['dbshards'], 1)
+READAHEAD: int = max(args['readahead'], 0) * MB
+
+# Duration of every stage of the run in seconds and the number of outputs looked up, written to --statsfile
+run_stats = {'stages': {}, 'lookups': 0}
+stage_started = time.perf_counter()
 
 if args['endblock'] > 0:
     END_BLOCK: int = args['endblock']
+else:
+    END_BLOCK: int = -1
 
 if args['outdir'] == "":
     # If no output directory is specified, save processed data to "csv" folder in current directory
@@ -54,6 +102,12 @@ if args['dbdir'] == "":
     print("No database directory specified. Initializing RocksDB in " + DB_PATH)
 else:
     DB_PATH: str = args['dbdir']
+# The shards of the database are spread over the directories given
+DB_PATHS = shard_paths(DB_PATH.split(","), DB_SHARDS)
+
+if FOLLOW and DB_SHARDS > 1:
+    sys.exit("ERROR: --follow writes the outputs of every block together with the follow state, which requires a "
+             "single shard.")
 
 # Set Bitcoin path to system defaults unless specified otherwise.
 # See: https://en.bitcoin.it/wiki/Data_directory
@@ -79,6 +133,106 @@ if not os.path.exists(BASE_PATH):
 BLOCK_PATH = os.path.join(BLOCK_PATH, "blocks")
 INDEX_PATH = os.path.join(BLOCK_PATH, "index")
 
+if args['blockindex'] == "":
+    BLOCK_INDEX_PATH: str = os.path.join(os.getcwd(), "block_index.bin")
+else:
+    BLOCK_INDEX_PATH: str = args['blockindex']
+
+# Read installed memory to allocate as much RAM as possible to database without bricking the system.
+mem = psutil.virtual_memory()
+
+print("Found " + str(round(mem.total / 1024 ** 3, 1)) + "GB of RAM on your system, " + str(
+    round(mem.available / 1024 ** 3, 1)) + "GB of which are available.")
+
+# The memory budget (--mem in MB, unless more than is available) goes to RocksDB and the cache of recently created
+# outputs, as everything runs in this process
+budget = MemoryBudget(memory_total(args["mem"]), 0)
+print(budget.describe())
+
+# if 0 < args["cores"] <= cpus:
+#     max_jobs = args["cores"]
+# else:
+#     max_jobs = cpus - 1
+
+# print("Found " + str(cpus) + " CPU cores on your system. " + str(max_jobs) + " cores will be used.")
+
+
+def db_options():
+    """
+    Returns the options of a shard of the transaction database. Memtables and block cache are split evenly between
+    the shards.
+
+    :return:    rocksdb.Options, the options
+    """
+    opts = rocksdb.Options()
+    # Create new instance if not already present
+    opts.create_if_missing = True
+    # We have A LOT of BTC-Transactions, so file open limit should be increased
+    opts.max_open_files = 1000000
+    # Increase buffer size since I/O is the bottleneck, not RAM
+    opts.write_buffer_size = budget.write_buffer_size // DB_SHARDS
+    opts.max_write_buffer_number = WRITE_BUFFERS
+    opts.target_file_size_base = 67108864
+    # Bloom filters for faster lookup
+    opts.table_factory = rocksdb.BlockBasedTableFactory(
+        filter_policy=rocksdb.BloomFilterPolicy(12),
+        block_cache=rocksdb.LRUCache(budget.block_cache // DB_SHARDS))
+    return opts
+
+
+# Load RocksDB Database
+try:
+    db = ShardedDB(DB_PATHS, db_options)
+    check_layout(db, LAYOUT_OUTPOINTS if PRUNE else LAYOUT_TRANSACTIONS, create=True)
+except ValueError as e:
+    sys.exit("ERROR: " + str(e))
+
+# Load Blockchain. The block index has to reach the tip when processing the entire chain or following it, as the chain
+# might have grown. Only the blocks added since, or replaced by a reorg, are added to it.
+block_index = load_index(BLOCK_INDEX_PATH, INDEX_PATH, BLOCK_PATH,
+                         END_BLOCK if END_BLOCK > 0 and not FOLLOW else None)
+
+
+def finish_delta(state):
+    """
+    Writes the Cypher statements of the current delta and marks it as finished in the follow state
+
+    :param state:   dict, the follow state
+    """
+    path = os.path.join(state['delta'], 'delta.cypher')
+    write_delta_cypher(state['delta'], path, state['removed'])
+    print("Delta written to " + state['delta'] + ". Apply it with: cypher-shell < " + path)
+    state['removed'] = []
+    state['delta'] = None
+    save_state(db, state)
+
+
+if FOLLOW:
+    state = load_state(db)
+    if state is None:
+        # The first run exports everything from --startblock on
+        state = new_state(START_BLOCK)
+    elif state['delta'] is not None:
+        # The previous run was interrupted. Rows of the block that had not been committed yet are cut off.
+        print("Completing the delta of the interrupted run.")
+        for name, size in state['offsets'].items():
+            os.truncate(os.path.join(state['delta'], name + '.csv'), size)
+        finish_delta(state)
+    try:
+        fork = find_fork(state, block_index)
+        if fork < state['height']:
+            print("The chain has been reorganized. Rolling back " + str(rollback(db, state, fork)) + " blocks.")
+    except ValueError as e:
+        sys.exit("ERROR: " + str(e))
+    START_BLOCK = state['height'] + 1
+    END_BLOCK = len(block_index)
+    if START_BLOCK >= END_BLOCK and not state['removed']:
+        sys.exit("No new blocks since the last run.")
+    # Every run writes its delta to a directory of its own
+    BASE_PATH = os.path.join(BASE_PATH, "delta-%08d-" % START_BLOCK + time.strftime('%Y%m%dT%H%M%S', time.gmtime()))
+    os.makedirs(BASE_PATH)
+    state['delta'] = BASE_PATH
+
 # Create output files
 address_file = open(os.path.join(BASE_PATH, 'addresses.csv'), 'w')
 address_file_w = csv.writer(address_file)
@@ -105,121 +259,136 @@ sends_file_w = csv.writer(sends_file)
 address_file_w.writerow(['coinbase'])
 address_file_w.writerow(['unknown'])
 
-# Read installed memory to allocate as much RAM as possible to database without bricking the system.
-mem = psutil.virtual_memory()
-# Check for user-defined memory constraints and make sure that user did not specify more RAM than installed
+# Files in the order of CSV_FILES
+output_handles = [address_file, blocks_file, transaction_file, before_file, belongs_file, receives_file, sends_file]
 
-if 0 < args["mem"] <= mem.available:
-    db_memory = args["mem"]
-else:
-    db_memory = mem.available - (4 * 1024 ** 3)
 
-print("Found " + str(round(mem.total / 1024 ** 3, 1)) + "GB of RAM on your system, " + str(
-    round(mem.available / 1024 ** 3, 1)) + \
-      "GB of which are available. RocksDB will use up to " + str(round(db_memory / 1024 ** 3, 1)) + "GB for Cache.")
+def record_offsets(state):
+    """
+    Records the size of the csv files in the follow state. Committed together with the next block.
 
-# if 0 < args["cores"] <= cpus:
-#     max_jobs = args["cores"]
-# else:
-#     max_jobs = cpus - 1
+    :param state:   dict, the follow state
+    """
+    for f in output_handles:
+        f.flush()
+    state['offsets'] = {name: f.tell() for name, f in zip(CSV_FILES, output_handles)}
 
-# print("Found " + str(cpus) + " CPU cores on your system. " + str(max_jobs) + " cores will be used.")
 
-opts = rocksdb.Options()
-# Create new instance if not already present
-opts.create_if_missing = True
-# We have A LOT of BTC-Transactions, so file open limit should be increased
-opts.max_open_files = 1000000
-# Increase buffer size since I/O is the bottleneck, not RAM
-opts.write_buffer_size = db_memory * 0.3
-opts.max_write_buffer_number = 3
-opts.target_file_size_base = 67108864
-# Bloom filters for faster lookup
-opts.table_factory = rocksdb.BlockBasedTableFactory(
-    filter_policy=rocksdb.BloomFilterPolicy(12),
-    block_cache=rocksdb.LRUCache(db_memory * 0.3),
-    block_cache_compressed=rocksdb.LRUCache(db_memory * 0.4))
+if FOLLOW:
+    record_offsets(state)
+    save_state(db, state)
+    # Changes are collected per block and written together with the follow state
+    store = BlockBatch(db, state, False)
+else:
+    # Outputs are written behind in batches and recently created outputs are looked up in memory
+    store = OutputCache(db, budget.output_cache, FLUSH)
 
-# Load RocksDB Database
-db = rocksdb.DB(DB_PATH, opts)
+# Addresses are encoded block by block from the script types and hashes extracted by the reader
+encoder = AddressEncoder(ADDR_CACHE, ENCODERS)
 
-# Load Blockchain
-blockchain = Blockchain(BLOCK_PATH)
 # Initialize iterator with respect to user specifications
 if END_BLOCK < 1:
-    blockchain = blockchain.get_ordered_blocks(INDEX_PATH, start=START_BLOCK)
-    TOTAL_BLOCKS = len(blockchain.blockIndexes)
+    blockchain = iter_blocks(BLOCK_INDEX_PATH, BLOCK_PATH, START_BLOCK, len(block_index), encoder=encoder,
+                             readahead=READAHEAD)
+    TOTAL_BLOCKS = len(block_index)
     print("Processing the entire blockchain.")
     print("INFO: Depending on your system, this process may take up to a week. You can interrupt the process " +
-          "at any time by pressing CTRL+C.")
+          "at any time by pressing CTRL+C. It stops at the end of the current block.")
     iterator = blockchain
 else:
-    blockchain = blockchain.get_ordered_blocks(INDEX_PATH, start=START_BLOCK, end=END_BLOCK)
+    blockchain = iter_blocks(BLOCK_INDEX_PATH, BLOCK_PATH, START_BLOCK, END_BLOCK, encoder=encoder,
+                             readahead=READAHEAD)
     iterator = tqdm.tqdm(blockchain, total=END_BLOCK-START_BLOCK)
 
+run_stats['stages']['setup'] = time.perf_counter() - stage_started
+stage_started = time.perf_counter()
+blocks_done = 0
+transactions_done = 0
+
+# Set by CTRL+C or SIGTERM. Outputs are written behind, so the run stops at the end of the current block and writes
+# the outputs of all blocks exported so far before it exits. Otherwise, the database would lack outputs that the
+# inputs of later blocks spend. With --follow, every block is committed on its own and the next run completes the
+# delta.
+interrupted = False
+
+
+def interrupt(signum, frame):
+    global interrupted
+    if interrupted:
+        # A second interrupt stops right away
+        raise KeyboardInterrupt
+    interrupted = True
+
+
+if not FOLLOW:
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+
 for block in iterator:
     block_height = block.height
     block_hash = block.hash
-    block_timestamp = block.header.timestamp.strftime('%Y-%m-%dT%H:%M')
-    block_date = block.header.timestamp.strftime('%Y-%m-%d')
-    previous_block_hash = block.header.previous_block_hash
+    block_time = time.gmtime(block.timestamp)
+    block_timestamp = time.strftime('%Y-%m-%dT%H:%M', block_time)
+    block_date = time.strftime('%Y-%m-%d', block_time)
+    previous_block_hash = block.prev_hash
 
     blocks_file_w.writerow([block_hash, block_height, block_timestamp])
     before_file_w.writerow([previous_block_hash, block_hash, 'PRECEDES'])
+    if FOLLOW:
+        # Blocks close to the tip may be replaced by a reorganization, so their changes have to be undoable
+        store.undo = block_height >= END_BLOCK - REORG_DEPTH
 
     for tx in block.transactions:
         tx_id = tx.txid
 
-        outputs = []
+        # List of outputs, where each output is a tuple comprising value and receiving address
+        outputs = tx.outputs
         addresses = []
         receives = []
         inSum = 0
         outSum = 0
         inDegree = 0
-        for o in range(len(tx.outputs)):
-            try:
-                # Create a list of outputs, where each output is itself a list comprising value, receiving address and
-                # output number.
-                addr = tx.outputs[o].addresses[0].address
-                val = tx.outputs[o].value
-                outSum += val
-                outputs.append([val, addr, o])
+        for o, (val, addr) in enumerate(outputs):
+            outSum += val
+            if addr != UNKNOWN_ADDRESS:
                 receives.append([tx_id, val, o, addr, 'RECEIVES'])
                 addresses.append([addr])
-            except Exception as e:
-                val = tx.outputs[o].value
-                outSum += val
-                outputs.append([val, 'unknown', o])
-                pass
-        # Add the output list to the database. Data must be serialized to bytestring.
-        db.put(tx_id.encode('utf-8'), pickle.dumps(outputs))
+        # Add the outputs to the database. Data must be serialized to bytestring.
+        if PRUNE:
+            # One entry per output, so spent outputs can be removed individually
+            for o, (val, addr) in enumerate(outputs):
+                store.put(outpoint_key(tx_id, o), encode_outpoint(val, addr))
+        else:
+            store.put(txid_key(tx_id), encode_outputs(outputs))
         tx_in = tx.inputs
         # Coinbase transactions (newly generated coins) have no sending address. So there's no need to look it up.
-        if not tx.is_coinbase():
+        if not tx.coinbase:
             sends = []
-            # Iterate over all transaction inputs
-            for i in tx_in:
+            # Iterate over all transaction inputs. Each input is the hash and output index of the transaction the
+            # coins have been last spent in.
+            for in_hash, in_index in tx_in:
                 inDegree += 1
-                # Get hash of the transaction the coins have been last spent in
-                in_hash = i.transaction_hash
-                # Get the index of the transaction output the coins have been last spent in
-                in_index = i.transaction_index
                 try:
-                    # Retrieve last spending transaction from database
-                    in_transaction = pickle.loads(db.get(in_hash.encode('utf-8')))
-                    # Get value and receiving address of last transaction (i.e. spending address in this tx)
-                    in_value = in_transaction[in_index][0]
+                    # Retrieve last spending transaction from database and decode value and receiving address of the
+                    # spent output (i.e. spending address in this tx)
+                    if PRUNE:
+                        in_key = outpoint_key(in_hash, in_index)
+                        in_value, in_address = decode_outpoint(store.get(in_key))
+                        # Output is spent now and will never be looked up again
+                        store.delete(in_key)
+                    else:
+                        in_value, in_address = decode_output(store.get(txid_key(in_hash)), in_index)
                     inSum += in_value
-                    in_address = in_transaction[in_index][1]
                     sends.append([in_address, in_value, tx_id, 'SENDS'])
                     # Catch exceptions that might occur when dealing with certain kinds of ominous transactions.
                     # This is very rare and should not break everything.
                 except Exception as e:
                     print(e)
                     continue
-                del in_transaction, in_address, in_value, in_hash, in_index
+                del in_address, in_value
+            run_stats['lookups'] += inDegree
         else:
-            sends = [["coinbase", sum(map(lambda x: x.value, tx.outputs)), tx_id, 'SENDS']]
+            sends = [["coinbase", outSum, tx_id, 'SENDS']]
             inSum = sends[0][1]
             inDegree = 1
 
@@ -232,7 +401,22 @@ for block in iterator:
         receives_file_w.writerows(receives)
         sends_file_w.writerows(sends)
 
+    if FOLLOW:
+        # The rows of the block are complete, so they are recorded together with its outputs
+        record_offsets(state)
+        store.commit(block_height, block_hash)
+    else:
+        store.end_block()
+    blocks_done += 1
+    transactions_done += len(block.transactions)
+    if interrupted:
+        break
+
 # Finalize
+encoder.close()
+if not FOLLOW:
+    store.flush()
+    run_stats['cache_hits'] = store.hits
 address_file.close()
 blocks_file.close()
 transaction_file.close()
@@ -240,3 +424,17 @@ before_file.close()
 belongs_file.close()
 receives_file.close()
 sends_file.close()
+
+if FOLLOW:
+    finish_delta(state)
+
+run_stats['stages']['csv'] = time.perf_counter() - stage_started
+if STATS_FILE:
+    run_stats['blocks'] = blocks_done
+    run_stats['transactions'] = transactions_done
+    with open(STATS_FILE, 'w') as f:
+        json.dump(run_stats, f, indent=2)
+
+if interrupted:
+    sys.exit("Interrupted. The database holds the outputs of all blocks up to " + str(START_BLOCK + blocks_done - 1) +
+             ". Continue with --startblock " + str(START_BLOCK + blocks_done) + " and a different --outdir.")
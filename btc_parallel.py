@@ -13,16 +13,34 @@ import argparse
 import csv
 import os
 import sys
-import pickle
-import math
+import multiprocessing
 import platform
+import time
+import glob
+import json
+import queue
+import functools
 
 import psutil
 import rocksdb
 import tqdm
-from blockchain_parser.blockchain import Blockchain
-from joblib import Parallel, delayed
-from joblib import parallel_backend
+
+from blkreader import iter_blocks, AddressEncoder, CACHE_SIZE
+from readahead import READAHEAD_BYTES
+from blockindex import load_index
+from txdb import UNKNOWN_ADDRESS, txid_key, outpoint_key, encode_outputs, encode_outpoint, lookup_outputs, \
+    check_layout, LAYOUT_TRANSACTIONS, LAYOUT_OUTPOINTS
+from sortjoin import ChunkRuns, join_runs, merge_runs, KEYVALUES
+from sinks import RecordSink, ShardSink, shard_path, CSV_FILES, ADDRESSES, SPENT
+from manifest import write_manifest
+from addressdb import AddressBook, InterningWriter
+from journal import new_journal, load_journal, write_journal
+from addrstats import ChunkAddressStats, merge_address_stats
+import gzipstream
+from gzipstream import open_csv
+from metrics import StageTimer, RunMetrics, rocksdb_properties
+from budget import MemoryBudget, memory_total, process_memory, private_memory, WRITE_BUFFERS, MB
+from shardeddb import ShardedDB, shard_paths, partition_count
 
 # Parse command-line arguments
 ap = argparse.ArgumentParser()
@@ -33,12 +51,72 @@ ap.add_argument("--btcdir", help="Installation path of Bitcoin Core",
                 type=str, default="")
 ap.add_argument("--outdir", help="Directory to store the CSVs in. Defaults to current working directory",
                 type=str, default="")
-ap.add_argument("--dbdir", help="Directory for the RocksDB to reside in. Defaults to current working directory",
+ap.add_argument("--dbdir", help="Directory for the RocksDB to reside in. Defaults to current working directory. "
+                                "Several directories separated by commas spread the shards of --dbshards over them",
                 type=str, default="")
+ap.add_argument("--dbshards", help="Number of RocksDB instances the transaction database is split into by txid, "
+                                  "defaults to 1", type=int, default=1)
 ap.add_argument("--cores", help="Number of cores the parser is allowed to use",
                 type=int, default=-1)
-ap.add_argument("--mem", help="Maximum memory (in MB) the parser is allowed to use",
-                type=int, default=-1)
+ap.add_argument("--mem", help="Maximum memory (in MB) the parser is allowed to use, shared by workers, rows in flight "
+                             "and RocksDB", type=int, default=-1)
+ap.add_argument("--prune", help="Delete spent outputs, so the database only holds the UTXO set",
+                action="store_true")
+ap.add_argument("--batchsize", help="Number of transactions whose inputs are looked up at once, defaults to 1000",
+                type=int, default=1000)
+ap.add_argument("--engine", help="How inputs are resolved: lookup (RocksDB, default) or join (sort-merge join)",
+                type=str, choices=["lookup", "join"], default="lookup")
+ap.add_argument("--rundir", help="Directory for sorted runs and SST files. Defaults to current working directory",
+                type=str, default="")
+ap.add_argument("--blockindex", help="File to store the block index in. Defaults to block_index.bin in current "
+                                    "working directory", type=str, default="")
+ap.add_argument("--skipbuild", help="Do not build the transaction database, use the existing one in --dbdir",
+                action="store_true")
+ap.add_argument("--queuedepth", help="Number of row batches that may be in flight between workers and writer, "
+                                    "defaults to a share of --mem", type=int, default=0)
+ap.add_argument("--output", help="single (default): one csv per output written by the main process, sharded: every "
+                                "worker writes its own csv shards, listed in manifest.json", type=str,
+                choices=["single", "sharded"], default="single")
+ap.add_argument("--format", help="csv (default) or parquet: typed, compressed Parquet files for Spark or DuckDB, "
+                                "written by the workers like sharded output. Requires pyarrow", type=str,
+                choices=["csv", "parquet"], default="csv")
+ap.add_argument("--compress", help="Write the csv files gzip compressed. neo4j-admin imports them directly",
+                action="store_true")
+ap.add_argument("--compressthreads", help="Number of threads per process compressing csv files, defaults to 4",
+                type=int, default=4)
+ap.add_argument("--intern", help="Give every address an integer ID, write each address once and reference the IDs in "
+                                "the relationship files", action="store_true")
+ap.add_argument("--addrdb", help="Directory for the address database used by --intern. Defaults to current working "
+                                "directory", type=str, default="")
+ap.add_argument("--addrstats", help="Write in- and out-degree, received and sent value and first and last block of "
+                                   "every address to the address file", action="store_true")
+ap.add_argument("--resume", help="Continue the interrupted run in --outdir from its last checkpoint",
+                action="store_true")
+ap.add_argument("--recordbatch", help="Number of rows workers send to the writer at once, defaults to 10000",
+                type=int, default=10000)
+ap.add_argument("--statsfile", help="Write the duration of every stage and lookup statistics to this JSON file",
+                type=str, default="")
+ap.add_argument("--metrics", help="Prometheus textfile to write progress and performance metrics to", type=str,
+                default="")
+ap.add_argument("--metricsport", help="Serve progress and performance metrics at http://127.0.0.1:<port>/metrics",
+                type=int, default=0)
+ap.add_argument("--metricslog", help="File to append progress and performance metrics to as JSON lines", type=str,
+                default="")
+ap.add_argument("--metricsinterval", help="Seconds between two metrics reports, defaults to 30", type=float,
+                default=30)
+ap.add_argument("--chunktx", help="Number of transactions per chunk of work, defaults to 500000", type=int,
+                default=500000)
+ap.add_argument("--window", help="Number of chunks between two checkpoints with single output or --prune, defaults "
+                                "to 4 per core", type=int, default=0)
+ap.add_argument("--addrcache", help="Number of recently used addresses whose encoding is cached per worker, defaults "
+                                   "to " + str(CACHE_SIZE), type=int, default=CACHE_SIZE)
+ap.add_argument("--rawaddresses", help="Identify addresses by script type and hash (hex) instead of encoding them, "
+                                      "which saves Base58 and Bech32 encoding", action="store_true")
+ap.add_argument("--readahead", help="Memory (in MB) per worker for blocks read ahead by a background thread, defaults "
+                                   "to " + str(READAHEAD_BYTES // MB) + ". 0 reads the memory-mapped blk files while "
+                                   "decoding", type=int, default=READAHEAD_BYTES // MB)
+ap.add_argument("--serialreads", help="Only one worker reads ahead at a time, so a spinning disk reads sequentially",
+                action="store_true")
 
 args = vars(ap.parse_args())
 
@@ -50,6 +128,68 @@ if platform.system() != "Linux":
 
 # Initialize global constants from CLI arguments
 START_BLOCK: int = args['startblock']
+PRUNE: bool = args['prune']
+BATCH_SIZE: int = max(args['batchsize'], 1)
+ENGINE: str = args['engine']
+SKIP_BUILD: bool = args['skipbuild']
+QUEUE_DEPTH: int = args['queuedepth']
+RECORD_BATCH: int = max(args['recordbatch'], 1)
+OUTPUT: str = args['output']
+FORMAT: str = args['format']
+COMPRESS: bool = args['compress']
+INTERN: bool = args['intern']
+RESUME: bool = args['resume']
+ADDR_STATS: bool = args['addrstats']
+CHUNK_TX: int = max(args['chunktx'], 1)
+ADDR_CACHE: int = max(args['addrcache'], 0)
+RAW_ADDRESSES: bool = args['rawaddresses']
+DB_SHARDS: int = max(args['dbshards'], 1)
+READAHEAD: int = max(args['readahead'], 0) * MB
+STATS_FILE: str = args['statsfile']
+# Workers only time their stages if the timings are reported somewhere
+METRICS: bool = bool(args['metrics'] or args['metricsport'] or args['metricslog'] or STATS_FILE)
+
+# Duration of every stage of the run in seconds and lookup statistics, written to --statsfile
+run_stats = {'stages': {}, 'lookups': 0, 'lookup_time': 0.0}
+stage_started = time.perf_counter()
+
+
+def end_stage(name):
+    """
+    Records the duration of a stage, which lasted from the end of the previous stage until now
+
+    :param name:    str, the name of the stage
+    """
+    global stage_started
+    now = time.perf_counter()
+    run_stats['stages'][name] = run_stats['stages'].get(name, 0.0) + now - stage_started
+    stage_started = now
+
+
+if ENGINE == "join" and PRUNE:
+    sys.exit("ERROR: The join engine does not use a database and cannot be combined with --prune.")
+
+if FORMAT == "parquet":
+    # Every worker writes the files of its chunks, which partitions the output by block height
+    OUTPUT = "sharded"
+    try:
+        import columnar
+    except ImportError:
+        sys.exit("ERROR: Parquet output requires pyarrow. Install it with 'pip install pyarrow'.")
+if FORMAT == "parquet" and COMPRESS:
+    sys.exit("ERROR: Parquet files are always compressed, --compress only applies to csv output.")
+# Compression threads are started by every process that writes compressed files
+gzipstream.THREADS = max(args['compressthreads'], 1)
+# Extension of the files of the output format
+EXTENSION = "parquet" if FORMAT == "parquet" else "csv.gz" if COMPRESS else "csv"
+
+if INTERN and OUTPUT == "sharded":
+    sys.exit("ERROR: Address IDs are assigned by the main process, so --intern cannot be combined with sharded or "
+             "Parquet output.")
+
+if ADDR_STATS and ENGINE == "join":
+    sys.exit("ERROR: The join engine resolves SENDS relationships after parsing, so --addrstats requires the lookup "
+             "engine.")
 
 if args['endblock'] > 0:
     END_BLOCK: int = args['endblock']
@@ -69,6 +209,20 @@ if args['dbdir'] == "":
     print("No database directory specified. Initializing RocksDB in " + DB_PATH)
 else:
     DB_PATH: str = args['dbdir']
+# The shards of the database are spread over the directories given, e.g. one per disk
+DB_PATHS = shard_paths(DB_PATH.split(","), DB_SHARDS)
+
+if args['addrdb'] == "":
+    # If no address database directory is specified, save it to "address_db" folder in current directory
+    ADDR_DB_PATH: str = os.path.join(os.getcwd(), "address_db")
+else:
+    ADDR_DB_PATH: str = args['addrdb']
+
+if args['rundir'] == "":
+    # If no run directory is specified, save sorted runs and SST files to "runs" folder in current directory
+    RUN_PATH: str = os.path.join(os.getcwd(), "runs")
+else:
+    RUN_PATH: str = args['rundir']
 
 # Set Bitcoin path to system defaults unless specified otherwise.
 # See: https://en.bitcoin.it/wiki/Data_directory
@@ -90,170 +244,512 @@ else:
 
 if not os.path.exists(BASE_PATH):
     os.makedirs(BASE_PATH)
+# Workers write their shards to a subdirectory of the output directory
+SHARD_PATH = os.path.join(BASE_PATH, "shards")
+if OUTPUT == "sharded" and not os.path.exists(SHARD_PATH):
+    os.makedirs(SHARD_PATH)
 # Create subpaths for Index and Blocks
 BLOCK_PATH = os.path.join(BLOCK_PATH, "blocks")
 INDEX_PATH = os.path.join(BLOCK_PATH, "index")
 
-# Create output files
-address_file = open(os.path.join(BASE_PATH, 'addresses.csv'), 'w')
-address_file_w = csv.writer(address_file)
+if args['blockindex'] == "":
+    BLOCK_INDEX_PATH: str = os.path.join(os.getcwd(), "block_index.bin")
+else:
+    BLOCK_INDEX_PATH: str = args['blockindex']
+
+# Settings that change the contents of the output. A run can only be resumed with the same settings.
+RUN_CONFIG = {'endblock': END_BLOCK, 'prune': PRUNE, 'engine': ENGINE, 'output': OUTPUT, 'format': FORMAT,
+              'compress': COMPRESS, 'intern': INTERN, 'addrstats': ADDR_STATS, 'chunktx': CHUNK_TX,
+              'rawaddresses': RAW_ADDRESSES}
+if RESUME:
+    try:
+        journal = load_journal(BASE_PATH, RUN_CONFIG)
+    except ValueError as e:
+        sys.exit("ERROR: " + str(e))
+    if journal['complete']:
+        sys.exit("The run in " + BASE_PATH + " is already complete.")
+    print("Resuming run in " + BASE_PATH + ". " + str(len(journal['chunks'])) + " chunks have already been processed.")
+else:
+    journal = new_journal(RUN_CONFIG)
+
+# Block locations are read from Bitcoin Core's LevelDB index only once and shared by all workers
+block_index = load_index(BLOCK_INDEX_PATH, INDEX_PATH, BLOCK_PATH, END_BLOCK)
+print("Block index covers " + str(len(block_index)) + " blocks, " + str(block_index.tx_count(0, END_BLOCK)) +
+      " transactions will be processed.")
 
-blocks_file = open(os.path.join(BASE_PATH, 'blocks.csv'), 'w')
-blocks_file_w = csv.writer(blocks_file)
+if INTERN:
+    address_db = rocksdb.DB(ADDR_DB_PATH, rocksdb.Options(create_if_missing=True))
+    if RESUME:
+        # Addresses that got their ID after the last checkpoint are written again, as their rows have been cut off
+        address_book = AddressBook(address_db, replay_from=journal['address_ids'])
+    else:
+        # IDs are only written once, so every run needs an address database of its own
+        address_book = AddressBook(address_db)
+        if len(address_book) > 0:
+            sys.exit("ERROR: The address database in " + ADDR_DB_PATH + " already holds addresses. Use a new --addrdb.")
+
+
+def output_path(name):
+    """
+    Returns the path of the file written by the main process for an output
+
+    :param name:    str, the name of the output (one of CSV_FILES)
+    :return:        str, the path of the file
+    """
+    if OUTPUT == "sharded":
+        # Only receives the coinbase address and, with the join engine, transactions and SENDS relationships
+        return os.path.join(SHARD_PATH, name + "-main." + EXTENSION)
+    return os.path.join(BASE_PATH, name + "." + EXTENSION)
 
-transaction_file = open(os.path.join(BASE_PATH, 'transactions.csv'), 'w')
-transaction_file_w = csv.writer(transaction_file)
 
-before_file = open(os.path.join(BASE_PATH, 'before-rel.csv'), 'w')
-before_file_w = csv.writer(before_file)
+def open_output(name):
+    """
+    Opens the csv file written by the main process for an output. When resuming, everything written after the last
+    checkpoint is cut off and new rows are appended.
+
+    :param name:    str, the name of the output (one of CSV_FILES)
+    :return:        file, the opened csv file
+    """
+    path = output_path(name)
+    if RESUME:
+        os.truncate(path, journal['offsets'][name])
+        return open_csv(path, 'a', COMPRESS)
+    return open_csv(path, 'w', COMPRESS)
+
+
+if FORMAT == "parquet":
+    # Parquet files cannot be appended to. As the main process only writes the coinbase address and the rows produced
+    # after parsing, a resumed run simply writes them again.
+    output_handles = []
+    csv_writers = [columnar.ParquetWriter(output_path(name), columnar.schema(name, ADDR_STATS)) for name in CSV_FILES]
+    address_file_w, blocks_file_w, transaction_file_w, before_file_w, belongs_file_w, receives_file_w, sends_file_w = \
+        csv_writers
+else:
+    # Create output files
+    address_file = open_output('addresses')
+    address_file_w = csv.writer(address_file)
 
-belongs_file = open(os.path.join(BASE_PATH, 'belongs-rel.csv'), 'w')
-belongs_file_w = csv.writer(belongs_file)
+    blocks_file = open_output('blocks')
+    blocks_file_w = csv.writer(blocks_file)
 
-receives_file = open(os.path.join(BASE_PATH, 'receives-rel.csv'), 'w')
-receives_file_w = csv.writer(receives_file)
+    transaction_file = open_output('transactions')
+    transaction_file_w = csv.writer(transaction_file)
 
-sends_file = open(os.path.join(BASE_PATH, 'sends-rel.csv'), 'w')
-sends_file_w = csv.writer(sends_file)
+    before_file = open_output('before-rel')
+    before_file_w = csv.writer(before_file)
 
-# Add coinbase as "special" address, since it does not explicitly appear in any transaction
-address_file_w.writerow(['coinbase'])
+    belongs_file = open_output('belongs-rel')
+    belongs_file_w = csv.writer(belongs_file)
+
+    receives_file = open_output('receives-rel')
+    receives_file_w = csv.writer(receives_file)
+
+    sends_file = open_output('sends-rel')
+    sends_file_w = csv.writer(sends_file)
+
+    # Files in the order of CSV_FILES
+    output_handles = [address_file, blocks_file, transaction_file, before_file, belongs_file, receives_file, sends_file]
+
+    if INTERN:
+        # Addresses in relationships are replaced by their IDs. New addresses are written to the address file on the
+        # fly, unless they are written together with their aggregates at the end.
+        receives_file_w = InterningWriter(receives_file_w, 3, address_book, None if ADDR_STATS else address_file_w)
+        sends_file_w = InterningWriter(sends_file_w, 0, address_book, None if ADDR_STATS else address_file_w)
+
+    # Writers in the order of the record kinds sent by the workers
+    csv_writers = [address_file_w, blocks_file_w, transaction_file_w, before_file_w, belongs_file_w, receives_file_w,
+                   sends_file_w]
+
+# Add coinbase as "special" address, since it does not explicitly appear in any transaction. A resumed run already
+# has it, unless its files are written again.
+if not RESUME or FORMAT == "parquet":
+    coinbase_row = ['coinbase']
+    if ADDR_STATS:
+        # Coinbase SENDS relationships are not written by the parallel parser, so there is nothing to count
+        coinbase_row += [0, 0, 0, 0, None, None]
+    if INTERN:
+        coinbase_row = [address_book.intern(['coinbase'])[0]['coinbase']] + coinbase_row
+    address_file_w.writerow(coinbase_row)
+
+
+def checkpoint(**progress):
+    """
+    Makes everything written so far durable and records it in the journal, so an interrupted run can be resumed from
+    here
+
+    :param progress:    the journal entries to update (chunks, db_height, complete)
+    """
+    journal.update(progress)
+    for f in output_handles:
+        f.flush()
+        os.fsync(f.fileno())
+    journal['offsets'] = {name: f.tell() for name, f in zip(CSV_FILES, output_handles)}
+    if INTERN:
+        journal['address_ids'] = len(address_book)
+    write_journal(BASE_PATH, journal)
 
-# Read installed memory to allocate as much RAM as possible to database without bricking the system.
+
+checkpoint()
+
+# Read installed memory to allocate as much RAM as possible without bricking the system.
 mem = psutil.virtual_memory()
 # Read CPU core count to avoid oversubscription of cores
 cpus = psutil.cpu_count()
 
 print("The parser will now profile your system to set the correct processing parameters.")
 
-# Check for user-defined memory constraints and make sure that user did not specify more RAM than installed
-if 0 < args["mem"]*1024**2 <= mem.available:
-    db_memory = args["mem"]*1024**2
-else:
-    db_memory = mem.available - (4 * 1024 ** 3)
-
 print("Found " + str(round(mem.total / 1024 ** 3, 1)) + "GB of RAM on your system, " + str(
-    round(mem.available / 1024 ** 3, 1)) + \
-      "GB of which are available. RocksDB will use up to " + str(round(db_memory / 1024 ** 3, 1)) + " GB for Cache.")
+    round(mem.available / 1024 ** 3, 1)) + "GB of which are available.")
 
 # Check for user-defined core constraints and make sure that user did not specify more cores than installed
 if 0 < args["cores"] <= cpus:
     max_jobs = args["cores"]
 else:
-    max_jobs = cpus - 1
-
-print("Found " + str(cpus) + " CPU cores on your system. " + str(max_jobs) + " cores will be used.")
-
-# Define options for RocksDB-Database
-# Optimized for fast inserts as suggested by https://github.com/facebook/rocksdb/wiki/RocksDB-FAQ
-opts = rocksdb.Options()
-# Create new instance if not already present
-opts.create_if_missing = True
-# We have A LOT of BTC-Transactions, so file open limit should be increased (-1 = infinite)
-opts.max_open_files = -1
-# Use Vector Memtables for faster inserts (which do not allow for concurrent writes)
-opts.memtable_factory = rocksdb.VectorMemtableFactory()
-opts.allow_concurrent_memtable_write = False
-# Increase buffer size since I/O is the bottleneck, not RAM
-opts.write_buffer_size = db_memory * 0.3
-opts.max_write_buffer_number = 10
-# Increase File size: Sequential reads are much faster than random reads
-opts.target_file_size_base = 128 * 1024 ** 2
-# Disable auto compactions because they are terribly slow. Will compact manually lateron.
-opts.disable_auto_compactions = True
-opts.max_background_compactions = 10
-# Bulkload Options as suggested by RocksDB FAQ
-opts.max_background_flushes = 15
-opts.level0_file_num_compaction_trigger = -1
-opts.level0_slowdown_writes_trigger = -1
-opts.level0_stop_writes_trigger = 999999
-opts.compression = rocksdb.CompressionType.no_compression
-
-# Bloom filters for faster lookup
-opts.table_factory = rocksdb.BlockBasedTableFactory(
-    filter_policy=rocksdb.BloomFilterPolicy(10),
-    block_cache=rocksdb.LRUCache(db_memory * 0.4),
-    block_cache_compressed=rocksdb.LRUCache(db_memory * 0.3))
-
-print("Establishing Database connection.")
-
-# Load RocksDB Database
-db = rocksdb.DB(DB_PATH, opts)
-
-print("OK.")
+    max_jobs = max(cpus - 1, 1)
+
+print("Found " + str(cpus) + " CPU cores on your system. Up to " + str(max_jobs) + " cores will be used.")
+
+# The memory budget (--mem, unless more than is available) is split between workers, rows in flight and RocksDB. There
+# are no more workers than fit into the budget.
+budget = MemoryBudget(memory_total(args["mem"]), max_jobs, RECORD_BATCH)
+print(budget.describe())
+if QUEUE_DEPTH <= 0:
+    QUEUE_DEPTH = budget.queue_depth
+
+def db_options():
+    """
+    Returns the options of a shard of the transaction database. Memtables and block cache are split evenly between
+    the shards, so every shard writes and caches on its own.
+
+    :return:    rocksdb.Options, the options
+    """
+    # Optimized for fast inserts as suggested by https://github.com/facebook/rocksdb/wiki/RocksDB-FAQ
+    opts = rocksdb.Options()
+    # Create new instance if not already present
+    opts.create_if_missing = True
+    # We have A LOT of BTC-Transactions, so file open limit should be increased (-1 = infinite)
+    opts.max_open_files = -1
+    # Use Vector Memtables for faster inserts (which do not allow for concurrent writes)
+    opts.memtable_factory = rocksdb.VectorMemtableFactory()
+    opts.allow_concurrent_memtable_write = False
+    # Increase buffer size since I/O is the bottleneck, not RAM
+    opts.write_buffer_size = budget.write_buffer_size // DB_SHARDS
+    opts.max_write_buffer_number = WRITE_BUFFERS
+    # Increase File size: Sequential reads are much faster than random reads
+    opts.target_file_size_base = 128 * 1024 ** 2
+    # Disable auto compactions because they are terribly slow. Will compact manually lateron.
+    opts.disable_auto_compactions = True
+    opts.max_background_compactions = 10
+    # Bulkload Options as suggested by RocksDB FAQ
+    opts.max_background_flushes = 15
+    opts.level0_file_num_compaction_trigger = -1
+    opts.level0_slowdown_writes_trigger = -1
+    opts.level0_stop_writes_trigger = 999999
+    opts.compression = rocksdb.CompressionType.no_compression
+
+    # Bloom filters for faster lookup. Blocks are not compressed, so there is no cache for compressed blocks.
+    opts.table_factory = rocksdb.BlockBasedTableFactory(
+        filter_policy=rocksdb.BloomFilterPolicy(10),
+        block_cache=rocksdb.LRUCache(budget.block_cache // DB_SHARDS))
+    return opts
+
+
+# Workers look up outputs through read-only handles of their own, each with a block cache of its own per shard
+WORKER_CACHE = budget.worker_cache // DB_SHARDS
+
+if ENGINE == "lookup":
+    print("Establishing Database connection.")
+
+    # Load RocksDB Database. Every shard is a RocksDB instance of its own.
+    try:
+        db = ShardedDB(DB_PATHS, db_options)
+        # The database is built during the run, unless an existing one is to be reused
+        check_layout(db, LAYOUT_OUTPOINTS if PRUNE else LAYOUT_TRANSACTIONS, create=not SKIP_BUILD,
+                     raw=RAW_ADDRESSES)
+    except ValueError as e:
+        sys.exit("ERROR: " + str(e))
+
+    print("OK.")
+
+if not os.path.exists(RUN_PATH):
+    os.makedirs(RUN_PATH)
+
+# The database is built from one SST file per key range. As the key ranges do not overlap, the files can be ingested
+# in one go without any compaction. Every key range belongs to a single shard.
+SST_PARTITIONS = partition_count(DB_SHARDS, 64)
+# Writing SST files requires a version of python-rocksdb that supports them. Otherwise, all entries are written by this
+# process.
+SST_SUPPORTED = hasattr(rocksdb, 'SstFileWriter')
+# Seconds between two checks whether all workers are still alive while waiting for them
+WORKER_CHECK = 5
+
+# Addresses are encoded block by block from the script types and hashes extracted by the reader. Created before the
+# workers are started, so each of them has an encoder with a cache of its own, which it keeps for the whole run.
+address_encoder = AddressEncoder(ADDR_CACHE, 0, RAW_ADDRESSES)
+# Held by the worker reading ahead, so the disk holding the blk files serves one worker at a time. Created before the
+# workers are started, so they all share it.
+disk_lock = multiprocessing.Lock() if args['serialreads'] else None
+
+# Read-only database handle of a worker process. It is opened on the first chunk of the worker and kept for the whole
+# run. A read-only handle does not see changes made after it was opened, so in pruning mode, where the database changes
+# with every window, it is reopened once per window.
+worker_db = None
+worker_generation = None
+
+
+def worker_options():
+    """
+    Returns the options of a read-only handle of a shard of the transaction database
+
+    :return:    rocksdb.Options, the options
+    """
+    read_opts = rocksdb.Options()
+    read_opts.max_open_files = -1
+    # Bloom filters are only used if the filter policy matches the one they were written with
+    read_opts.table_factory = rocksdb.BlockBasedTableFactory(filter_policy=rocksdb.BloomFilterPolicy(10),
+                                                             block_cache=rocksdb.LRUCache(WORKER_CACHE))
+    return read_opts
+
+
+def open_worker_db(generation):
+    """
+    Returns the read-only database handle of this worker process, opening it if it is not open yet or the database has
+    changed since
+
+    :param generation:  int, the number of times the database has changed
+    :return:            ShardedDB, the handle
+    """
+    global worker_db, worker_generation
+    if worker_db is None or worker_generation != generation:
+        # The previous handle is closed once it is no longer referenced
+        worker_db = None
+        worker_db = ShardedDB(DB_PATHS, worker_options, read_only=True)
+        worker_generation = generation
+    return worker_db
+
 
 # Define Functions for parallel processing
 
-def process_chunk(BLOCK_PATH, INDEX_PATH, start):
+def process_chunk(BLOCK_PATH, BLOCK_INDEX, start, end, prune=False):
     """
-    Processes a chunk of Bitcoin blocks (start to start+1000) and returns the transaction outputs
+    Processes a chunk of Bitcoin blocks (start to end) and returns the transaction outputs
 
     :param BLOCK_PATH:  str, the path to the Bitcoin blocks
-    :param INDEX_PATH:  str, the path to the LevelDB Bitcoin index
+    :param BLOCK_INDEX: str, the path to the block index file
     :param start:       int, the block height to start at
-    :return:            list, a list of tuples. One tuple per transaction, where each tuple contains the transaction id
-                        and a serialized representation of a list of transaction outputs as bytestring.
+    :param end:         int, the block height to stop at (exclusive)
+    :param prune:       bool, whether to return one entry per output (outpoints layout) instead of one per transaction
+    :return:            list, a list of tuples. One tuple per transaction (or output), where each tuple contains the
+                        database key and a serialized record of the transaction outputs as bytestring.
     """
     re_data = []
-    # Load Blockchain, ignore Read Locks imposed by other instances of the process
-    blockchain = Blockchain(BLOCK_PATH, ignoreLocks=True)
-    blockchain = blockchain.get_ordered_blocks(INDEX_PATH, start=start, end=start + 1000)
+    # Read blocks at the locations stored in the block index
+    blockchain = iter_blocks(BLOCK_INDEX, BLOCK_PATH, start, end, encoder=address_encoder, readahead=READAHEAD,
+                             lock=disk_lock)
     for block in blockchain:
         for tx in block.transactions:
             tx_id = tx.txid
-            # Create a list of outputs, where each output is itself a list comprising value, receiving address and
-            # output number.
-            outputs = []
-            for o in range(len(tx.outputs)):
-                try:
-                    addr = tx.outputs[o].addresses[0].address
-                    val = tx.outputs[o].value
-                    outputs.append([val, addr, o])
-                except Exception as e:
-                    val = tx.outputs[o].value
-                    outputs.append([val, 'unknown', o])
-                    pass
+            # The reader already provides a list of outputs, where each output is a tuple comprising value and
+            # receiving address
+            outputs = tx.outputs
             # Add the output list of the transaction and append it to the collector list. Serialization for the
             # the database is performed here because it is costly and should be done in parallel.
-            re_data.append((tx_id, pickle.dumps(outputs)))
+            if prune:
+                re_data.extend((outpoint_key(tx_id, o), encode_outpoint(val, addr))
+                               for o, (val, addr) in enumerate(outputs))
+            else:
+                re_data.append((txid_key(tx_id), encode_outputs(outputs)))
 
     return re_data
 
 
-def generate_csv(BLOCK_PATH, INDEX_PATH, start):
+def build_chunk(BLOCK_PATH, BLOCK_INDEX, start, end, prune, RUN_PATH):
     """
-    Processes a chunk of Bitcoin blocks and returns the values that will be written into the csv files
+    Processes a chunk of Bitcoin blocks and writes its database entries to sorted runs, one for each key range
 
     :param BLOCK_PATH:  str, the path to the Bitcoin blocks
-    :param INDEX_PATH:  str, the path to the LevelDB Bitcoin index
+    :param BLOCK_INDEX: str, the path to the block index file
     :param start:       int, the block height to start at
-    :return:            tuple, a tuple of lists. Each entry in the list corresponds to one row in the csv
+    :param end:         int, the block height to stop at (exclusive)
+    :param prune:       bool, whether to create entries for the outpoints layout
+    :param RUN_PATH:    str, the directory to store the sorted runs in
+    :return:            list, the database entries if SST files are not supported, otherwise an empty list
     """
+    re_data = process_chunk(BLOCK_PATH, BLOCK_INDEX, start, end, prune)
+    if not SST_SUPPORTED:
+        return re_data
 
-    # Connect to Transaction Output Database. No weird hacks requires as RocksDB natively supports concurrent reads.
-    opts = rocksdb.Options()
-    db = rocksdb.DB(DB_PATH, opts, read_only=True)
+    # SST files require unique keys. Duplicate txids (BIP 30) keep the later transaction, just like a regular put.
+    partitions = [[] for _ in range(SST_PARTITIONS)]
+    for key, value in sorted(dict(re_data).items()):
+        partitions[key[0] * SST_PARTITIONS // 256].append((key, value))
+    del re_data
+    for p, records in enumerate(partitions):
+        path = os.path.join(RUN_PATH, "sst-" + str(p) + "-" + str(start) + ".run")
+        KEYVALUES.write(path + ".tmp", records)
+        os.replace(path + ".tmp", path)
+    return []
+
+
+def build_partition(RUN_PATH, partition, starts):
+    """
+    Merges the sorted runs of one key range into a single SST file
+
+    :param RUN_PATH:    str, the directory the sorted runs are stored in
+    :param partition:   int, the number of the key range
+    :param starts:      list, the start heights of all chunks that have been processed by build_chunk
+    :return:            str, the path of the SST file or None if there are no entries in this key range
+    """
+    paths = [os.path.join(RUN_PATH, "sst-" + str(partition) + "-" + str(c) + ".run") for c in starts]
+    records = merge_runs(KEYVALUES, paths, RUN_PATH, "sst-" + str(partition), key=lambda r: r[0])
+    previous = next(records, None)
+    if previous is None:
+        return None
+
+    path = os.path.join(RUN_PATH, "outputs-" + str(partition) + ".sst")
+    writer = rocksdb.SstFileWriter(db_options())
+    writer.open(path)
+    for record in records:
+        # Runs are merged in chunk order, so the entry of the later chunk wins if a key occurs twice
+        if record[0] != previous[0]:
+            writer.put(previous[0], previous[1])
+        previous = record
+    writer.put(previous[0], previous[1])
+    writer.finish()
+
+    for p in paths:
+        os.remove(p)
+    return path
+
+
+def check_workers():
+    """
+    Stops the run if a worker process has died, e.g. killed by the out-of-memory killer. The pool replaces the worker,
+    but the chunk it was working on never signals its end and its result never becomes ready, so the run would wait
+    for it forever. Errors raised in Python do not end the worker and are passed on with the result of the chunk.
+    """
+    if any(p.exitcode is not None for p in pool._pool) or {p.pid for p in pool._pool} != worker_pids:
+        pool.terminate()
+        raise RuntimeError("A worker process died without finishing its chunk, probably killed by the out-of-memory "
+                           "killer. Continue with --resume and a smaller --mem or fewer --cores.")
 
-    # Load Blockchain, ignore Read Locks imposed by other instances of the process
-    blockchain = Blockchain(BLOCK_PATH, ignoreLocks=True)
-    blockchain = blockchain.get_ordered_blocks(INDEX_PATH, start=start, end=start + 1000)
 
-    # Create output lists
-    address_data = []
-    blocks_data = []
-    transaction_data = []
-    before_data = []
-    belongs_data = []
-    receives_data = []
-    sends_data = []
+def wait_for(async_result):
+    """
+    Waits for the result of chunks handed out to the pool, checking regularly that all workers are still alive
+
+    :param async_result:    multiprocessing.pool.AsyncResult, the result
+    :return:                the result
+    """
+    while not async_result.ready():
+        async_result.wait(WORKER_CHECK)
+        check_workers()
+    return async_result.get()
+
+
+def build_database(chunk_list):
+    """
+    Writes the outputs of several chunks to the transaction database. Each worker writes the outputs of its chunks to
+    sorted runs, which are then merged into one SST file per key range and ingested into the database at once.
+
+    :param chunk_list:  list, first block height and block height to stop at of every chunk in order of height
+    """
+    # Chunks are handed out one at a time to the workers of the pool
+    result = wait_for(pool.starmap_async(build_chunk, [(BLOCK_PATH, BLOCK_INDEX_PATH, start, end, PRUNE, RUN_PATH)
+                                                       for start, end in chunk_list], chunksize=1))
+    if not SST_SUPPORTED:
+        # Write results to database
+        for entry in result:
+            # Pooling for faster insert
+            batch = db.batch()
+            for e in entry:
+                batch.put(e[0], e[1])
+            db.write(batch)
+        return
+    del result
+
+    files = wait_for(pool.starmap_async(build_partition, [(RUN_PATH, p, [c[0] for c in chunk_list])
+                                                          for p in range(SST_PARTITIONS)], chunksize=1))
+    # Every shard ingests the files of its key ranges
+    shard_files = [[] for _ in range(DB_SHARDS)]
+    for p, f in enumerate(files):
+        if f is not None:
+            shard_files[p * DB_SHARDS // SST_PARTITIONS].append(f)
+    db.ingest_external_file(shard_files)
+    for f in files:
+        if f is not None and os.path.exists(f):
+            os.remove(f)
+
+
+def generate_csv(BLOCK_PATH, BLOCK_INDEX, start, end, db, sink, prune=False, batch_size=1000, addr_stats=None,
+                 timer=None):
+    """
+    Processes a chunk of Bitcoin blocks and sends the values that will be written into the csv files to the writer
+
+    :param BLOCK_PATH:  str, the path to the Bitcoin blocks
+    :param BLOCK_INDEX: str, the path to the block index file
+    :param start:       int, the block height to start at
+    :param end:         int, the block height to stop at (exclusive)
+    :param db:          ShardedDB, the read-only transaction database
+    :param sink:        RecordSink, collects the rows of the chunk. Besides the csv rows, it receives the database keys
+                        of all outputs spent in this chunk.
+    :param prune:       bool, whether the database uses the outpoints layout
+    :param batch_size:  int, the number of transactions whose inputs are resolved with one database request
+    :param addr_stats:  ChunkAddressStats, collects the aggregates of the addresses in this chunk. None to skip them.
+    :param timer:       StageTimer, adds up the time spent in each stage. None to skip timing.
+    :return:            dict, the number of database lookups and the time spent on them. With a timer, also the
+                        statistics of the database.
+    """
+    # Read blocks at the locations stored in the block index
+    blockchain = iter_blocks(BLOCK_INDEX, BLOCK_PATH, start, end, timer, address_encoder, READAHEAD, disk_lock)
+
+    # Output lists are provided by the sink, which sends them to the writer once they are large enough
+    address_data, blocks_data, transaction_data, before_data, belongs_data, receives_data, sends_data, \
+        spent_data = sink.rows
+    # Transactions whose inputs have not been resolved yet and lookup statistics
+    pending = []
+    stats = {'lookups': 0, 'lookup_time': 0.0}
+
+    def resolve_pending():
+        """
+        Looks up the spent outputs of all pending transactions with a single multi_get and emits their rows
+        """
+        if not pending:
+            return
+        started = time.perf_counter()
+        resolved, lookups = lookup_outputs(db, [p for tx in pending for p in tx[3]], prune)
+        stats['lookup_time'] += time.perf_counter() - started
+        stats['lookups'] += lookups
+        if timer is not None:
+            timer.add('lookup', time.perf_counter() - started)
+        for tx_id, block_height, block_date, block_hash, prevouts, outDegree, outSum in pending:
+            inSum = 0
+            for prevout in prevouts:
+                # Get value and receiving address of the spent output (i.e. spending address in this tx). Some ominous
+                # transactions spend outputs that cannot be resolved. This is very rare and should not break everything.
+                if prevout not in resolved:
+                    print("Could not resolve input " + prevout[0] + ":" + str(prevout[1]))
+                    continue
+                in_value, in_address = resolved[prevout]
+                sends_data.append([in_address, in_value, tx_id, 'SENDS'])
+                inSum += in_value
+                if addr_stats is not None:
+                    addr_stats.send(in_address, in_value, block_height)
+            if prune:
+                # Deleting is up to the main process, other chunks of this window may still be reading
+                spent_data.extend(outpoint_key(*prevout) for prevout in prevouts if prevout in resolved)
+            transaction_data.append([tx_id, str(block_date)[0:10], len(prevouts), outDegree, inSum, outSum])
+            belongs_data.append([tx_id, block_hash, 'BELONGS_TO'])
+        pending.clear()
 
     for block in blockchain:
         # Get Block parameters
         block_height = block.height
         block_hash = block.hash
-        block_timestamp = block.header.timestamp.strftime('%Y-%m-%dT%H:%M')
-        block_date = block.header.timestamp.strftime('%Y-%m-%d')
-        previous_block_hash = block.header.previous_block_hash
+        block_time = time.gmtime(block.timestamp)
+        block_timestamp = time.strftime('%Y-%m-%dT%H:%M', block_time)
+        block_date = time.strftime('%Y-%m-%d', block_time)
+        previous_block_hash = block.prev_hash
 
         # Append block data to lists. Note: List of lists, as the csv writer will interpret each list
         # as a new row in the file.
@@ -262,127 +758,384 @@ def generate_csv(BLOCK_PATH, INDEX_PATH, start):
         for tx in block.transactions:
             tx_id = tx.txid
             # Initialize summing variables
-            inSum = 0
             outSum = 0
-            inDegree = 0
-            for o in range(len(tx.outputs)):
-                try:
-                    addr = tx.outputs[o].addresses[0].address
-                    val = tx.outputs[o].value
-                    outSum += val
+            for o, (val, addr) in enumerate(tx.outputs):
+                outSum += val
+                # Some transactions contain irregular outputs (Spam, Attacks on Bitcoin,...). These will be ignored.
+                if addr != UNKNOWN_ADDRESS:
                     receives_data.append([tx_id, val, o, addr, 'RECEIVES'])
                     address_data.append([addr])
-                # Some transactions contain irregular outputs (Spam, Attacks on Bitcoin,...). These will be ignored.
-                except Exception as e:
-                    val = tx.outputs[o].value
-                    outSum += val
-                    pass
-            tx_in = tx.inputs
+                    if addr_stats is not None:
+                        addr_stats.receive(addr, val, block_height)
+            # In-Degree is length of sending adddresses, out-degree the number of tx outputs
+            outDegree = len(tx.outputs)
+
             # Coinbase transactions (newly generated coins) have no sending address. So there's no need to look it up.
-            if not tx.is_coinbase():
-                # Iterate over all transaction inputs
-                for i in tx_in:
-                    inDegree +=1
-                    # Get hash of the transaction the coins have been last spent in
-                    in_hash = i.transaction_hash
-                    # Get the index of the transaction output the coins have been last spent in
-                    in_index = i.transaction_index
-                    try:
-                        # Retrieve last spending transaction from database
-                        in_transaction = pickle.loads(db.get(in_hash.encode()))
-                        # Get value and receiving address of last transaction (i.e. spending address in this tx)
-                        in_value = in_transaction[in_index][0]
-                        in_address = in_transaction[in_index][1]
-                        # Append data to return list
-                        sends_data.append([in_address, in_value, tx_id, 'SENDS'])
-                        inSum += in_value
-                    # Catch exceptions that might occur when dealing with certain kinds of ominous transactions.
-                    # This is very rare and should not break everything.
-                    except Exception as e:
-                        print(e)
-                        continue
-                    del in_transaction, in_address, in_value, in_hash, in_index
+            if not tx.coinbase:
+                # Inputs are resolved later on together with the inputs of other transactions
+                pending.append((tx_id, block_height, block_date, block_hash, tx.inputs, outDegree, outSum))
+                if len(pending) >= batch_size:
+                    resolve_pending()
             else:
                 # Simplified parsing for coinbase transactions
-                sends = [["coinbase", sum(map(lambda x: x.value, tx.outputs)), tx_id, 'SENDS']]
+                sends = [["coinbase", outSum, tx_id, 'SENDS']]
                 inSum = sends[0][1]
                 inDegree = 1
+                transaction_data.append([tx_id, str(block_date)[0:10], inDegree, outDegree, inSum, outSum])
+                belongs_data.append([tx_id, block_hash, 'BELONGS_TO'])
+        sink.poll()
 
-            # In-Degree is length of sending adddresses, out-degree the number of tx outputs
+    resolve_pending()
+
+    if timer is not None:
+        stats['rocksdb'] = rocksdb_properties(db)
+    return stats
+
+
+def spill_chunk(BLOCK_PATH, BLOCK_INDEX, start, end, sink, RUN_PATH, timer=None):
+    """
+    Processes a chunk of Bitcoin blocks for the join engine. Outputs, inputs and transactions are written to sorted
+    runs, all other values are sent to the writer like in generate_csv.
+
+    :param BLOCK_PATH:  str, the path to the Bitcoin blocks
+    :param BLOCK_INDEX: str, the path to the block index file
+    :param start:       int, the block height to start at
+    :param end:         int, the block height to stop at (exclusive)
+    :param sink:        RecordSink, collects the rows of the chunk. Transactions and SENDS relationships are left out
+                        and written by join_runs once all chunks have been processed.
+    :param RUN_PATH:    str, the directory to store the sorted runs in
+    :param timer:       StageTimer, adds up the time spent in each stage. None to skip timing.
+    :return:            dict, lookup statistics like generate_csv. Always zero, as the join engine does no lookups.
+    """
+    runs = ChunkRuns(RUN_PATH, start)
+
+    # Read blocks at the locations stored in the block index
+    blockchain = iter_blocks(BLOCK_INDEX, BLOCK_PATH, start, end, timer, address_encoder, READAHEAD, disk_lock)
+
+    # Output lists are provided by the sink
+    address_data, blocks_data, _, before_data, belongs_data, receives_data, _, _ = sink.rows
+
+    for block in blockchain:
+        # Get Block parameters
+        block_height = block.height
+        block_hash = block.hash
+        block_time = time.gmtime(block.timestamp)
+        block_timestamp = time.strftime('%Y-%m-%dT%H:%M', block_time)
+        block_date = time.strftime('%Y-%m-%d', block_time)
+        previous_block_hash = block.prev_hash
+
+        blocks_data.append([block_hash, block_height, block_timestamp])
+        before_data.append([previous_block_hash, block_hash, 'PRECEDES'])
+        for tx in block.transactions:
+            tx_id = tx.txid
+            outSum = 0
+            for o, (val, addr) in enumerate(tx.outputs):
+                outSum += val
+                if addr != UNKNOWN_ADDRESS:
+                    receives_data.append([tx_id, val, o, addr, 'RECEIVES'])
+                    address_data.append([addr])
+                # Irregular outputs can still be spent, so they have to be part of the join
+                runs.add_output(tx_id, o, val, addr)
             outDegree = len(tx.outputs)
 
-            transaction_data.append([tx_id, str(block_date)[0:10], inDegree, outDegree, inSum, outSum])
+            if not tx.coinbase:
+                for in_hash, in_index in tx.inputs:
+                    runs.add_input(in_hash, in_index, tx_id)
+                # The in-sum is added up by the join
+                runs.add_transaction(tx_id, block_date, len(tx.inputs), outDegree, outSum)
+            else:
+                runs.add_transaction(tx_id, block_date, 1, outDegree, outSum, outSum)
             belongs_data.append([tx_id, block_hash, 'BELONGS_TO'])
+        sink.poll()
+
+    runs.close()
 
-    # Return Lists
-
-    return (address_data, blocks_data, transaction_data, before_data, belongs_data, receives_data, sends_data)
-
-
-# Create the chunks for processing. Will generate chunks of 1,000 blocks and split these chunks into equal-sized
-# lists, where the number of elements corresponds to the number of parallel jobs. Thus, up to 100% of allocated CPU power
-# can be used. Runs as many jobs as can fit into memory (25 GB per process), but at least one. 
-# Splitting processing up in several steps is necessary, as RocksDB does not allow concurrent writes.
-# Writing one large batch of data after all blocks have been processed would cause the program to run out of memory.
-
-n = max(math.floor(mem.available /(25*1024**3)), 1)
-chunks = list(range(0, END_BLOCK, 1000))
-steps = [chunks[i:i + n] for i in range(0, len(chunks), n)]
-
-print("Initializing Transaction-Database. Depending on your system, this might take a while...")
-# for s in tqdm.tqdm(steps):
-#     with parallel_backend('multiprocessing', n_jobs=max_jobs):
-#         result = Parallel(n_jobs=-1)(delayed(process_chunk)(BLOCK_PATH, INDEX_PATH, c) for c in s)
-#     # Write results to database
-#     for entry in result:
-#         # Pooling for faster insert
-#         batch = rocksdb.WriteBatch()
-#         for e in entry:
-#             batch.put(e[0].encode(), e[1])
-#         db.write(batch)
-#     del result
-# # Auto-Compaction of database was disabled, so it has to be manually triggered.
-# db.compact_range()
-# # Same as above, but the limiting factor is now RAM. Run as many jobs as can fit into memory (25 GB per process),
-# # but at least one.
+    return {'lookups': 0, 'lookup_time': 0.0}
+
+
+def stream_chunk(chunk, generation=0):
+    """
+    Processes a chunk of Bitcoin blocks in a worker process and streams its rows to the writer through the record queue,
+    or writes them to shards of its own with sharded output. The end of the chunk is always signalled, even if
+    processing fails, so the writer never waits for it forever. Only a worker that is killed cannot signal it, which
+    the writer detects with check_workers.
+
+    :param chunk:       tuple, the block height to start at and the block height to stop at (exclusive)
+    :param generation:  int, the number of times the database has changed, see open_worker_db
+    """
+    start, end = chunk
+    # Address rows are written by the interning writers or together with the aggregates of the address
+    skip = (ADDRESSES,) if INTERN or ADDR_STATS else ()
+    if FORMAT == "parquet":
+        sink = columnar.ParquetSink(record_queue, start, RECORD_BATCH, SHARD_PATH, end, skip)
+    elif OUTPUT == "sharded":
+        sink = ShardSink(record_queue, start, RECORD_BATCH, SHARD_PATH, end, skip, COMPRESS)
+    else:
+        sink = RecordSink(record_queue, start, RECORD_BATCH, skip)
+    addr_stats = ChunkAddressStats() if ADDR_STATS else None
+    timer = StageTimer() if METRICS else None
+    if timer is not None:
+        # Handing rows on, i.e. sending them through the queue or writing shards
+        sink.poll = timer.timed('send', sink.poll)
+    started = time.perf_counter()
+    try:
+        if ENGINE == "join":
+            stats = spill_chunk(BLOCK_PATH, BLOCK_INDEX_PATH, start, end, sink, RUN_PATH, timer)
+        else:
+            # No weird hacks required, as RocksDB natively supports concurrent reads
+            stats = generate_csv(BLOCK_PATH, BLOCK_INDEX_PATH, start, end, open_worker_db(generation), sink, PRUNE,
+                                 BATCH_SIZE, addr_stats, timer)
+        if addr_stats is not None:
+            addr_stats.write(RUN_PATH, start)
+    except BaseException:
+        sink.abort()
+        raise
+    if timer is not None:
+        # Time not covered by any other stage is spent building the rows
+        timer.add('rows', time.perf_counter() - started - sum(timer.seconds.values()))
+        stats.update(stages=dict(timer.seconds), pid=os.getpid())
+    # Private memory of the worker, which calibrates the memory budget. Its RSS would include the pages of the
+    # memory-mapped blk files. The block cache has a budget of its own, so it is not counted.
+    stats['memory'] = private_memory()
+    if worker_db is not None:
+        stats['memory'] -= int(worker_db.get_property(b'rocksdb.block-cache-usage') or 0)
+    sink.close(stats)
+
+
+# Create the chunks for processing. Chunks are cut by the block index to hold about CHUNK_TX transactions each, as 1,000
+# early blocks hold a few thousand transactions and 1,000 recent blocks millions. A pool of one worker per allocated
+# core is started once and hands out the chunks one at a time whenever a worker becomes idle, largest first, so no core
+# waits for the slowest chunk of a group and the run does not end waiting for a large chunk. Workers do not hold the
+# rows of their chunk, but stream them to this process in batches through a bounded queue. Memory use is therefore set
+# by the queue depth.
+# Chunks are processed in windows that end with a checkpoint:
+# - With sharded output, every chunk writes files of its own and is recorded as soon as it is finished. All chunks form
+#   a single window, so workers never wait for each other.
+# - With single output, the rows of all running chunks are interleaved in the same files. A checkpoint is only
+#   consistent once no chunk is partially written, so workers drain at the end of every window of WINDOW chunks.
+# - In pruning mode, the outputs of a window are written right before its CSVs are generated and the outputs it spent
+#   are deleted right after, as RocksDB does not allow concurrent writes. Windows follow the block height, so outputs
+#   are in the database before they are spent. Deletions have to wait for the whole window, as its chunks run in
+#   parallel and may spend each other's outputs.
+# When resuming, chunks finished before the last checkpoint are skipped.
+# With --serialreads, chunks are handed out in order of height instead. Chunks hold about the same number of
+# transactions, so little balance is lost, and the workers read neighbouring parts of the blk files one after another.
+
+n = budget.workers
+WINDOW = args['window'] if args['window'] > 0 else 4 * n
+chunks = block_index.chunks(END_BLOCK, CHUNK_TX)
+starts = [c[0] for c in chunks]
+finished = set(journal['chunks'])
+pending_chunks = [c for c in chunks if c[0] not in finished]
+# Transactions and size of every pending chunk, by start height
+chunk_tx = {start: block_index.tx_count(start, end) for start, end in pending_chunks}
+chunk_bytes = {start: block_index.byte_count(start, end) for start, end in pending_chunks}
+
+
+def dispatch_order(chunk_list):
+    """
+    Returns chunks in the order they are handed out to the workers, largest first unless reads are serialized
+
+    :param chunk_list:  list, the chunks as tuples of first block height and block height to stop at
+    :return:            list, the chunks in order
+    """
+    if args['serialreads']:
+        return sorted(chunk_list)
+    return sorted(chunk_list, key=lambda c: chunk_tx[c[0]], reverse=True)
+
+
+if PRUNE:
+    windows = [dispatch_order(pending_chunks[i:i + WINDOW]) for i in range(0, len(pending_chunks), WINDOW)]
+elif OUTPUT == "sharded":
+    windows = [dispatch_order(pending_chunks)] if pending_chunks else []
+else:
+    pending_chunks = dispatch_order(pending_chunks)
+    windows = [pending_chunks[i:i + WINDOW] for i in range(0, len(pending_chunks), WINDOW)]
+
+print("Split blocks into " + str(len(chunks)) + " chunks of about " + str(CHUNK_TX) + " transactions, " +
+      str(len(pending_chunks)) + " of which are left to process.")
+
+# Rows travel from the workers to this process in batches. Workers block once QUEUE_DEPTH batches are waiting. The
+# queue is created before the worker processes, so they inherit it.
+record_queue = multiprocessing.Queue(QUEUE_DEPTH)
+# The workers are started once and build the database as well as generate the CSVs. Each keeps its database handle,
+# block index and open blk files from one chunk to the next.
+pool = multiprocessing.Pool(n)
+# Workers are only replaced by the pool if they die
+worker_pids = {p.pid for p in pool._pool}
+
+end_stage('setup')
+
+# In pruning mode, the database is built window by window while generating the CSVs
+if ENGINE == "lookup" and not PRUNE and not SKIP_BUILD and journal['db_height'] < END_BLOCK:
+    print("Initializing Transaction-Database. Depending on your system, this might take a while...")
+    if SST_SUPPORTED:
+        build_database(chunks)
+    else:
+        print("WARNING: This version of python-rocksdb cannot write SST files. Falling back to sequential inserts.")
+        # Steps inserted before an interruption do not need to be inserted again
+        build_steps = [chunks[i:i + n] for i in range(0, len(chunks), n) if chunks[i][0] >= journal['db_height']]
+        for s in tqdm.tqdm(build_steps):
+            build_database(s)
+            checkpoint(db_height=s[-1][1])
+        # Auto-Compaction of database was disabled, so it has to be manually triggered.
+        db.compact_range()
+    checkpoint(db_height=chunks[-1][1])
+end_stage('database')
 
 print("Generating CSV Files.")
-print("NOTE: The progress-bar vastly underestimates the duration of this process! Depending on your system "+
-       "configuration, this might take between 20 hours and several days.")
-
-for s in tqdm.tqdm(steps):
-    with parallel_backend('multiprocessing', n_jobs=n):
-        collector = Parallel(n_jobs=-1)(delayed(generate_csv)(BLOCK_PATH, INDEX_PATH, c) for c in s)
-    # Extract and flatten data
-    collected_addresses = list(map(lambda x: x[0], collector))
-    collected_addresses = [item for sublist in collected_addresses for item in sublist]
-    collected_blocks = list(map(lambda x: x[1], collector))
-    collected_blocks = [item for sublist in collected_blocks for item in sublist]
-    collected_transactions = list(map(lambda x: x[2], collector))
-    collected_transactions = [item for sublist in collected_transactions for item in sublist]
-    collected_before = list(map(lambda x: x[3], collector))
-    collected_before = [item for sublist in collected_before for item in sublist]
-    collected_belongs = list(map(lambda x: x[4], collector))
-    collected_belongs = [item for sublist in collected_belongs for item in sublist]
-    collected_receives = list(map(lambda x: x[5], collector))
-    collected_receives = [item for sublist in collected_receives for item in sublist]
-    collected_sends = list(map(lambda x: x[6], collector))
-    collected_sends = [item for sublist in collected_sends for item in sublist]
-
-    # Write CSV files
-    address_file_w.writerows(collected_addresses)
-    blocks_file_w.writerows(collected_blocks)
-    transaction_file_w.writerows(collected_transactions)
-    before_file_w.writerows(collected_before)
-    belongs_file_w.writerows(collected_belongs)
-    receives_file_w.writerows(collected_receives)
-    sends_file_w.writerows(collected_sends)
+print("NOTE: Depending on your system configuration, this might take between 20 hours and several days.")
+
+# Progress and ETA are weighted by the number of transactions of every chunk
+metrics = RunMetrics(sum(chunk_tx.values()), sum(chunk_bytes.values()), args['metricsinterval'], args['metrics'],
+                     args['metricsport'], args['metricslog'])
+progress = tqdm.tqdm(total=metrics.total_tx, unit='tx', unit_scale=True)
+
+for generation, w in enumerate(windows):
+    if PRUNE:
+        # Runs are merged in order of height, so the later of two duplicate transactions wins
+        build_database(sorted(w))
+        # Deferred deletion of the outputs spent in this window
+        batch = db.batch()
+    lookups = 0
+    lookup_time = 0.0
+    # Chunks are handed out one at a time, so an idle worker takes the next chunk right away, largest first. No more
+    # chunks run at once than the memory budget allows. The database only changes between windows in pruning mode.
+    task = functools.partial(stream_chunk, generation=generation if PRUNE else 0)
+    todo = w[::-1]
+    result = []
+    running = 0
+    # Write rows as they arrive until every chunk of the window has signalled its end
+    remaining = len(w)
+    while remaining:
+        while todo and running < budget.active:
+            result.append(pool.apply_async(task, (todo.pop(),)))
+            running += 1
+        waiting = time.perf_counter()
+        try:
+            # Wakes up regularly to report metrics while the workers are busy
+            chunk, kind, rows = record_queue.get(timeout=metrics.interval)
+        except queue.Empty:
+            # A killed worker never signals the end of its chunk
+            check_workers()
+            budget.adjust(process_memory())
+            continue
+        finally:
+            writing = time.perf_counter()
+            metrics.add_stage('wait', writing - waiting)
+            metrics.maybe_report()
+        if kind is None:
+            remaining -= 1
+            running -= 1
+            if 'memory' in rows:
+                budget.calibrate(rows['memory'])
+            budget.adjust(process_memory())
+            lookups += rows['lookups']
+            lookup_time += rows['lookup_time']
+            metrics.chunk_done(chunk_tx[chunk], chunk_bytes[chunk], rows)
+            progress.update(chunk_tx[chunk])
+            if OUTPUT == "sharded" and not PRUNE and not rows.get('failed'):
+                # The shards of the chunk are complete, so it is recorded without waiting for the others
+                checkpoint(chunks=journal['chunks'] + [chunk])
+        elif kind == SPENT:
+            for key in rows:
+                batch.delete(key)
+        else:
+            csv_writers[kind].writerows(rows)
+            metrics.add_stage('write', time.perf_counter() - writing)
+    # Raises the exception of a failed chunk
+    for r in result:
+        r.get()
+    run_stats['lookups'] += lookups
+    run_stats['lookup_time'] += lookup_time
+    # Report lookup throughput of the window, summed over all workers
+    if lookup_time > 0:
+        progress.write("Resolved " + str(lookups) + " outputs at " + str(round(lookups / lookup_time)) +
+                       " lookups/s per worker.")
+    # The window is recorded before its spent outputs are deleted. If the run is interrupted in between, the window
+    # is not repeated and the database merely keeps a few spent outputs. The other way round, a repeated window
+    # could not resolve the outputs it already deleted.
+    recorded = set(journal['chunks'])
+    checkpoint(chunks=journal['chunks'] + [c[0] for c in w if c[0] not in recorded],
+               db_height=max(c[1] for c in w) if PRUNE else journal['db_height'])
+    if PRUNE:
+        db.write(batch)
+pool.close()
+pool.join()
+progress.close()
+metrics.close()
+end_stage('csv')
+
+if ENGINE == "join":
+    print("Joining inputs with the outputs they spend.")
+    joined, unresolved = join_runs(RUN_PATH, starts, sends_file_w, transaction_file_w)
+    print("Joined " + str(joined) + " inputs, " + str(unresolved) + " inputs could not be resolved.")
+
+if INTERN:
+    # Write rows still buffered by the interning writers
+    receives_file_w.flush()
+    sends_file_w.flush()
+
+
+
+def write_addresses(rows):
+    """
+    Writes rows to the address file. With --intern, the ID of the address is put in front.
+
+    :param rows:    list, the rows, each starting with the address
+    """
+    if INTERN:
+        ids = address_book.intern(r[0] for r in rows)[0]
+        rows = [[ids[r[0]]] + r for r in rows]
+    address_file_w.writerows(rows)
+
+
+if ADDR_STATS:
+    # Every address is written once, together with its aggregates over all chunks
+    print("Merging address aggregates.")
+    address_rows = []
+    for row in merge_address_stats(RUN_PATH, starts):
+        address_rows.append(row)
+        if len(address_rows) >= RECORD_BATCH:
+            write_addresses(address_rows)
+            address_rows = []
+    write_addresses(address_rows)
 
 # Close file handles
-address_file.close()
-blocks_file.close()
-transaction_file.close()
-before_file.close()
-belongs_file.close()
-receives_file.close()
-sends_file.close()
+for f in output_handles:
+    f.close()
+if FORMAT == "parquet":
+    for w in csv_writers:
+        w.close()
+
+# List the files of every output in height order, so the import does not have to know about shards
+if OUTPUT == "sharded":
+    manifest_files = {}
+    for name in CSV_FILES:
+        paths = [output_path(name)] + [shard_path(SHARD_PATH, name, start, end, EXTENSION)
+                                        for start, end in chunks]
+        manifest_files[name] = [os.path.relpath(p, BASE_PATH) for p in paths
+                                if os.path.exists(p) and os.path.getsize(p) > 0]
+else:
+    manifest_files = {name: [name + "." + EXTENSION] for name in CSV_FILES}
+write_manifest(BASE_PATH, OUTPUT, manifest_files, INTERN, ADDR_STATS, FORMAT, COMPRESS)
+
+if FORMAT == "csv":
+    # Files are closed, so the offsets are taken from their sizes
+    journal['offsets'] = {name: os.path.getsize(output_path(name)) for name in CSV_FILES}
+journal['complete'] = True
+write_journal(BASE_PATH, journal)
+
+if ENGINE == "join" or ADDR_STATS:
+    # Remove chunk runs and intermediate runs of the merge. Only done once the run has been recorded as complete, as
+    # resuming an interrupted merge needs them.
+    for run in glob.glob(os.path.join(RUN_PATH, '*.run')):
+        os.remove(run)
+end_stage('finish')
+
+if STATS_FILE:
+    run_stats['blocks'] = min(END_BLOCK, len(block_index))
+    run_stats['transactions'] = block_index.tx_count(0, END_BLOCK)
+    run_stats['worker_stages'] = dict(metrics.stages)
+    with open(STATS_FILE, 'w') as f:
+        json.dump(run_stats, f, indent=2)
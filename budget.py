@@ -0,0 +1,180 @@
+"""
+Memory budget of a parser run.
+
+The memory given with --mem (or, by default, the available memory less a reserve) is split between the worker
+processes, the rows in flight between workers and writer, the memtables and block cache of the writer's RocksDB and the
+block caches of the workers' read-only handles. The split starts from an estimate of the memory of a worker, which is
+replaced by the memory the workers report after their first chunk. The memory of all processes is watched while the
+run goes on: if it approaches the budget, fewer chunks are run at once until it has dropped again.
+
+Memory is measured as private memory, i.e. the RSS less file-backed and shared pages. Workers keep blk files
+memory-mapped, whose pages count towards the RSS, but are page cache the kernel reclaims whenever it needs memory.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import psutil
+
+MB = 1024 ** 2
+# Memory left to the operating system and the page cache when no budget is given
+RESERVE = 4 * 1024 ** 3
+# Estimated private memory of a worker process without its block cache, until the first chunks have been measured
+WORKER_MEMORY = 768 * MB
+# Estimated size of a row in flight, pickled
+ROW_BYTES = 200
+# Share of the budget the rows in flight may take up
+QUEUE_SHARE = 0.05
+# Number of memtables of the writer
+WRITE_BUFFERS = 4
+# Fewer chunks are run at once above HIGH of the budget and more again below LOW
+HIGH = 0.9
+LOW = 0.75
+
+
+def memory_total(mem):
+    """
+    Returns the memory budget of the run
+
+    :param mem: int, the memory (in MB) given by the user, 0 or less for the default
+    :return:    int, the budget in bytes. The available memory less RESERVE unless the user gave a smaller budget.
+    """
+    available = psutil.virtual_memory().available
+    if 0 < mem * MB <= available:
+        return mem * MB
+    return max(available - RESERVE, available // 2)
+
+
+def private_memory(process=None):
+    """
+    Returns the private memory of a process, i.e. its RSS without file-backed and shared pages
+
+    :param process: psutil.Process, the process. None for this process.
+    :return:        int, the private memory in bytes
+    """
+    info = (process or psutil.Process()).memory_info()
+    # Only Linux reports shared pages, elsewhere the whole RSS is counted
+    return info.rss - getattr(info, 'shared', 0)
+
+
+def process_memory():
+    """
+    Returns the private memory of this process and all its child processes
+
+    :return:    int, the private memory in bytes
+    """
+    process = psutil.Process()
+    memory = private_memory(process)
+    for child in process.children(recursive=True):
+        try:
+            memory += private_memory(child)
+        except psutil.Error:
+            # The child has exited in the meantime
+            pass
+    return memory
+
+
+class MemoryBudget:
+    """
+    Splits a memory and core budget between worker processes, rows in flight and RocksDB and adjusts the number of
+    chunks run at once to the memory measured while running
+    """
+
+    def __init__(self, total, cores, batch_rows=0, worker_memory=WORKER_MEMORY):
+        """
+        :param total:       int, the memory budget in bytes
+        :param cores:       int, the number of cores that may be used by worker processes, 0 to run in a single process
+        :param batch_rows:  int, the number of rows a worker sends to the writer at once
+        :param worker_memory:   int, the estimated private memory of a worker process in bytes
+        """
+        self.total = total
+        self.cores = cores
+        self.batch_rows = batch_rows
+        self.plan(worker_memory)
+        # Number of chunks that may run at once, never more than there are workers
+        self.active = self.workers
+        # Number of chunks measured by calibrate
+        self.measured = 0
+
+    def _fit_workers(self):
+        # Workers take up at most half of the budget left by the rows in flight, so their block caches do not starve
+        usable = self.total - self.queue_depth * max(self.batch_rows, 1) * ROW_BYTES
+        return int(min(max(usable // 2 // self.worker_memory, 1), self.cores))
+
+    def plan(self, worker_memory):
+        """
+        Splits the budget for a given memory per worker. Sets workers, queue_depth, write_buffer_size, block_cache (of
+        the writer), worker_cache (of every worker) and output_cache (of the single-threaded exporter).
+
+        :param worker_memory:   int, the private memory of a worker process without its block cache in bytes
+        """
+        self.worker_memory = worker_memory
+        usable = self.total
+        if self.cores > 0:
+            # Rows in flight only take up a small share, a deeper queue does not make the writer any faster
+            batch_bytes = max(self.batch_rows, 1) * ROW_BYTES
+            self.queue_depth = int(min(max(usable * QUEUE_SHARE // batch_bytes, 4), 256))
+            usable -= self.queue_depth * batch_bytes
+            self.workers = self._fit_workers()
+            usable -= self.workers * worker_memory
+        else:
+            self.queue_depth = 0
+            self.workers = 0
+        usable = max(usable, 64 * MB)
+        if self.workers > 0:
+            # The writer only writes, lookups go through the handles of the workers
+            self.write_buffer_size = int(usable * 0.2 / WRITE_BUFFERS)
+            self.block_cache = int(usable * 0.05)
+            self.worker_cache = int(usable * 0.75 / self.workers)
+            self.output_cache = 0
+        else:
+            # Recently created outputs answer most lookups, the block cache the rest
+            self.write_buffer_size = int(usable * 0.2 / WRITE_BUFFERS)
+            self.block_cache = int(usable * 0.4)
+            self.worker_cache = 0
+            self.output_cache = int(usable * 0.4)
+
+    def calibrate(self, worker_memory):
+        """
+        Replaces the estimated memory of a worker by a measured one during calibration, i.e. for the first chunk of
+        every worker. If workers need more memory than estimated, fewer chunks are run at once. The number of worker
+        processes, the queue depth and the caches have been set up already and stay the same, so only the number of
+        chunks run at once is lowered. It stays below the number of workers, which adjust may still go up to.
+
+        :param worker_memory:   int, the private memory of a worker process without its block cache measured after its
+                                first chunk in bytes
+        """
+        if self.measured >= self.workers:
+            return
+        self.measured += 1
+        if worker_memory <= self.worker_memory:
+            return
+        self.worker_memory = worker_memory
+        self.active = min(self.active, self._fit_workers())
+
+    def adjust(self, memory):
+        """
+        Adjusts the number of chunks run at once to the memory of all processes of the run
+
+        :param memory:  int, the private memory of all processes in bytes, see process_memory
+        :return:        int, the number of chunks that may run at once
+        """
+        if memory > self.total * HIGH and self.active > 1:
+            self.active -= 1
+        elif memory < self.total * LOW and self.active < self.workers:
+            self.active += 1
+        return self.active
+
+    def describe(self):
+        """
+        Returns a summary of the split for the log
+
+        :return:    str, the summary
+        """
+        text = "Memory budget of " + str(round(self.total / 1024 ** 3, 1)) + " GB: "
+        if self.workers > 0:
+            text += str(self.workers) + " workers with a block cache of " + str(self.worker_cache // MB) + \
+                " MB each, " + str(self.queue_depth) + " row batches in flight, "
+        else:
+            text += str(self.output_cache // MB) + " MB for recently created outputs, "
+        return text + str(WRITE_BUFFERS) + " memtables of " + str(self.write_buffer_size // MB) + \
+            " MB and a block cache of " + str(self.block_cache // MB) + " MB for RocksDB."
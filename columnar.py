@@ -0,0 +1,152 @@
+"""
+Parquet output of the parallel parser.
+
+Every output is written as typed, compressed Parquet instead of csv: values are int64 satoshis, block times are
+timestamps and transaction dates are dates. Like csv shards, every worker writes one file per output and chunk of
+blocks, so the files partition each output by block height and engines like Spark or DuckDB can skip the ones they do
+not need. Relationship types are left out, as they are implied by the output.
+
+Requires pyarrow, which is only imported when Parquet output is selected.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from sinks import CSV_FILES, ShardSink, shard_path
+
+# Compression codec of all files
+COMPRESSION = 'zstd'
+# Number of rows collected before they are written as row group
+ROW_GROUP_SIZE = 100000
+
+# Block times are stored in UTC
+_TIMESTAMP = pa.timestamp('s', tz='UTC')
+
+# Columns of each output in the order of the csv columns
+_SCHEMAS = {
+    'addresses': pa.schema([('address', pa.string())]),
+    'blocks': pa.schema([('hash', pa.string()), ('height', pa.int64()), ('mediantime', _TIMESTAMP)]),
+    'transactions': pa.schema([('txid', pa.string()), ('date', pa.date32()), ('inDegree', pa.int64()),
+                               ('outDegree', pa.int64()), ('inSum', pa.int64()), ('outSum', pa.int64())]),
+    'before-rel': pa.schema([('previous_hash', pa.string()), ('hash', pa.string())]),
+    'belongs-rel': pa.schema([('txid', pa.string()), ('block_hash', pa.string())]),
+    'receives-rel': pa.schema([('txid', pa.string()), ('value', pa.int64()), ('output_nr', pa.int64()),
+                               ('address', pa.string())]),
+    'sends-rel': pa.schema([('address', pa.string()), ('value', pa.int64()), ('txid', pa.string())]),
+}
+# Aggregates appended to the address columns with --addrstats (see addrstats.py). Addresses that never appear in a
+# relationship have no first and last block.
+_ADDRESS_STATS = [('inDegree', pa.int64()), ('outDegree', pa.int64()), ('received', pa.int64()), ('sent', pa.int64()),
+                  ('firstSeen', pa.int64()), ('lastSeen', pa.int64())]
+
+
+def schema(name, address_stats=False):
+    """
+    Returns the Parquet schema of an output
+
+    :param name:            str, the name of the output (one of CSV_FILES)
+    :param address_stats:   bool, whether the address file holds the aggregates of every address
+    :return:                pyarrow.Schema, the schema
+    """
+    if name == 'addresses' and address_stats:
+        return pa.schema(list(_SCHEMAS[name]) + [pa.field(n, t) for n, t in _ADDRESS_STATS])
+    return _SCHEMAS[name]
+
+
+def _column(values, field):
+    # Times and dates arrive as the strings written to the csv files
+    if field.type == _TIMESTAMP:
+        return pc.strptime(pa.array(values, pa.string()), format='%Y-%m-%dT%H:%M', unit='s').cast(_TIMESTAMP)
+    if field.type == pa.date32():
+        return pc.strptime(pa.array(values, pa.string()), format='%Y-%m-%d', unit='s').cast(pa.date32())
+    return pa.array(values, field.type)
+
+
+class ParquetWriter:
+    """
+    Writes rows to a Parquet file, like csv.writer does to a csv file. Columns beyond those of the schema, i.e. the
+    relationship type, are dropped.
+
+    The file is written under a temporary name and renamed once it is closed. A file without any rows is not created.
+    """
+
+    def __init__(self, path, file_schema):
+        """
+        :param path:        str, the path of the Parquet file
+        :param file_schema: pyarrow.Schema, the schema of the file
+        """
+        self.path = path
+        self.schema = file_schema
+        self._rows = []
+        self._writer = None
+
+    def writerow(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= ROW_GROUP_SIZE:
+            self._write()
+
+    def writerows(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= ROW_GROUP_SIZE:
+            self._write()
+
+    def _write(self):
+        if not self._rows:
+            return
+        columns = [_column(values, field) for values, field in zip(zip(*self._rows), self.schema)]
+        self._rows = []
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path + ".tmp", self.schema, compression=COMPRESSION)
+        self._writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        """
+        Writes the remaining rows and renames the file into place
+        """
+        self._write()
+        if self._writer is not None:
+            self._writer.close()
+            os.replace(self.path + ".tmp", self.path)
+            self._writer = None
+
+    def abort(self):
+        """
+        Removes the temporary file. Rows that have not been written yet are dropped.
+        """
+        self._rows = []
+        if self._writer is not None:
+            self._writer.close()
+            os.remove(self.path + ".tmp")
+            self._writer = None
+
+
+class ParquetSink(ShardSink):
+    """
+    Writes the rows of a chunk to Parquet files of its own, one per output. See ShardSink.
+    """
+
+    def __init__(self, queue, chunk, batch_size, shard_dir, end, skip=()):
+        """
+        :param queue:       multiprocessing.Queue, the queue read by the writer
+        :param chunk:       int, the block height the chunk starts at
+        :param batch_size:  int, the number of rows passed to the Parquet writers at once
+        :param shard_dir:   str, the directory to store the files in
+        :param end:         int, the block height the chunk stops at (exclusive)
+        :param skip:        tuple, record kinds whose rows are dropped instead of written
+        """
+        super().__init__(queue, chunk, batch_size, shard_dir, end, skip)
+        self.paths = [shard_path(shard_dir, name, chunk, end, "parquet") for name in CSV_FILES]
+
+    def _open(self, kind):
+        return ParquetWriter(self.paths[kind], schema(CSV_FILES[kind]))
+
+    def _finish(self, kind):
+        self.writers[kind].close()
+
+    def _discard(self, kind):
+        self.writers[kind].abort()
@@ -0,0 +1,62 @@
+"""
+Cypher statements that apply an incremental export to an existing Neo4j database.
+
+neo4j-admin import only works on an empty database. The csv files of an incremental export are therefore converted
+into batches of UNWIND statements, which can be run with cypher-shell. Nodes and relationships are merged or replaced,
+so running a file twice does not create duplicates.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import csv
+import json
+import os
+
+# Number of rows per statement
+BATCH_SIZE = 1000
+
+# Statement per csv file. r is a row of the file, all values are strings.
+_STATEMENTS = (
+    ('addresses', "MERGE (:Address {address: r[0]})"),
+    ('blocks', "MERGE (b:Block {hash: r[0]}) SET b.height = toInteger(r[1]), b.mediantime = datetime(r[2] + 'Z')"),
+    ('transactions', "MERGE (t:Transaction {txid: r[0]}) SET t.date = date(r[1]), t.inDegree = toInteger(r[2]), "
+                     "t.outDegree = toInteger(r[3]), t.inSum = toInteger(r[4]), t.outSum = toInteger(r[5])"),
+    ('before-rel', "MATCH (a:Block {hash: r[0]}), (b:Block {hash: r[1]}) MERGE (a)-[:PRECEDES]->(b)"),
+    ('belongs-rel', "MATCH (t:Transaction {txid: r[0]}), (b:Block {hash: r[1]}) MERGE (t)-[:BELONGS_TO]->(b)"),
+    ('receives-rel', "MATCH (t:Transaction {txid: r[0]}) MERGE (a:Address {address: r[3]}) "
+                     "MERGE (t)-[x:RECEIVES {output_nr: toInteger(r[2])}]->(a) SET x.value = toInteger(r[1])"),
+    # A transaction can spend several outputs of the same address, each of which is a relationship of its own. They
+    # cannot be told apart by MERGE, so the SENDS relationships of the transactions are replaced instead.
+    ('sends-rel', "MATCH (t:Transaction {txid: r[2]}) MERGE (a:Address {address: r[0]}) "
+                  "CREATE (a)-[:SENDS {value: toInteger(r[1])}]->(t)"),
+)
+_CLEAR_SENDS = "MATCH (:Address)-[x:SENDS]->(:Transaction {txid: r}) DELETE x"
+
+# Removes the blocks of a reorganization together with their transactions and all relationships of both. Addresses
+# are kept, as they may be used by other transactions.
+_ROLLBACK = "MATCH (b:Block) WHERE b.hash IN {hashes} OPTIONAL MATCH (t:Transaction)-[:BELONGS_TO]->(b) " \
+            "DETACH DELETE t, b;\n"
+
+
+def _write_batches(f, statement, rows):
+    for i in range(0, len(rows), BATCH_SIZE):
+        f.write("UNWIND " + json.dumps(rows[i:i + BATCH_SIZE]) + " AS r " + statement + ";\n")
+
+
+def write_delta_cypher(csv_dir, path, removed_blocks=()):
+    """
+    Writes the statements that apply the csv files of an incremental export
+
+    :param csv_dir:         str, the directory of the csv files
+    :param path:            str, the file to write the statements to
+    :param removed_blocks:  list, hashes of blocks removed by a reorganization. They are deleted first.
+    """
+    with open(path, 'w') as f:
+        if removed_blocks:
+            f.write(_ROLLBACK.format(hashes=json.dumps(list(removed_blocks))))
+        for name, statement in _STATEMENTS:
+            with open(os.path.join(csv_dir, name + ".csv")) as data:
+                rows = list(csv.reader(data))
+            if name == 'sends-rel':
+                _write_batches(f, _CLEAR_SENDS, sorted({row[2] for row in rows}))
+            _write_batches(f, statement, rows)
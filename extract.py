@@ -0,0 +1,397 @@
+#!/usr/local/bin/python3
+
+"""
+Targeted extraction of the transactions around a set of addresses or transactions.
+
+Exporting the entire chain takes days. To investigate a few thousand addresses, the blocks are indexed once with
+`python3 extract.py index --endblock <height>`, which builds the secondary indexes of txindex.py in an index database.
+`python3 extract.py extract --addresses <file> --hops 2 --outdir <dir>` then exports only the transactions reachable
+from the addresses (one per line) in the same csv format as the exporters:
+
+* Hop 1 holds every transaction the addresses received coins in (postings) or sent coins in (spends of the outputs
+  they received).
+* Every further hop adds the transactions of all addresses that take part in the transactions of the previous hop.
+
+Seed transactions (--txids) are part of hop 1. Their addresses lead on to the next hop. Only the blocks holding
+extracted transactions are read, the spent outputs are looked up in the transaction database (built without --prune).
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import argparse
+import collections
+import csv
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import rocksdb
+import tqdm
+
+from blkreader import iter_blocks, AddressEncoder
+from blockindex import load_index, BlockIndex
+from manifest import write_manifest
+from readahead import READAHEAD_BYTES
+from shardeddb import ShardedDB, shard_paths
+from sinks import CSV_FILES
+from txdb import UNKNOWN_ADDRESS, lookup_outputs, check_layout, LAYOUT_TRANSACTIONS
+from follow import REORG_DEPTH
+from txindex import block_entries, postings, spenders, tx_heights, indexed_height, indexed_hash, height_entry
+
+# Addresses are encoded block by block, with a cache of recent addresses per process
+encoder = None
+
+
+def index_chunk(block_index_path, block_path, start, end):
+    """
+    Returns the index entries of a chunk of blocks
+
+    :param block_index_path:    str, the block index file
+    :param block_path:          str, the path to the Bitcoin blocks
+    :param start:               int, the block height to start at
+    :param end:                 int, the block height to stop at (exclusive)
+    :return:                    tuple, the block height to stop at and the sorted index entries of the chunk
+    """
+    global encoder
+    if encoder is None:
+        encoder = AddressEncoder()
+    entries = []
+    for block in iter_blocks(block_index_path, block_path, start, end, encoder=encoder, readahead=READAHEAD_BYTES):
+        entries.extend(block_entries(block))
+    entries.sort()
+    return end, entries
+
+
+def check_indexed(index_db, block_index):
+    """
+    Makes sure that the last indexed block is still on the main chain. Blocks are only indexed once they are
+    REORG_DEPTH blocks deep, so it is only replaced by a deeper reorg.
+
+    :param index_db:    rocksdb.DB, the index database
+    :param block_index: BlockIndex, the block index
+    """
+    height = indexed_height(index_db)
+    block_hash = indexed_hash(index_db)
+    if block_hash is not None and (height > len(block_index) or block_index.location(height - 1)[4] != block_hash):
+        raise ValueError("Block " + str(height - 1) + " has been replaced by a reorg since it was indexed. Build the "
+                         "index again in a new --indexdb.")
+
+
+def build_index(index_db, block_index, block_index_path, block_path, end, cores, chunk_tx):
+    """
+    Indexes the blocks up to a height. Blocks indexed by an earlier run are skipped, blocks within REORG_DEPTH of the
+    tip are left to a later run, as a reorg may still replace them.
+
+    :param index_db:            rocksdb.DB, the index database
+    :param block_index:         BlockIndex, the block index
+    :param block_index_path:    str, the block index file
+    :param block_path:          str, the path to the Bitcoin blocks
+    :param end:                 int, the block height to stop at (exclusive)
+    :param cores:               int, the number of worker processes
+    :param chunk_tx:            int, the number of transactions per chunk of work
+    """
+    check_indexed(index_db, block_index)
+    if end > len(block_index) - REORG_DEPTH:
+        end = max(len(block_index) - REORG_DEPTH, 0)
+        print("Blocks within " + str(REORG_DEPTH) + " blocks of the tip may still be replaced by a reorg. Indexing "
+              "blocks up to " + str(end - 1) + " only.")
+    start = indexed_height(index_db)
+    chunks = [(max(s, start), e) for s, e in block_index.chunks(end, chunk_tx) if e > start]
+    if not chunks:
+        print("Blocks up to " + str(start) + " have already been indexed.")
+        return
+    print("Indexing blocks " + str(chunks[0][0]) + " to " + str(chunks[-1][1] - 1) + ".")
+    tasks = collections.deque((block_index_path, block_path, s, e) for s, e in chunks)
+    with multiprocessing.Pool(cores) as pool, tqdm.tqdm(total=len(chunks)) as progress:
+        # No more chunks are in flight than there are workers. The entries of finished chunks wait in this process until
+        # they are written, so they cannot pile up if writing is slower than parsing.
+        in_flight = collections.deque(pool.apply_async(index_chunk, tasks.popleft())
+                                      for _ in range(min(cores, len(tasks))))
+        while in_flight:
+            # Chunks are written in order of height, so the indexed height only grows and an interrupted run can be
+            # continued from it
+            chunk_end, entries = in_flight.popleft().get()
+            if tasks:
+                # A worker is idle, it parses the next chunk while this one is written
+                in_flight.append(pool.apply_async(index_chunk, tasks.popleft()))
+            batch = rocksdb.WriteBatch()
+            for key, value in entries:
+                batch.put(key, value)
+            batch.put(*height_entry(chunk_end, block_index.location(chunk_end - 1)[4]))
+            index_db.write(batch)
+            progress.update()
+
+
+class Extraction:
+    """
+    Writes the rows of extracted transactions to the csv files of an output directory. Blocks and addresses are
+    written once, however many of their transactions are extracted.
+    """
+
+    def __init__(self, base_path, block_index_path, block_path, txdb):
+        """
+        :param base_path:           str, the output directory
+        :param block_index_path:    str, the block index file
+        :param block_path:          str, the path to the Bitcoin blocks
+        :param txdb:                ShardedDB, the transaction database
+        """
+        self.block_index_path = block_index_path
+        self.block_path = block_path
+        self.txdb = txdb
+        self.files = [open(os.path.join(base_path, name + ".csv"), 'w') for name in CSV_FILES]
+        self.address_w, self.blocks_w, self.transaction_w, self.before_w, self.belongs_w, self.receives_w, \
+            self.sends_w = [csv.writer(f) for f in self.files]
+        self.encoder = AddressEncoder()
+        self.blocks = set()
+        self.addresses = set()
+        self.transactions = 0
+        self.unresolved = 0
+        # Add coinbase as "special" address, since it does not explicitly appear in any transaction
+        self._address('coinbase')
+
+    def _address(self, address):
+        if address not in self.addresses:
+            self.addresses.add(address)
+            self.address_w.writerow([address])
+
+    def write(self, selected):
+        """
+        Writes the rows of transactions
+
+        :param selected:    dict, the block height of every transaction to write
+        :return:            set, the addresses taking part in the transactions
+        """
+        by_height = {}
+        for txid, height in selected.items():
+            by_height.setdefault(height, set()).add(txid)
+        touched = set()
+        for height in tqdm.tqdm(sorted(by_height)):
+            block = next(iter_blocks(self.block_index_path, self.block_path, height, height + 1, encoder=self.encoder))
+            block_time = time.gmtime(block.timestamp)
+            block_date = time.strftime('%Y-%m-%d', block_time)
+            if height not in self.blocks:
+                self.blocks.add(height)
+                self.blocks_w.writerow([block.hash, height, time.strftime('%Y-%m-%dT%H:%M', block_time)])
+                self.before_w.writerow([block.prev_hash, block.hash, 'PRECEDES'])
+            transactions = [tx for tx in block.transactions if tx.txid in by_height[height]]
+            # Spent outputs of all extracted transactions of the block are looked up at once
+            resolved, _ = lookup_outputs(self.txdb, [p for tx in transactions if not tx.coinbase for p in tx.inputs])
+            for tx in transactions:
+                outSum = 0
+                for o, (val, addr) in enumerate(tx.outputs):
+                    outSum += val
+                    if addr != UNKNOWN_ADDRESS:
+                        self.receives_w.writerow([tx.txid, val, o, addr, 'RECEIVES'])
+                        self._address(addr)
+                        touched.add(addr)
+                if tx.coinbase:
+                    self.sends_w.writerow(["coinbase", outSum, tx.txid, 'SENDS'])
+                    inDegree = 1
+                    inSum = outSum
+                else:
+                    inDegree = len(tx.inputs)
+                    inSum = 0
+                    for prevout in tx.inputs:
+                        if prevout not in resolved:
+                            self.unresolved += 1
+                            continue
+                        in_value, in_address = resolved[prevout]
+                        self.sends_w.writerow([in_address, in_value, tx.txid, 'SENDS'])
+                        self._address(in_address)
+                        touched.add(in_address)
+                        inSum += in_value
+                self.transaction_w.writerow([tx.txid, block_date, inDegree, len(tx.outputs), inSum, outSum])
+                self.belongs_w.writerow([tx.txid, block.hash, 'BELONGS_TO'])
+                self.transactions += 1
+        touched.discard(UNKNOWN_ADDRESS)
+        return touched
+
+    def close(self):
+        self.encoder.close()
+        for f in self.files:
+            f.close()
+
+
+def extract(index_db, extraction, addresses, txids, hops, max_tx):
+    """
+    Extracts the transactions reachable from a set of addresses and transactions, hop by hop
+
+    :param index_db:    rocksdb.DB, the index database
+    :param extraction:  Extraction, writes the rows of the transactions
+    :param addresses:   set, the addresses to start from
+    :param txids:       set, the transactions to start from
+    :param hops:        int, the number of hops
+    :param max_tx:      int, the number of transactions after which no further hop is started, 0 for no limit
+    :return:            int, the number of hops done
+    """
+    selected = set()
+    visited = set()
+    frontier = set(addresses)
+    found = tx_heights(index_db, list(txids))
+    for txid in txids:
+        if txid not in found:
+            print("WARNING: Transaction " + txid + " has not been indexed.")
+    for hop in range(1, hops + 1):
+        for address in tqdm.tqdm(frontier - visited, desc="Hop " + str(hop)):
+            received = postings(index_db, address)
+            for height, txid, vout, _ in received:
+                found[txid] = height
+            found.update(spenders(index_db, [(txid, vout) for _, txid, vout, _ in received]).values())
+        visited |= frontier
+        new = {txid: height for txid, height in found.items() if txid not in selected}
+        print("Hop " + str(hop) + ": " + str(len(new)) + " new transactions.")
+        selected.update(new)
+        frontier = extraction.write(new)
+        found = {}
+        if not new or 0 < max_tx <= len(selected):
+            return hop
+    return hops
+
+
+def index_options(create=False):
+    """
+    Returns the options of the index database
+
+    :param create:  bool, whether the options are used to build the index
+    :return:        rocksdb.Options, the options
+    """
+    opts = rocksdb.Options()
+    opts.max_open_files = -1
+    # Point lookups of spends and transactions skip the SST files without the key. Reading them requires the same
+    # filter policy as writing.
+    opts.table_factory = rocksdb.BlockBasedTableFactory(filter_policy=rocksdb.BloomFilterPolicy(10))
+    if create:
+        opts.create_if_missing = True
+        opts.write_buffer_size = 256 * 1024 ** 2
+        opts.target_file_size_base = 128 * 1024 ** 2
+    return opts
+
+
+def txdb_options():
+    """
+    Returns the options of a read-only handle of a shard of the transaction database
+
+    :return:    rocksdb.Options, the options
+    """
+    opts = rocksdb.Options()
+    opts.max_open_files = -1
+    # Bloom filters are only used if the filter policy matches the one they were written with
+    opts.table_factory = rocksdb.BlockBasedTableFactory(filter_policy=rocksdb.BloomFilterPolicy(10))
+    return opts
+
+
+def read_list(path, values):
+    """
+    Reads a list of addresses or transaction ids, one per line
+
+    :param path:    str, the file, empty to read none
+    :param values:  list, further values given on the command line
+    :return:        set, the values
+    """
+    found = set(values or [])
+    if path:
+        with open(path) as f:
+            found.update(line.strip() for line in f if line.strip())
+    return found
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Builds secondary indexes and extracts the transactions around a set of "
+                                             "addresses or transactions")
+    commands = ap.add_subparsers(dest='command')
+    commands.required = True
+    index_ap = commands.add_parser('index', help="Index the blocks up to --endblock")
+    extract_ap = commands.add_parser('extract', help="Extract the transactions reachable from addresses or "
+                                                     "transactions")
+    for p in (index_ap, extract_ap):
+        p.add_argument("--btcdir", help="Installation path of Bitcoin Core", type=str, default="")
+        p.add_argument("--blockindex", help="File to store the block index in. Defaults to block_index.bin in current "
+                                            "working directory", type=str, default="")
+        p.add_argument("--indexdb", help="Directory of the index database. Defaults to tx_index in current working "
+                                         "directory", type=str, default="")
+    index_ap.add_argument("--endblock", help="Block to stop at. Blocks within " + str(REORG_DEPTH) +
+                                             " blocks of the tip are left out", type=int, required=True)
+    index_ap.add_argument("--cores", help="Number of cores the indexer is allowed to use", type=int, default=-1)
+    index_ap.add_argument("--chunktx", help="Number of transactions per chunk of work, defaults to 500000", type=int,
+                          default=500000)
+    extract_ap.add_argument("--addresses", help="File with the addresses to start from, one per line", type=str,
+                            default="")
+    extract_ap.add_argument("--address", help="Address to start from, can be given several times", type=str,
+                            action='append')
+    extract_ap.add_argument("--txids", help="File with the transactions to start from, one per line", type=str,
+                            default="")
+    extract_ap.add_argument("--txid", help="Transaction to start from, can be given several times", type=str,
+                            action='append')
+    extract_ap.add_argument("--hops", help="Number of hops from the addresses, defaults to 1 (their own transactions)",
+                            type=int, default=1)
+    extract_ap.add_argument("--maxtx", help="Do not start another hop once this many transactions have been "
+                                            "extracted, defaults to 1000000. 0 for no limit", type=int,
+                            default=1000000)
+    extract_ap.add_argument("--outdir", help="Directory to store the CSVs in", type=str, required=True)
+    extract_ap.add_argument("--dbdir", help="Directory of the transaction database (built without --prune). Defaults "
+                                            "to transaction_db in current working directory", type=str, default="")
+    extract_ap.add_argument("--dbshards", help="Number of shards of the transaction database, defaults to 1",
+                            type=int, default=1)
+    args = vars(ap.parse_args())
+
+    # Set Bitcoin path to system defaults unless specified otherwise.
+    if args['btcdir'] == "":
+        host_os = platform.system()
+        if host_os == "Linux":
+            BLOCK_PATH = os.path.expanduser("~/.bitcoin")
+        elif host_os == "Darwin":
+            BLOCK_PATH = os.path.expanduser("~/Library/Application Support/Bitcoin")
+        else:
+            sys.exit("ERROR: Could not determine the path to Bitcoin Core. Please specify it with --btcdir.")
+    else:
+        BLOCK_PATH = args['btcdir']
+    BLOCK_PATH = os.path.join(BLOCK_PATH, "blocks")
+    INDEX_PATH = os.path.join(BLOCK_PATH, "index")
+    BLOCK_INDEX_PATH = args['blockindex'] or os.path.join(os.getcwd(), "block_index.bin")
+    INDEX_DB_PATH = args['indexdb'] or os.path.join(os.getcwd(), "tx_index")
+
+    if args['command'] == 'index':
+        block_index = load_index(BLOCK_INDEX_PATH, INDEX_PATH, BLOCK_PATH, args['endblock'])
+        index_db = rocksdb.DB(INDEX_DB_PATH, index_options(create=True))
+        cores = args['cores'] if args['cores'] > 0 else max(multiprocessing.cpu_count() - 1, 1)
+        try:
+            build_index(index_db, block_index, BLOCK_INDEX_PATH, BLOCK_PATH, args['endblock'], cores,
+                        max(args['chunktx'], 1))
+        except ValueError as e:
+            sys.exit("ERROR: " + str(e))
+        print("Compacting index database.")
+        index_db.compact_range()
+        print("Done. Blocks up to " + str(indexed_height(index_db)) + " have been indexed.")
+        sys.exit(0)
+
+    addresses = read_list(args['addresses'], args['address'])
+    txids = read_list(args['txids'], args['txid'])
+    if not addresses and not txids:
+        sys.exit("ERROR: Give the addresses or transactions to start from with --addresses, --address, --txids or "
+                 "--txid.")
+    if not os.path.exists(INDEX_DB_PATH):
+        sys.exit("ERROR: No index database in " + INDEX_DB_PATH + ". Build it with 'extract.py index' first.")
+    index_db = rocksdb.DB(INDEX_DB_PATH, index_options(), read_only=True)
+    print("Blocks up to " + str(indexed_height(index_db)) + " have been indexed.")
+
+    try:
+        check_indexed(index_db, BlockIndex(BLOCK_INDEX_PATH))
+        txdb = ShardedDB(shard_paths((args['dbdir'] or os.path.join(os.getcwd(), "transaction_db")).split(","),
+                                     max(args['dbshards'], 1)), txdb_options, read_only=True)
+        # The index holds encoded addresses, so the spent outputs looked up in the transaction database have to as well
+        check_layout(txdb, LAYOUT_TRANSACTIONS)
+    except ValueError as e:
+        sys.exit("ERROR: " + str(e))
+
+    BASE_PATH = args['outdir']
+    if not os.path.exists(BASE_PATH):
+        os.makedirs(BASE_PATH)
+    extraction = Extraction(BASE_PATH, BLOCK_INDEX_PATH, BLOCK_PATH, txdb)
+    done = extract(index_db, extraction, addresses, txids, max(args['hops'], 1), max(args['maxtx'], 0))
+    extraction.close()
+    write_manifest(BASE_PATH, "single", {name: [name + ".csv"] for name in CSV_FILES})
+    print("Extracted " + str(extraction.transactions) + " transactions in " + str(len(extraction.blocks)) +
+          " blocks and " + str(len(extraction.addresses)) + " addresses in " + str(done) + " hops to " + BASE_PATH +
+          ". " + str(extraction.unresolved) + " inputs could not be resolved.")
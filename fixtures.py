@@ -0,0 +1,329 @@
+#!/usr/local/bin/python3
+
+"""
+Generator of synthetic blockchains for tests and benchmarks.
+
+Writes a chain of valid-looking blocks in the format of Bitcoin Core: blk*.dat files in a blocks folder, a LevelDB
+block index in blocks/index (only if plyvel is installed) and the block index file of this parser, so the exporters
+can be run against it without a copy of the real blockchain. Run it like:
+`python3 fixtures.py --outdir <fixture dir> --blocks 5000 --txs 100`
+and point the exporters at it with `--btcdir <fixture dir> --blockindex <fixture dir>/block_index.bin`.
+
+Transactions spend random unspent outputs of earlier blocks and pay to a fixed pool of addresses, so addresses are
+reused like on the real chain. Signatures and proof of work are random bytes, nothing the exporters check. The same
+seed always yields the same chain. A summary of the chain is written to fixture.json.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import hashlib
+import json
+import os
+import random
+import struct
+
+from blockindex import write_index
+
+FIXTURE_FILE = 'fixture.json'
+# Magic bytes of the main network, written in front of every block
+NETWORK_MAGIC = bytes.fromhex('f9beb4d9')
+# Timestamp of the genesis block. Blocks follow every 10 minutes.
+GENESIS_TIME = 1231006505
+# Block reward in satoshis
+REWARD = 50 * 10 ** 8
+# Default share of every script type among the addresses
+SCRIPT_TYPES = {'p2pkh': 50, 'p2sh': 15, 'p2wpkh': 20, 'p2wsh': 5, 'p2tr': 5, 'p2pk': 3, 'multisig': 1,
+                'nonstandard': 1}
+
+# Bitcoin Core block status: valid up to scripts and stored in a blk file
+_BLOCK_STATUS = 5 | 8
+# Client version stored with every entry of the LevelDB index
+_CLIENT_VERSION = 250000
+_SEQUENCE = b'\xff\xff\xff\xff'
+
+
+def _sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def _compact_size(n):
+    """
+    Encodes a length as variable length integer like in serialized transactions
+    """
+    if n < 0xfd:
+        return bytes([n])
+    if n <= 0xffff:
+        return b'\xfd' + struct.pack('<H', n)
+    if n <= 0xffffffff:
+        return b'\xfe' + struct.pack('<I', n)
+    return b'\xff' + struct.pack('<Q', n)
+
+
+def _core_varint(n):
+    """
+    Encodes an integer as VARINT of the Bitcoin Core databases (base 128, most significant group first)
+    """
+    groups = [n & 0x7f]
+    while n > 0x7f:
+        n = (n >> 7) - 1
+        groups.append((n & 0x7f) | 0x80)
+    return bytes(reversed(groups))
+
+
+def output_script(script_type, key):
+    """
+    Returns an output script paying to a key
+
+    :param script_type: str, the script type (one of SCRIPT_TYPES)
+    :param key:         bytes, 32 bytes of key material
+    :return:            bytes, the script
+    """
+    if script_type == 'p2pkh':
+        return b'\x76\xa9\x14' + key[:20] + b'\x88\xac'
+    if script_type == 'p2sh':
+        return b'\xa9\x14' + key[:20] + b'\x87'
+    if script_type == 'p2wpkh':
+        return b'\x00\x14' + key[:20]
+    if script_type == 'p2wsh':
+        return b'\x00\x20' + key
+    if script_type == 'p2tr':
+        return b'\x51\x20' + key
+    if script_type == 'p2pk':
+        return b'\x21\x02' + key + b'\xac'
+    if script_type == 'multisig':
+        # 1-of-2 bare multisig
+        return b'\x51\x21\x02' + key + b'\x21\x03' + key[::-1] + b'\x52\xae'
+    # Data carrier output, which has no address
+    return b'\x6a\x20' + key
+
+
+def serialize_transaction(inputs, outputs, witness=None):
+    """
+    Serializes a transaction
+
+    :param inputs:  list, (txid, output number, script) tuples of the spent outputs
+    :param outputs: list, (value, script) tuples
+    :param witness: list, the witness items of every input. None for transactions without witness.
+    :return:        tuple, the serialized transaction and its txid
+    """
+    body = _compact_size(len(inputs))
+    for txid, vout, script in inputs:
+        body += bytes.fromhex(txid)[::-1] + struct.pack('<I', vout) + _compact_size(len(script)) + script + _SEQUENCE
+    body += _compact_size(len(outputs))
+    for value, script in outputs:
+        body += struct.pack('<Q', value) + _compact_size(len(script)) + script
+    version = struct.pack('<I', 2 if witness else 1)
+    lock_time = b'\0' * 4
+    txid = _sha256d(version + body + lock_time)[::-1].hex()
+    if witness is None:
+        return version + body + lock_time, txid
+    items = b''
+    for stack in witness:
+        items += _compact_size(len(stack)) + b''.join(_compact_size(len(item)) + item for item in stack)
+    return version + b'\x00\x01' + body + items + lock_time, txid
+
+
+def _merkle_root(txids):
+    level = [bytes.fromhex(txid)[::-1] for txid in txids]
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [_sha256d(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0]
+
+
+class ChainGenerator:
+    """
+    Generates the blocks of a synthetic chain one after another
+    """
+
+    def __init__(self, txs=50, fanin=3, fanout=3, addresses=10000, script_types=None, segwit=0.3, profile='growing',
+                 blocks=1000, seed=0):
+        """
+        :param txs:             int, the average number of transactions per block besides the coinbase
+        :param fanin:           int, the maximum number of inputs of a transaction
+        :param fanout:          int, the maximum number of outputs of a transaction
+        :param addresses:       int, the number of addresses outputs are paid to
+        :param script_types:    dict, the share of every script type among the addresses
+        :param segwit:          float, the share of transactions serialized with witness
+        :param profile:         str, flat: the same number of transactions in every block, growing: blocks get fuller
+                                towards the tip, like on the real chain
+        :param blocks:          int, the number of blocks of the chain, used by the growing profile
+        :param seed:            int, the seed of the random generator
+        """
+        self.rng = random.Random(seed)
+        self.txs = txs
+        self.fanin = max(fanin, 1)
+        self.fanout = max(fanout, 1)
+        self.segwit = segwit
+        self.profile = profile
+        self.blocks = blocks
+        types = script_types or SCRIPT_TYPES
+        names = list(types)
+        chosen = self.rng.choices(names, weights=[types[n] for n in names], k=max(addresses, 1))
+        self.scripts = [output_script(t, hashlib.sha256(b'%d:%d' % (seed, i)).digest()) for i, t in enumerate(chosen)]
+        # Unspent outputs of earlier blocks: (txid, output number, value)
+        self.unspent = []
+        self.prev_hash = b'\0' * 32
+        self.height = 0
+        self.stats = {'blocks': 0, 'transactions': 0, 'inputs': 0, 'outputs': 0}
+
+    def _payouts(self, value):
+        n = self.rng.randint(1, self.fanout)
+        cuts = sorted(self.rng.randint(0, value) for _ in range(n - 1))
+        values = [b - a for a, b in zip([0] + cuts, cuts + [value])]
+        return [(v, self.rng.choice(self.scripts)) for v in values]
+
+    def _block_size(self):
+        if self.profile == 'flat':
+            return self.txs
+        # Grows linearly from empty blocks to twice the average at the tip
+        return self.rng.randint(0, max(2 * self.txs * self.height // max(self.blocks, 1), 0))
+
+    def _spend(self):
+        inputs = []
+        value = 0
+        for _ in range(min(self.rng.randint(1, self.fanin), len(self.unspent))):
+            # Swap with the last output, so removal is cheap
+            i = self.rng.randrange(len(self.unspent))
+            self.unspent[i], self.unspent[-1] = self.unspent[-1], self.unspent[i]
+            txid, vout, v = self.unspent.pop()
+            inputs.append((txid, vout))
+            value += v
+        return inputs, value
+
+    def next_block(self):
+        """
+        Generates the next block
+
+        :return:    tuple, the serialized block, its hash (as hex string) and its number of transactions
+        """
+        raw = []
+        txids = []
+        created = []
+        # The height in the coinbase script makes every coinbase txid unique (BIP 34)
+        coinbase = [('0' * 64, 0xffffffff, b'\x04' + struct.pack('<I', self.height) + self.rng.randbytes(8))]
+        outputs = self._payouts(REWARD)
+        tx, txid = serialize_transaction(coinbase, outputs)
+        raw.append(tx)
+        txids.append(txid)
+        created.extend((txid, o, v) for o, (v, _) in enumerate(outputs))
+        self.stats['outputs'] += len(outputs)
+
+        for _ in range(self._block_size()):
+            if not self.unspent:
+                break
+            inputs, value = self._spend()
+            outputs = self._payouts(value)
+            if self.rng.random() < self.segwit:
+                # Spent with signature and public key in the witness
+                tx, txid = serialize_transaction([(t, o, b'') for t, o in inputs], outputs,
+                                                 [[self.rng.randbytes(72), self.rng.randbytes(33)] for _ in inputs])
+            else:
+                script = b'\x48' + self.rng.randbytes(72) + b'\x21' + self.rng.randbytes(33)
+                tx, txid = serialize_transaction([(t, o, script) for t, o in inputs], outputs)
+            raw.append(tx)
+            txids.append(txid)
+            created.extend((txid, o, v) for o, (v, _) in enumerate(outputs))
+            self.stats['inputs'] += len(inputs)
+            self.stats['outputs'] += len(outputs)
+
+        header = struct.pack('<I', 0x20000000) + self.prev_hash + _merkle_root(txids) + \
+            struct.pack('<III', GENESIS_TIME + 600 * self.height, 0x1d00ffff, self.rng.getrandbits(32))
+        block_hash = _sha256d(header)
+        # Outputs can be spent from the next block on
+        self.unspent.extend(created)
+        self.prev_hash = block_hash
+        self.height += 1
+        self.stats['blocks'] += 1
+        self.stats['transactions'] += len(raw)
+        return header + _compact_size(len(raw)) + b''.join(raw), block_hash[::-1].hex(), len(raw)
+
+
+def _leveldb_entry(height, n_tx, file_number, offset, header):
+    # Serialized CDiskBlockIndex as read by blockchain_parser
+    return _core_varint(_CLIENT_VERSION) + _core_varint(height) + _core_varint(_BLOCK_STATUS) + \
+        _core_varint(n_tx) + _core_varint(file_number) + _core_varint(offset) + header
+
+
+def write_fixture(outdir, blocks, generator, file_size=128 * 1024 ** 2):
+    """
+    Writes a synthetic chain
+
+    :param outdir:      str, the directory to write the chain to. Blocks are written to its blocks folder.
+    :param blocks:      int, the number of blocks
+    :param generator:   ChainGenerator, generates the blocks
+    :param file_size:   int, the size at which a new blk file is started
+    :return:            dict, the summary of the chain, also written to fixture.json
+    """
+    block_path = os.path.join(outdir, "blocks")
+    os.makedirs(block_path, exist_ok=True)
+    try:
+        import plyvel
+        leveldb = plyvel.DB(os.path.join(block_path, "index"), create_if_missing=True, compression=None)
+    except ImportError:
+        print("plyvel is not installed. Only the block index file of the parser is written.")
+        leveldb = None
+
+    locations = []
+    file_number = 0
+    blk = open(os.path.join(block_path, "blk%05d.dat" % file_number), 'wb')
+    for height in range(blocks):
+        block, block_hash, n_tx = generator.next_block()
+        if blk.tell() > 0 and blk.tell() + len(block) + 8 > file_size:
+            blk.close()
+            file_number += 1
+            blk = open(os.path.join(block_path, "blk%05d.dat" % file_number), 'wb')
+        blk.write(NETWORK_MAGIC + struct.pack('<I', len(block)))
+        offset = blk.tell()
+        blk.write(block)
+        locations.append((file_number, offset, len(block), n_tx, block_hash))
+        if leveldb is not None:
+            leveldb.put(b'b' + bytes.fromhex(block_hash)[::-1],
+                        _leveldb_entry(height, n_tx, file_number, offset, block[:80]))
+    blk.close()
+    if leveldb is not None:
+        leveldb.close()
+    write_index(os.path.join(outdir, "block_index.bin"), locations)
+
+    summary = dict(generator.stats, files=file_number + 1,
+                   bytes=sum(size for _, _, size, _, _ in locations))
+    with open(os.path.join(outdir, FIXTURE_FILE), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+if __name__ == '__main__':
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Writes a synthetic blockchain in the format of Bitcoin Core")
+    ap.add_argument("--outdir", help="Directory to write the chain to", type=str, required=True)
+    ap.add_argument("--blocks", help="Number of blocks, defaults to 2000", type=int, default=2000)
+    ap.add_argument("--txs", help="Average number of transactions per block, defaults to 50", type=int, default=50)
+    ap.add_argument("--fanin", help="Maximum number of inputs per transaction, defaults to 3", type=int, default=3)
+    ap.add_argument("--fanout", help="Maximum number of outputs per transaction, defaults to 3", type=int, default=3)
+    ap.add_argument("--addresses", help="Number of distinct addresses, defaults to 10000", type=int, default=10000)
+    ap.add_argument("--scripts", help="Share of every script type, e.g. p2pkh=60,p2wpkh=40. Defaults to " +
+                                      ",".join(k + "=" + str(v) for k, v in SCRIPT_TYPES.items()), type=str, default="")
+    ap.add_argument("--segwit", help="Share of transactions with witness, defaults to 0.3", type=float, default=0.3)
+    ap.add_argument("--profile", help="flat: same number of transactions in every block, growing (default): blocks "
+                                      "get fuller towards the tip", type=str, choices=["flat", "growing"],
+                    default="growing")
+    ap.add_argument("--filesize", help="Size of the blk files in MB, defaults to 128", type=int, default=128)
+    ap.add_argument("--seed", help="Seed of the random generator, defaults to 0", type=int, default=0)
+    args = vars(ap.parse_args())
+
+    script_types = None
+    if args['scripts']:
+        script_types = {}
+        for part in args['scripts'].split(','):
+            name, share = part.split('=')
+            if name not in SCRIPT_TYPES:
+                ap.error("unknown script type " + name)
+            script_types[name] = float(share)
+
+    chain = ChainGenerator(args['txs'], args['fanin'], args['fanout'], args['addresses'], script_types,
+                           args['segwit'], args['profile'], args['blocks'], args['seed'])
+    summary = write_fixture(args['outdir'], args['blocks'], chain, args['filesize'] * 1024 ** 2)
+    print("Wrote " + str(summary['blocks']) + " blocks with " + str(summary['transactions']) + " transactions to " +
+          args['outdir'] + ".")
@@ -0,0 +1,212 @@
+"""
+Incremental export of the blocks added to the chain since the last run.
+
+The follow state is stored in the transaction database itself and updated in the same write as the outputs of every
+block, so it always matches the contents of the database. Besides the last exported height and the hashes of the most
+recent blocks, it records the directory the current delta is written to and the size of its csv files, so the delta
+of an interrupted run can be completed on the next run.
+
+For the most recent blocks, undo records are kept as well. They hold the previous value of every key a block changed,
+so the block can be rolled back when it is replaced by a reorganization of the chain.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import json
+import struct
+
+# Key of the follow state and prefix of the undo records. Cannot collide with txid (32 bytes) or outpoint (36 bytes)
+# keys.
+STATE_KEY = b'__follow__'
+UNDO_PREFIX = b'__undo__'
+# Number of blocks below the tip that can be rolled back. Deeper reorganizations require a full export.
+REORG_DEPTH = 100
+
+_HEIGHT = struct.Struct('>I')
+# Undo entry: length of the key, whether a previous value exists, length of the previous value
+_UNDO_ENTRY = struct.Struct('<HBI')
+
+
+def undo_key(height):
+    return UNDO_PREFIX + _HEIGHT.pack(height)
+
+
+def encode_undo(changes):
+    """
+    Serializes the undo record of a block
+
+    :param changes: list, a list of (key, previous value) tuples. The previous value is None if the key did not exist.
+    :return:        bytes, the serialized record
+    """
+    record = bytearray()
+    for key, previous in changes:
+        record += _UNDO_ENTRY.pack(len(key), previous is not None, len(previous or b''))
+        record += key
+        record += previous or b''
+    return bytes(record)
+
+
+def decode_undo(record):
+    """
+    Decodes the undo record of a block
+
+    :param record:  bytes, the serialized record
+    :return:        list, a list of (key, previous value) tuples
+    """
+    changes = []
+    pos = 0
+    while pos < len(record):
+        key_length, exists, value_length = _UNDO_ENTRY.unpack_from(record, pos)
+        pos += _UNDO_ENTRY.size
+        key = record[pos:pos + key_length]
+        pos += key_length
+        changes.append((key, record[pos:pos + value_length] if exists else None))
+        pos += value_length
+    return changes
+
+
+def new_state(start):
+    """
+    Creates the follow state of a database that has not been built in follow mode
+
+    :param start:   int, the first block height to export
+    :return:        dict, the follow state
+    """
+    # height: last exported block, hashes: hashes of the most recent blocks by height, removed: hashes of blocks rolled
+    # back but not yet deleted by a delta, delta: directory of the unfinished delta, offsets: size of its csv files
+    return {'height': start - 1, 'hashes': {}, 'removed': [], 'delta': None, 'offsets': {}}
+
+
+def load_state(db):
+    """
+    Reads the follow state of a transaction database
+
+    :param db:  ShardedDB, the transaction database
+    :return:    dict, the follow state or None if the database has not been built in follow mode
+    """
+    record = db.get(STATE_KEY)
+    if record is None:
+        return None
+    return json.loads(record.decode('utf-8'))
+
+
+def save_state(db, state):
+    """
+    Writes the follow state of a transaction database
+
+    :param db:      ShardedDB, the transaction database
+    :param state:   dict, the follow state
+    """
+    db.put(STATE_KEY, json.dumps(state).encode('utf-8'))
+
+
+class BlockBatch:
+    """
+    Collects the database changes of one block, so they are written together with the follow state. Changes can be
+    read back before they are committed, as a block may spend outputs it creates.
+    """
+
+    def __init__(self, db, state, undo):
+        """
+        :param db:      ShardedDB, the transaction database
+        :param state:   dict, the follow state, updated on commit
+        :param undo:    bool, whether to keep an undo record for this block
+        """
+        self.db = db
+        self.state = state
+        self.undo = undo
+        self.staged = {}
+        self.changes = []
+
+    def get(self, key):
+        if key in self.staged:
+            return self.staged[key]
+        return self.db.get(key)
+
+    def _record(self, key):
+        # Only the value before the first change of the block is needed to undo it
+        if self.undo and key not in self.staged:
+            self.changes.append((key, self.db.get(key)))
+
+    def put(self, key, value):
+        self._record(key)
+        self.staged[key] = value
+
+    def delete(self, key):
+        self._record(key)
+        self.staged[key] = None
+
+    def commit(self, height, block_hash):
+        """
+        Writes the changes of the block, its undo record and the new follow state at once
+
+        :param height:      int, the block height
+        :param block_hash:  str, the block hash
+        """
+        batch = self.db.batch()
+        for key, value in self.staged.items():
+            if value is None:
+                batch.delete(key)
+            else:
+                batch.put(key, value)
+        if self.undo:
+            batch.put(undo_key(height), encode_undo(self.changes))
+        if height >= REORG_DEPTH:
+            batch.delete(undo_key(height - REORG_DEPTH))
+
+        hashes = self.state['hashes']
+        hashes[str(height)] = block_hash
+        hashes.pop(str(height - REORG_DEPTH), None)
+        self.state['height'] = height
+        batch.put(STATE_KEY, json.dumps(self.state).encode('utf-8'))
+        self.db.write(batch)
+        self.staged = {}
+        self.changes = []
+
+
+def find_fork(state, block_index):
+    """
+    Finds the highest exported block that is still part of the main chain
+
+    :param state:       dict, the follow state
+    :param block_index: BlockIndex, the current block index
+    :return:            int, the height of the block
+    """
+    if not state['hashes']:
+        # Nothing has been exported yet
+        return state['height']
+    for height in range(state['height'], state['height'] - len(state['hashes']), -1):
+        if height < len(block_index) and block_index.location(height)[4] == state['hashes'].get(str(height)):
+            return height
+    raise ValueError("The chain has been reorganized more than " + str(len(state['hashes'])) +
+                     " blocks deep. A full export is required.")
+
+
+def rollback(db, state, height):
+    """
+    Undoes all blocks above a given height, newest first. The hashes of the removed blocks are added to the removed
+    blocks of the follow state.
+
+    :param db:      ShardedDB, the transaction database
+    :param state:   dict, the follow state, updated in place
+    :param height:  int, the height of the last block to keep
+    :return:        int, the number of removed blocks
+    """
+    removed = 0
+    for h in range(state['height'], height, -1):
+        record = db.get(undo_key(h))
+        if record is None:
+            raise ValueError("No undo record for block " + str(h) + ". A full export is required.")
+        batch = db.batch()
+        for key, previous in reversed(decode_undo(record)):
+            if previous is None:
+                batch.delete(key)
+            else:
+                batch.put(key, previous)
+        batch.delete(undo_key(h))
+        state['removed'].append(state['hashes'].pop(str(h)))
+        removed += 1
+        state['height'] = h - 1
+        batch.put(STATE_KEY, json.dumps(state).encode('utf-8'))
+        db.write(batch)
+    return removed
@@ -0,0 +1,105 @@
+"""
+Compressed csv output.
+
+neo4j-admin import reads gzip compressed csv files. GzipStream is a text file that compresses everything written to
+it on a thread pool, so compression runs next to parsing instead of in its way. Text is collected in blocks, and every
+block is compressed on its own and written as gzip member. A file of several members is a valid gzip file. As every
+flush ends a member, a file cut off at an offset reported after a flush can be appended to like a plain csv file.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import os
+
+# Number of characters compressed at once
+BLOCK_SIZE = 4 * 1024 ** 2
+# gzip compression level
+LEVEL = 6
+# Number of compression threads per process
+THREADS = 4
+
+_executor = None
+_executor_pid = None
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    # Threads do not survive fork, so every worker process gets a pool of its own
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = concurrent.futures.ThreadPoolExecutor(THREADS)
+        _executor_pid = os.getpid()
+    return _executor
+
+
+class GzipStream:
+    """
+    Text file that is written gzip compressed. Can be used with csv.writer.
+    """
+
+    def __init__(self, path, mode='w'):
+        """
+        :param path:    str, the path of the file
+        :param mode:    str, 'w' to create the file or 'a' to append to it
+        """
+        self.file = open(path, mode + 'b')
+        self._buffer = []
+        self._size = 0
+        # Members being compressed, in the order they have to be written
+        self._pending = collections.deque()
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= BLOCK_SIZE:
+            self._submit()
+        return len(text)
+
+    def _submit(self):
+        if self._buffer:
+            data = ''.join(self._buffer).encode('utf-8')
+            self._buffer = []
+            self._size = 0
+            self._pending.append(_get_executor().submit(gzip.compress, data, LEVEL))
+        # Finished members are written right away. Once too many members are in flight, the writer waits for the
+        # oldest one, which bounds the memory taken up by pending members.
+        while self._pending and (self._pending[0].done() or len(self._pending) > 2 * THREADS):
+            self.file.write(self._pending.popleft().result())
+
+    def flush(self):
+        """
+        Compresses and writes everything written so far
+        """
+        self._submit()
+        while self._pending:
+            self.file.write(self._pending.popleft().result())
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        """
+        Returns the size of the compressed file. Only includes what has been written before the last flush.
+        """
+        return self.file.tell()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def open_csv(path, mode='w', compress=False):
+    """
+    Opens a csv file for writing
+
+    :param path:        str, the path of the file
+    :param mode:        str, 'w' to create the file or 'a' to append to it
+    :param compress:    bool, whether to write the file gzip compressed
+    :return:            file, the opened file
+    """
+    if compress:
+        return GzipStream(path, mode)
+    return open(path, mode)
@@ -0,0 +1,64 @@
+"""
+Progress journal of a parser run.
+
+The journal (journal.json in the output directory) is rewritten at every checkpoint. It records the settings of the
+run, the chunks whose rows have been written completely, the size of every csv file written by the main process at
+that point and how far the transaction database has been built. A run that was interrupted can be continued from the
+last checkpoint: finished chunks are skipped and everything written to the csv files after the checkpoint is cut off.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import json
+import os
+
+JOURNAL_FILE = 'journal.json'
+JOURNAL_VERSION = 1
+
+
+def new_journal(config):
+    """
+    Creates the journal of a new run
+
+    :param config:  dict, the settings of the run that have to match when it is resumed
+    :return:        dict, the journal
+    """
+    return {'version': JOURNAL_VERSION, 'config': config, 'chunks': [], 'offsets': {}, 'db_height': 0,
+            'address_ids': 0, 'complete': False}
+
+
+def load_journal(base_path, config):
+    """
+    Reads the journal of an interrupted run
+
+    :param base_path:   str, the output directory
+    :param config:      dict, the settings of the current run
+    :return:            dict, the journal
+    """
+    path = os.path.join(base_path, JOURNAL_FILE)
+    if not os.path.exists(path):
+        raise ValueError("No journal found in " + base_path + ". There is no run to resume.")
+    with open(path) as f:
+        journal = json.load(f)
+    if journal['version'] != JOURNAL_VERSION:
+        raise ValueError("Unsupported journal version " + str(journal['version']))
+    for key, value in config.items():
+        if journal['config'].get(key) != value:
+            raise ValueError("The run in " + base_path + " was started with " + key + "=" +
+                             str(journal['config'].get(key)) + ", not " + str(value) + ". Use the same settings.")
+    return journal
+
+
+def write_journal(base_path, journal):
+    """
+    Writes the journal durably. The previous journal stays intact until the new one is complete.
+
+    :param base_path:   str, the output directory
+    :param journal:     dict, the journal
+    """
+    path = os.path.join(base_path, JOURNAL_FILE)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(journal, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
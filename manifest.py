@@ -0,0 +1,106 @@
+#!/usr/local/bin/python3
+
+"""
+Manifest of the csv files written by the parser.
+
+The manifest (manifest.json in the output directory) lists the files that make up each output, in order of block
+height. With sharded output, every output consists of one shard per chunk of blocks. Without a manifest, every output
+is a single file named after it.
+
+Run this file to print the files of an output, e.g. for neo4j-admin import:
+`python3 manifest.py <csv dir> transactions`
+or to check a property of the output (exit code 0 if it applies):
+`python3 manifest.py <csv dir> --check interned`
+
+Properties are interned (addresses are referenced by integer IDs), address_stats (the address file holds aggregates),
+unique_addresses (every address is written once, so no deduplication is needed), compressed (the csv files are gzip
+compressed) and parquet (the files are Parquet instead of csv and cannot be imported into Neo4j).
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import json
+import os
+
+from sinks import CSV_FILES
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+
+
+def write_manifest(base_path, mode, files, interned=False, address_stats=False, file_format='csv', compressed=False):
+    """
+    Writes the manifest of an output directory
+
+    :param base_path:   str, the output directory
+    :param mode:        str, the output mode (single or sharded)
+    :param files:       dict, maps each output name to the list of its files in height order. Paths are relative to
+                        the output directory.
+    :param interned:        bool, whether addresses are referenced by integer IDs
+    :param address_stats:   bool, whether the address file holds the aggregates of every address
+    :param file_format:     str, the format of the files (csv or parquet)
+    :param compressed:      bool, whether the csv files are gzip compressed
+    """
+    path = os.path.join(base_path, MANIFEST_FILE)
+    manifest = {'version': MANIFEST_VERSION, 'mode': mode, 'files': files, 'interned': interned,
+                'address_stats': address_stats, 'unique_addresses': interned or address_stats, 'format': file_format,
+                'parquet': file_format == 'parquet', 'compressed': compressed}
+    with open(path + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def _load(base_path):
+    path = os.path.join(base_path, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest['version'] != MANIFEST_VERSION:
+        raise ValueError("Unsupported manifest version " + str(manifest['version']))
+    return manifest
+
+
+def read_manifest(base_path):
+    """
+    Reads the manifest of an output directory
+
+    :param base_path:   str, the output directory
+    :return:            dict, maps each output name to the list of its files as absolute paths
+    """
+    manifest = _load(base_path)
+    if manifest is None:
+        return {name: [os.path.join(base_path, name + ".csv")] for name in CSV_FILES}
+    return {name: [os.path.join(base_path, p) for p in paths] for name, paths in manifest['files'].items()}
+
+
+def check(base_path, prop):
+    """
+    Checks a property of an output directory
+
+    :param base_path:   str, the output directory
+    :param prop:        str, the property (interned, address_stats, unique_addresses, compressed or parquet)
+    :return:            bool, True if the property applies
+    """
+    manifest = _load(base_path)
+    return manifest is not None and manifest.get(prop, False)
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    ap = argparse.ArgumentParser(description="Prints the files of an output listed in the manifest")
+    ap.add_argument("csvdir", help="Directory the CSVs are saved in", type=str)
+    ap.add_argument("output", help="Name of the output", type=str, choices=CSV_FILES, nargs="?")
+    ap.add_argument("--separator", help="String to put between file names, defaults to ','", type=str, default=",")
+    ap.add_argument("--check", help="Exit with code 0 if the property applies to the output, 1 otherwise", type=str,
+                    choices=["interned", "address_stats", "unique_addresses", "compressed",
+                             "parquet"])
+    args = vars(ap.parse_args())
+
+    if args['check'] is not None:
+        sys.exit(0 if check(args['csvdir'], args['check']) else 1)
+    if args['output'] is None:
+        ap.error("the name of an output is required")
+    print(args['separator'].join(read_manifest(args['csvdir'])[args['output']]))
@@ -0,0 +1,242 @@
+"""
+Progress and performance metrics of the parallel parser.
+
+Workers time the stages of every chunk (block read, transaction decode, address encoding, output lookup, building the
+rows and handing them on) with a StageTimer and report the totals together with properties of their RocksDB handle
+when the chunk is done. The main process adds the time it spends waiting for and writing rows, the RSS of every
+worker and an ETA weighted by the number of transactions of the chunks that are left, as early chunks are nearly
+empty. The metrics are written as Prometheus textfile, served over HTTP and logged as JSON lines.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import collections
+import http.server
+import json
+import os
+import re
+import threading
+import time
+
+import psutil
+
+# Numeric RocksDB properties reported by the workers
+ROCKSDB_PROPERTIES = ('rocksdb.block-cache-usage', 'rocksdb.estimate-num-keys', 'rocksdb.cur-size-all-mem-tables',
+                      'rocksdb.actual-delayed-write-rate', 'rocksdb.is-write-stopped',
+                      'rocksdb.num-running-compactions')
+# Tickers read from the statistics of RocksDB, if they are enabled
+ROCKSDB_TICKERS = ('rocksdb.block.cache.hit', 'rocksdb.block.cache.miss', 'rocksdb.bytes.read')
+
+_STALL = re.compile(r'Cumulative stall: \S+ H:M:S, ([\d.]+) percent')
+_TICKER = re.compile(r'(rocksdb\.[\w.]+) COUNT : (\d+)')
+
+
+class StageTimer:
+    """
+    Adds up the time spent in each stage of processing
+    """
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def timed(self, stage, function):
+        """
+        Wraps a function, so the time spent in its calls is added to a stage
+
+        :param stage:       str, the stage
+        :param function:    function, the function to wrap
+        :return:            function, the wrapped function
+        """
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - started
+        return wrapper
+
+
+def rocksdb_properties(db):
+    """
+    Reads the statistics of a RocksDB handle
+
+    :param db:  rocksdb.DB or ShardedDB, the database
+    :return:    dict, numeric properties, the share of time writes were stalled and, if statistics are enabled, block
+                cache hits and misses and bytes read
+    """
+    values = {}
+    for name in ROCKSDB_PROPERTIES:
+        value = db.get_property(name.encode('ascii'))
+        if value is not None and value.isdigit():
+            values[name] = int(value)
+    stats = db.get_property(b'rocksdb.stats')
+    if stats is not None:
+        match = _STALL.search(stats.decode('utf-8', 'replace'))
+        if match:
+            values['rocksdb.stall-percent'] = float(match.group(1))
+    tickers = db.get_property(b'rocksdb.options-statistics')
+    if tickers is not None:
+        for name, count in _TICKER.findall(tickers.decode('utf-8', 'replace')):
+            if name in ROCKSDB_TICKERS:
+                values[name] = int(count)
+    return values
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+class RunMetrics:
+    """
+    Collects the metrics of a run in the main process and reports them periodically
+    """
+
+    def __init__(self, total_tx, total_bytes, interval=30, textfile="", port=0, log=""):
+        """
+        :param total_tx:    int, the number of transactions to process
+        :param total_bytes: int, the size of the blocks to process
+        :param interval:    float, the number of seconds between two reports
+        :param textfile:    str, the Prometheus textfile to write, empty for none
+        :param port:        int, the port to serve the metrics on at 127.0.0.1:<port>/metrics, 0 for none
+        :param log:         str, the file to append JSON log lines to, empty for none
+        """
+        self.total_tx = total_tx
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.textfile = textfile
+        self.log = log
+        self.done_tx = 0
+        self.done_bytes = 0
+        self.chunks = 0
+        self.lookups = 0
+        self.stages = collections.defaultdict(float)
+        # Latest RocksDB statistics of every worker process
+        self.rocksdb = {}
+        self.started = time.time()
+        self.last_report = self.started
+        self._text = b''
+        self._server = None
+        if port:
+            self._serve(port)
+
+    def _serve(self, port):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.end_headers()
+                self.wfile.write(metrics._text)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def chunk_done(self, tx, size, stats):
+        """
+        Adds the statistics of a finished chunk
+
+        :param tx:      int, the number of transactions of the chunk
+        :param size:    int, the size of the blocks of the chunk
+        :param stats:   dict, the statistics reported by the worker
+        """
+        self.done_tx += tx
+        self.done_bytes += size
+        self.chunks += 1
+        self.lookups += stats['lookups']
+        for stage, seconds in stats.get('stages', {}).items():
+            self.stages[stage] += seconds
+        if stats.get('rocksdb'):
+            self.rocksdb[stats['pid']] = stats['rocksdb']
+
+    def add_stage(self, stage, seconds):
+        self.stages[stage] += seconds
+
+    def eta(self):
+        """
+        Returns the estimated number of seconds until all transactions are processed, or None if nothing has been
+        processed yet
+        """
+        if self.done_tx == 0:
+            return None
+        elapsed = time.time() - self.started
+        return elapsed * (self.total_tx - self.done_tx) / self.done_tx
+
+    def snapshot(self):
+        """
+        Returns the current metrics
+
+        :return:    dict, the metrics
+        """
+        workers = {}
+        try:
+            for child in psutil.Process().children(recursive=True):
+                workers[child.pid] = child.memory_info().rss
+        except psutil.Error:
+            pass
+        return {'time': time.time(), 'elapsed': time.time() - self.started, 'chunks': self.chunks,
+                'transactions': self.done_tx, 'transactions_total': self.total_tx, 'bytes': self.done_bytes,
+                'bytes_total': self.total_bytes, 'eta': self.eta(), 'lookups': self.lookups,
+                'stages': dict(self.stages), 'rss': psutil.Process().memory_info().rss, 'worker_rss': workers,
+                'rocksdb': self.rocksdb}
+
+    def _render(self, snapshot):
+        lines = ['btc_parser_transactions_done ' + str(snapshot['transactions']),
+                 'btc_parser_transactions_total ' + str(snapshot['transactions_total']),
+                 'btc_parser_bytes_done ' + str(snapshot['bytes']),
+                 'btc_parser_bytes_total ' + str(snapshot['bytes_total']),
+                 'btc_parser_chunks_done ' + str(snapshot['chunks']),
+                 'btc_parser_lookups_total ' + str(snapshot['lookups']),
+                 'btc_parser_elapsed_seconds ' + str(round(snapshot['elapsed'], 1)),
+                 'btc_parser_rss_bytes ' + str(snapshot['rss'])]
+        if snapshot['eta'] is not None:
+            lines.append('btc_parser_eta_seconds ' + str(round(snapshot['eta'], 1)))
+        for stage, seconds in sorted(snapshot['stages'].items()):
+            lines.append('btc_parser_stage_seconds_total{stage="' + _label(stage) + '"} ' + str(round(seconds, 3)))
+        for pid, rss in sorted(snapshot['worker_rss'].items()):
+            lines.append('btc_parser_worker_rss_bytes{pid="' + str(pid) + '"} ' + str(rss))
+        for pid, values in sorted(snapshot['rocksdb'].items()):
+            for name, value in sorted(values.items()):
+                lines.append('btc_parser_rocksdb{pid="' + str(pid) + '",property="' + _label(name) + '"} ' +
+                             str(value))
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def report(self):
+        """
+        Writes the current metrics to the textfile and the log and updates the metrics served over HTTP
+
+        :return:    dict, the reported metrics
+        """
+        snapshot = self.snapshot()
+        self._text = self._render(snapshot)
+        if self.textfile:
+            # Written under a temporary name, so the collector never reads a partial file
+            with open(self.textfile + ".tmp", 'wb') as f:
+                f.write(self._text)
+            os.replace(self.textfile + ".tmp", self.textfile)
+        if self.log:
+            with open(self.log, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
+        self.last_report = time.time()
+        return snapshot
+
+    def maybe_report(self):
+        """
+        Reports the metrics if the last report is older than the interval
+        """
+        if time.time() - self.last_report >= self.interval:
+            self.report()
+
+    def close(self):
+        self.report()
+        if self._server is not None:
+            self._server.shutdown()
@@ -0,0 +1,83 @@
+#!/usr/local/bin/python3
+
+"""
+Converts a transaction database created by older versions of the parser (hex txid keys, pickled output lists) into
+the binary record format.
+
+The converted database is written to a new directory, the source database is opened read-only and left untouched.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import argparse
+import os
+import pickle
+import sys
+
+import rocksdb
+import tqdm
+
+from shardeddb import ShardedDB
+from txdb import txid_key, encode_outputs, check_layout, LAYOUT_TRANSACTIONS
+
+# Parse command-line arguments
+ap = argparse.ArgumentParser()
+ap.add_argument("--src", help="Directory of the pickled transaction database", type=str, required=True)
+ap.add_argument("--dst", help="Directory to create the converted database in", type=str, required=True)
+ap.add_argument("--batch", help="Number of transactions per write batch, defaults to 100000", type=int,
+                default=100000)
+args = vars(ap.parse_args())
+
+if os.path.exists(args['dst']) and os.listdir(args['dst']):
+    sys.exit("ERROR: Destination " + args['dst'] + " is not empty.")
+
+src = rocksdb.DB(args['src'], rocksdb.Options(), read_only=True)
+
+
+def dst_options():
+    """
+    Returns the options of the converted database. Bulkload options, see btc_parallel.py.
+
+    :return:    rocksdb.Options, the options
+    """
+    opts = rocksdb.Options()
+    opts.create_if_missing = True
+    opts.max_open_files = -1
+    opts.write_buffer_size = 256 * 1024 ** 2
+    opts.max_write_buffer_number = 4
+    opts.target_file_size_base = 128 * 1024 ** 2
+    opts.disable_auto_compactions = True
+    opts.compression = rocksdb.CompressionType.no_compression
+    opts.table_factory = rocksdb.BlockBasedTableFactory(filter_policy=rocksdb.BloomFilterPolicy(10))
+    return opts
+
+
+# The converted database has a single shard and records its layout, so the parser refuses to use it for pruning. The
+# old database holds encoded addresses.
+dst = ShardedDB([args['dst']], dst_options)
+check_layout(dst, LAYOUT_TRANSACTIONS, create=True)
+
+total = int(src.get_property(b'rocksdb.estimate-num-keys') or 0)
+print("Converting approximately " + str(total) + " transactions.")
+
+it = src.iteritems()
+it.seek_to_first()
+batch = dst.batch()
+skipped = 0
+for key, value in tqdm.tqdm(it, total=total):
+    try:
+        # Old records are lists of [value, address, output number] in output order
+        outputs = pickle.loads(value)
+        batch.put(txid_key(key.decode('utf-8')), encode_outputs([(o[0], o[1]) for o in outputs]))
+    except Exception as e:
+        skipped += 1
+        print(e)
+        continue
+    if batch.count() >= args['batch']:
+        dst.write(batch)
+        batch = dst.batch()
+dst.write(batch)
+
+print("Compacting database.")
+dst.compact_range()
+print("Done. " + str(skipped) + " entries could not be converted.")
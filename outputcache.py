@@ -0,0 +1,103 @@
+"""
+Write-behind access to the transaction database for the single-threaded exporter.
+
+Writing every transaction and reading every spent output on its own makes the database the bottleneck of btc-to-csv.py.
+Most inputs spend outputs created in the last few thousand blocks, many of them in the same block. OutputCache collects
+new outputs and deletions and writes them in one WriteBatch every few blocks or once they take up too much memory.
+Written outputs stay in a cache of recently created outputs, which is bounded by size and evicts the least recently
+used outputs first, so most lookups are answered without touching RocksDB.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import collections
+
+# Number of blocks whose changes are written at once
+FLUSH_BLOCKS = 100
+# Estimated memory taken up by an entry besides key and value (dict entry, bytes objects)
+ENTRY_OVERHEAD = 150
+
+
+class OutputCache:
+    """
+    Database wrapper with the get, put and delete methods of rocksdb.DB. Changes that have not been written yet are
+    always answered from memory.
+    """
+
+    def __init__(self, db, cache_bytes, flush_blocks=FLUSH_BLOCKS):
+        """
+        :param db:              ShardedDB, the transaction database
+        :param cache_bytes:     int, the memory taken up by changes not written yet and recently created outputs.
+                                Changes are written early once they take up a quarter of it.
+        :param flush_blocks:    int, the number of blocks whose changes are written at once
+        """
+        self.db = db
+        self.cache_bytes = cache_bytes
+        self.flush_blocks = max(flush_blocks, 1)
+        # Changes not written yet, None for deleted keys
+        self.staged = {}
+        self.staged_bytes = 0
+        # Outputs already written, least recently used first
+        self.recent = collections.OrderedDict()
+        self.recent_bytes = 0
+        self.blocks = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.staged:
+            self.hits += 1
+            return self.staged[key]
+        value = self.recent.get(key)
+        if value is not None:
+            self.hits += 1
+            self.recent.move_to_end(key)
+            return value
+        self.misses += 1
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.staged[key] = value
+        self.staged_bytes += len(key) + len(value) + ENTRY_OVERHEAD
+
+    def delete(self, key):
+        # An output created and spent before the next write is never written, only the deletion is
+        self.staged[key] = None
+        self.staged_bytes += len(key) + ENTRY_OVERHEAD
+        value = self.recent.pop(key, None)
+        if value is not None:
+            self.recent_bytes -= len(key) + len(value) + ENTRY_OVERHEAD
+
+    def end_block(self):
+        """
+        Marks the end of a block. Writes the changes every flush_blocks blocks or if they have grown too large.
+        """
+        self.blocks += 1
+        if self.blocks >= self.flush_blocks or self.staged_bytes > self.cache_bytes // 4:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all changes and moves the outputs written into the cache of recently created outputs
+        """
+        if not self.staged:
+            return
+        batch = self.db.batch()
+        for key, value in self.staged.items():
+            if value is None:
+                batch.delete(key)
+            else:
+                batch.put(key, value)
+                # Duplicate transactions (BIP 30) replace the outputs of an earlier one
+                old = self.recent.pop(key, None)
+                if old is not None:
+                    self.recent_bytes -= len(key) + len(old) + ENTRY_OVERHEAD
+                self.recent[key] = value
+                self.recent_bytes += len(key) + len(value) + ENTRY_OVERHEAD
+        self.db.write(batch)
+        self.staged = {}
+        self.staged_bytes = 0
+        self.blocks = 0
+        while self.recent_bytes > self.cache_bytes and self.recent:
+            key, value = self.recent.popitem(last=False)
+            self.recent_bytes -= len(key) + len(value) + ENTRY_OVERHEAD
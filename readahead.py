@@ -0,0 +1,156 @@
+"""
+Read-ahead of blk files in a background thread.
+
+Memory-mapped blocks are read by page faults while they are decoded, so the parser waits for the disk and the disk
+waits for the parser. On a spinning disk, several workers faulting in pages of different blk files at once also make
+it seek back and forth. ReadAhead instead reads the blocks of a range of heights in spans of consecutive blocks, each
+with a single large sequential read, in a thread of its own while the parser decodes the blocks read before. The kernel
+is told to read the following span into the page cache in the meantime (posix_fadvise). Spans that have been read but
+not decoded yet wait in a bounded queue, which limits the memory taken up by read-ahead.
+
+Processes sharing one disk can pass a lock, so only one of them reads a span at a time and the disk reads every span
+sequentially instead of serving all processes in turns.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import os
+import queue
+import threading
+
+from blockindex import block_file
+
+# Largest span read at once. Blocks of a span are close to each other in the same blk file.
+SPAN_BYTES = 16 * 1024 ** 2
+# Memory taken up by spans read ahead per process
+READAHEAD_BYTES = 64 * 1024 ** 2
+# Seconds between two checks whether reading has been stopped while the queue is full
+_POLL = 0.1
+
+
+def spans(index, start, end, span_bytes=SPAN_BYTES):
+    """
+    Groups a range of blocks into spans of consecutive heights that can be read at once. Blocks are mostly stored in
+    order of height, but not strictly, so a span covers its blocks and everything in between. A span ends when the next
+    block is in another blk file or would make it larger than span_bytes.
+
+    :param index:       BlockIndex, the block index
+    :param start:       int, the block height to start at
+    :param end:         int, the block height to stop at (exclusive)
+    :param span_bytes:  int, the largest span to read at once. Larger blocks get a span of their own.
+    :return:            iterator, tuples of blk file number, offset, size and a list of (height, offset, size) tuples of
+                        its blocks
+    """
+    current = None
+    for height in range(start, min(end, len(index))):
+        file_number, offset, size, _, _ = index.location(height)
+        if current is not None and current[0] == file_number:
+            low = min(current[1], offset)
+            high = max(current[1] + current[2], offset + size)
+            if high - low <= span_bytes:
+                current = (file_number, low, high - low, current[3])
+                current[3].append((height, offset, size))
+                continue
+        if current is not None:
+            yield current
+        current = (file_number, offset, size, [(height, offset, size)])
+    if current is not None:
+        yield current
+
+
+def _advise(fd, offset, size, advice):
+    # posix_fadvise is not available on every platform and only a hint anyway
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, size, getattr(os, advice))
+
+
+def _read(fd, offset, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    pos = 0
+    while pos < size:
+        read = os.preadv(fd, [view[pos:]], offset + pos)
+        if read == 0:
+            raise EOFError("blk file ends within a block. Is the block index outdated?")
+        pos += read
+    return data
+
+
+class ReadAhead:
+    """
+    Reads the blocks of a range of heights ahead in a background thread. Iterating over it yields the height and
+    serialized block of every block in order of height.
+    """
+
+    def __init__(self, index, block_path, start, end, buffer_bytes=READAHEAD_BYTES, lock=None):
+        """
+        :param index:           BlockIndex, the block index
+        :param block_path:      str, the path to the Bitcoin blocks
+        :param start:           int, the block height to start at
+        :param end:             int, the block height to stop at (exclusive)
+        :param buffer_bytes:    int, the memory taken up by spans read ahead. At least two spans are read ahead.
+        :param lock:            multiprocessing.Lock, held while a span is read. None to read without waiting for
+                                other processes.
+        """
+        self.queue = queue.Queue(max(buffer_bytes // SPAN_BYTES, 2))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(index, block_path, start, end, lock), daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=_POLL)
+                return
+            except queue.Full:
+                continue
+
+    def _run(self, index, block_path, start, end, lock):
+        files = {}
+        try:
+            pending = spans(index, start, end)
+            span = next(pending, None)
+            while span is not None and not self.stopped.is_set():
+                following = next(pending, None)
+                needed = {span[0]} if following is None else {span[0], following[0]}
+                for file_number in needed:
+                    if file_number not in files:
+                        files[file_number] = os.open(block_file(block_path, file_number), os.O_RDONLY)
+                        # Doubles the read-ahead window of the kernel for the file
+                        _advise(files[file_number], 0, 0, 'POSIX_FADV_SEQUENTIAL')
+                if following is not None:
+                    # The kernel reads the next span into the page cache while this one is decoded
+                    _advise(files[following[0]], following[1], following[2], 'POSIX_FADV_WILLNEED')
+                if lock is not None:
+                    with lock:
+                        data = _read(files[span[0]], span[1], span[2])
+                else:
+                    data = _read(files[span[0]], span[1], span[2])
+                # Files that are not read any further are closed
+                for file_number in [f for f in files if f not in needed]:
+                    os.close(files.pop(file_number))
+                self._put((span, data))
+                span = following
+            self._put(None)
+        except Exception as e:
+            # Raised by the iterator, i.e. in the thread decoding the blocks
+            self._put(e)
+        finally:
+            for fd in files.values():
+                os.close(fd)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                (_, span_offset, _, blocks), data = item
+                view = memoryview(data)
+                for height, offset, size in blocks:
+                    yield height, view[offset - span_offset:offset - span_offset + size]
+        finally:
+            # Also stops reading if the blocks are not read to the end
+            self.stopped.set()
@@ -0,0 +1,245 @@
+"""
+Transaction database split into several RocksDB instances by txid prefix.
+
+A single RocksDB instance takes writes from one process only and keeps its files on one disk. The database can instead
+be split into shards, each a RocksDB instance of its own with its own memtables and block cache, which may be placed on
+different disks. Keys of the transactions and outpoints layouts start with the raw txid, which is uniformly
+distributed, so its first byte routes every key to a shard. Keys of the same transaction always end up in the same
+shard. All other keys (layout, follow state, undo records) are kept in the first shard.
+
+ShardedDB offers the methods of rocksdb.DB used by the parser. Requests that touch several shards (multi_get, write,
+ingest_external_file, compact_range) are sent to the shards in parallel by one thread per shard, as RocksDB does not
+hold the GIL while it reads or writes. A database with a single shard is an ordinary RocksDB in the given directory,
+so databases built by earlier versions can still be opened.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import concurrent.futures
+import os
+import struct
+
+import rocksdb
+
+from txdb import LAYOUT_KEY
+
+# Key under which the number of shards is recorded in the first shard. Cannot collide with txid (32 bytes) or outpoint
+# (36 bytes) keys.
+SHARDS_KEY = b'__shards__'
+# Keys of transactions and outpoints are at least as long as a raw txid
+_TXID_SIZE = 32
+# Most shards a database can be split into, one per value of the first key byte
+MAX_SHARDS = 256
+
+_COUNT = struct.Struct('<I')
+
+
+def shard_paths(directories, shards):
+    """
+    Returns the directory of every shard. Shards are spread over the given directories in turn.
+
+    :param directories: list, the directories the database may be placed in, e.g. one per disk
+    :param shards:      int, the number of shards
+    :return:            list, the directory of every shard
+    """
+    if shards == 1 and len(directories) == 1:
+        # A database with a single shard is stored like a database built by earlier versions
+        return list(directories)
+    return [os.path.join(directories[i % len(directories)], "shard-%03d" % i) for i in range(shards)]
+
+
+def shard_of(key, shards):
+    """
+    Returns the shard of a key
+
+    :param key:     bytes, the database key
+    :param shards:  int, the number of shards
+    :return:        int, the number of the shard
+    """
+    if len(key) < _TXID_SIZE:
+        return 0
+    return key[0] * shards // MAX_SHARDS
+
+
+def partition_count(shards, minimum):
+    """
+    Returns the number of key ranges to split the database into when it is built from SST files. It is a multiple of the
+    number of shards, so every key range belongs to exactly one shard.
+
+    :param shards:  int, the number of shards
+    :param minimum: int, the least number of key ranges
+    :return:        int, the number of key ranges
+    """
+    return max(-(-minimum // shards), 1) * shards
+
+
+class ShardedBatch:
+    """
+    Write batch of a sharded database with one rocksdb.WriteBatch per shard. Each of them is written atomically, the
+    batch as a whole only if the database has a single shard.
+    """
+
+    def __init__(self, shards):
+        self.batches = [rocksdb.WriteBatch() for _ in range(shards)]
+
+    def put(self, key, value):
+        self.batches[shard_of(key, len(self.batches))].put(key, value)
+
+    def delete(self, key):
+        self.batches[shard_of(key, len(self.batches))].delete(key)
+
+    def count(self):
+        return sum(b.count() for b in self.batches)
+
+
+class ShardedDB:
+    """
+    Transaction database made up of one or more RocksDB instances
+    """
+
+    def __init__(self, paths, options, read_only=False):
+        """
+        :param paths:       list, the directory of every shard, see shard_paths
+        :param options:     function, returns the rocksdb.Options of a shard. Called once per shard, as RocksDB options
+                            cannot be shared between instances.
+        :param read_only:   bool, whether to open the shards read-only
+        """
+        self.shards = len(paths)
+        if not 0 < self.shards <= MAX_SHARDS:
+            raise ValueError("A transaction database has between 1 and " + str(MAX_SHARDS) + " shards.")
+        # Opening a shard creates it, so a directory holding a database with a different number of shards is refused
+        # before. A database with a single shard has its files in the directory itself, one with several shards keeps
+        # them in subdirectories.
+        if self.shards > 1:
+            for directory in sorted(set(os.path.dirname(path) for path in paths)):
+                if os.path.exists(os.path.join(directory, "CURRENT")):
+                    raise ValueError(self._mismatch(directory, 1))
+        elif os.path.isdir(os.path.join(paths[0], "shard-000")) and \
+                not os.path.exists(os.path.join(paths[0], "CURRENT")):
+            raise ValueError(self._mismatch(paths[0], None))
+        if not read_only:
+            for path in paths:
+                os.makedirs(path, exist_ok=True)
+        self.dbs = [rocksdb.DB(path, options(), read_only=read_only) for path in paths]
+        # Threads are only started on the first request that touches several shards, i.e. after worker processes
+        # have been forked
+        self._executor = None
+
+        found = self.dbs[0].get(SHARDS_KEY)
+        if found is not None:
+            built = _COUNT.unpack(found)[0]
+        elif self.dbs[0].get(LAYOUT_KEY) is not None or os.path.isdir(os.path.join(paths[0], "shard-000")):
+            # Databases built by earlier versions have a single shard and do not record it. A database with several
+            # shards keeps them in subdirectories.
+            built = 1 if self.dbs[0].get(LAYOUT_KEY) is not None else None
+        else:
+            built = self.shards
+            if not read_only:
+                self.dbs[0].put(SHARDS_KEY, _COUNT.pack(self.shards))
+        if built != self.shards:
+            raise ValueError(self._mismatch(paths[0], built))
+
+    def _mismatch(self, path, built):
+        """
+        Returns the message of the error raised if a database is opened with a different number of shards
+
+        :param path:    str, the directory of the database
+        :param built:   int, the number of shards the database was built with, None if it is not known
+        :return:        str, the message
+        """
+        return "Transaction database in " + path + " was built with " + (str(built) if built else "several") + \
+            " shards, but " + str(self.shards) + " were requested. Use the same --dbshards."
+
+    def _map(self, function, items):
+        """
+        Calls a function for every shard with a non-empty item, in parallel if there are several
+
+        :param function:    function, called with the RocksDB instance of a shard and its item
+        :param items:       list, one item per shard, None or empty to skip the shard
+        :return:            list, the results of the calls
+        """
+        calls = [(db, item) for db, item in zip(self.dbs, items) if item]
+        if len(calls) <= 1:
+            return [function(*call) for call in calls]
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.shards)
+        return list(self._executor.map(lambda call: function(*call), calls))
+
+    def get(self, key):
+        return self.dbs[shard_of(key, self.shards)].get(key)
+
+    def put(self, key, value):
+        self.dbs[shard_of(key, self.shards)].put(key, value)
+
+    def delete(self, key):
+        self.dbs[shard_of(key, self.shards)].delete(key)
+
+    def batch(self):
+        """
+        Returns an empty write batch for this database
+
+        :return:    ShardedBatch, the batch
+        """
+        return ShardedBatch(self.shards)
+
+    def write(self, batch):
+        """
+        Writes a batch returned by batch(). Every shard writes its part of the batch at the same time.
+
+        :param batch:   ShardedBatch, the batch
+        """
+        self._map(lambda db, b: db.write(b), [b if b.count() > 0 else None for b in batch.batches])
+
+    def multi_get(self, keys):
+        """
+        Reads several keys. Every shard reads its keys at the same time.
+
+        :param keys:    list, the keys
+        :return:        dict, the value of every key, None for keys that do not exist
+        """
+        by_shard = [[] for _ in range(self.shards)]
+        for key in keys:
+            by_shard[shard_of(key, self.shards)].append(key)
+        records = {}
+        for found in self._map(lambda db, k: db.multi_get(k), by_shard):
+            records.update(found)
+        return records
+
+    def ingest_external_file(self, files):
+        """
+        Ingests SST files. Every shard ingests its files at the same time.
+
+        :param files:   list, the paths of the SST files of every shard. The keys of a file have to belong to its shard.
+        """
+        self._map(lambda db, f: db.ingest_external_file(f), files)
+
+    def compact_range(self):
+        self._map(lambda db, _: db.compact_range(), [True] * self.shards)
+
+    def holds_records(self):
+        """
+        Returns whether the database holds any transactions or outpoints. Keys recording the setup of the database,
+        which are shorter than a txid, are not counted.
+
+        :return:    bool, True if any shard holds a key of a transaction or outpoint
+        """
+        for db in self.dbs:
+            it = db.iterkeys()
+            it.seek_to_first()
+            for key in it:
+                if len(key) >= _TXID_SIZE:
+                    return True
+        return False
+
+    def get_property(self, name):
+        """
+        Reads a RocksDB property. Numeric properties are added up over all shards, others are read from the first
+        shard.
+
+        :param name:    bytes, the name of the property
+        :return:        bytes, the value or None if the property does not exist
+        """
+        values = [db.get_property(name) for db in self.dbs]
+        if all(v is not None and v.isdigit() for v in values):
+            return str(sum(int(v) for v in values)).encode('ascii')
+        return values[0]
@@ -1,19 +1,33 @@
 #!/usr/bin/env bash
+# Parquet output is meant for Spark or DuckDB, neo4j-admin only imports csv files
+if python3 ./manifest.py $DATA --check parquet; then
+    echo "$DATA holds Parquet files, which cannot be imported into Neo4j. Run the parser with --format csv." >&2
+    exit 1
+fi
 sudo systemctl stop neo4j
 sudo chmod -R a+rwx /var/log/neo4j/
 sudo chmod -R a+rwx $DBDIR
 
 export HEADERS=./headers
+# Lists the files of an output, which may be split into shards (see manifest.py)
+files() { python3 ./manifest.py $DATA $1; }
+if python3 ./manifest.py $DATA --check unique_addresses; then
+    ADDRESSES=$(files addresses)
+elif python3 ./manifest.py $DATA --check compressed; then
+    ADDRESSES=$DATA/addresses_dedup.csv.gz
+else
+    ADDRESSES=$DATA/addresses_dedup.csv
+fi
 
 neo4j-admin import \
 --mode=csv \
---nodes:Address $HEADERS/addresses-header.csv,$DATA/addresses_dedup.csv \
---nodes:Block $HEADERS/blocks-header.csv,$DATA/blocks.csv \
---nodes:Transaction $HEADERS/transactions-header.csv,$DATA/transactions.csv \
---relationships:IS_BEFORE $HEADERS/before-rel-header.csv,$DATA/before-rel.csv \
---relationships:BELONGS_TO $HEADERS/belongs-rel-header.csv,$DATA/belongs-rel.csv \
---relationships:RECEIVES $HEADERS/receives-rel-header.csv,$DATA/receives-rel.csv \
---relationships:SENDS $HEADERS/sends-rel-header.csv,$DATA/sends-rel.csv \
+--nodes:Address $HEADERS/addresses-header.csv,$ADDRESSES \
+--nodes:Block $HEADERS/blocks-header.csv,$(files blocks) \
+--nodes:Transaction $HEADERS/transactions-header.csv,$(files transactions) \
+--relationships:IS_BEFORE $HEADERS/before-rel-header.csv,$(files before-rel) \
+--relationships:BELONGS_TO $HEADERS/belongs-rel-header.csv,$(files belongs-rel) \
+--relationships:RECEIVES $HEADERS/receives-rel-header.csv,$(files receives-rel) \
+--relationships:SENDS $HEADERS/sends-rel-header.csv,$(files sends-rel) \
 --ignore-missing-nodes=true \
 --ignore-duplicate-nodes=true \
 --multiline-fields=true \
@@ -1,2 +1,17 @@
-sort -S 80% -uo $DATA/addresses_dedup.csv $DATA/addresses.csv --parallel=$CORES
+# Parquet output is meant for Spark or DuckDB, neo4j-admin only imports csv files
+if python3 ./manifest.py $DATA --check parquet; then
+    echo "$DATA holds Parquet files, which cannot be imported into Neo4j. Run the parser with --format csv." >&2
+    exit 1
+fi
+# Addresses that are interned or written with their aggregates are written only once and need no deduplication
+if python3 ./manifest.py $DATA --check unique_addresses; then
+    exit 0
+fi
+ADDRESS_FILES=$(python3 ./manifest.py $DATA addresses --separator ' ')
+if python3 ./manifest.py $DATA --check compressed; then
+    # Compressed files are decompressed on the fly and the deduplicated file is compressed again
+    zcat $ADDRESS_FILES | sort -S 80% -u --parallel=$CORES | gzip -c > $DATA/addresses_dedup.csv.gz
+else
+    sort -S 80% -uo $DATA/addresses_dedup.csv $ADDRESS_FILES --parallel=$CORES
+fi
 #rm $DATA/addresses.csv
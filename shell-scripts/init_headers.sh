@@ -1,8 +1,19 @@
 #!/usr/bin/env bash
-# Creates Header-Files for node4j import
+# Creates Header-Files for node4j import. Headers stay uncompressed even if the data files are compressed (--compress),
+# neo4j-admin detects the compression of every file on its own.
 mkdir headers
 echo 'txid:ID(Transaction),date:date,inDegree:int,outDegree:int,inSum:long,outSum:long' > ./headers/transactions-header.csv
-echo 'address:ID(Address)' > ./headers/addresses-header.csv
+# Addresses replaced by integer IDs keep their address as property
+if python3 ./manifest.py $DATA --check interned; then
+    ADDRESS_COLUMNS='id:ID(Address),address'
+else
+    ADDRESS_COLUMNS='address:ID(Address)'
+fi
+# Aggregates computed by the parser (--addrstats)
+if python3 ./manifest.py $DATA --check address_stats; then
+    ADDRESS_COLUMNS=$ADDRESS_COLUMNS',inDegree:int,outDegree:int,received:long,sent:long,firstSeen:int,lastSeen:int'
+fi
+echo $ADDRESS_COLUMNS > ./headers/addresses-header.csv
 echo ':START_ID(Block),:END_ID(Block),:TYPE' > ./headers/before-rel-header.csv
 echo ':START_ID(Transaction),:END_ID(Block),:TYPE' > ./headers/belongs-rel-header.csv
 echo 'hash:ID(Block),height:int,mediantime:datetime{timezone:UTC}' > ./headers/blocks-header.csv
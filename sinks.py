@@ -0,0 +1,157 @@
+"""
+Destinations for the rows produced by the worker processes.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import csv
+import os
+
+from gzipstream import open_csv
+
+# Output files in the order of the record kinds used by the workers
+CSV_FILES = ('addresses', 'blocks', 'transactions', 'before-rel', 'belongs-rel', 'receives-rel', 'sends-rel')
+# Record kind of the address rows
+ADDRESSES = 0
+# Record kind of the database keys of spent outputs (pruning mode). Not written to a file.
+SPENT = len(CSV_FILES)
+
+
+class RecordSink:
+    """
+    Collects the rows of a chunk in one list per record kind and pushes them in batches to a queue, which is read by
+    the writer process. As the queue is bounded, workers block when the writer falls behind, which limits the amount of
+    memory taken up by rows in flight.
+
+    Messages on the queue are tuples of chunk, record kind and list of rows. The end of a chunk is marked by a message
+    with record kind None and a dict of statistics instead of rows.
+    """
+
+    def __init__(self, queue, chunk, batch_size, skip=()):
+        """
+        :param queue:       multiprocessing.Queue, the queue read by the writer
+        :param chunk:       int, the block height the chunk starts at
+        :param batch_size:  int, the number of rows sent at once
+        :param skip:        tuple, record kinds whose rows are dropped instead of sent
+        """
+        self.queue = queue
+        self.chunk = chunk
+        self.batch_size = batch_size
+        self.skip = skip
+        self.rows = [[] for _ in range(SPENT + 1)]
+
+    def _send(self, kind):
+        if kind in self.skip:
+            self.rows[kind].clear()
+            return
+        # The queue pickles its items in a background thread, so the list must not be modified after sending it
+        self.queue.put((self.chunk, kind, self.rows[kind][:]))
+        self.rows[kind].clear()
+
+    def poll(self):
+        """
+        Sends all record kinds that have reached the batch size
+        """
+        for kind, rows in enumerate(self.rows):
+            if len(rows) >= self.batch_size:
+                self._send(kind)
+
+    def close(self, stats):
+        """
+        Sends all remaining rows and marks the chunk as finished
+
+        :param stats:   dict, statistics of the chunk
+        """
+        for kind, rows in enumerate(self.rows):
+            if rows:
+                self._send(kind)
+        self.queue.put((self.chunk, None, stats))
+
+    def abort(self):
+        """
+        Marks the chunk as finished after processing failed. Rows that have not been sent yet are dropped.
+        """
+        self.queue.put((self.chunk, None, {'lookups': 0, 'lookup_time': 0.0, 'failed': True}))
+
+
+def shard_path(shard_dir, name, start, end, extension="csv"):
+    """
+    Returns the path of the shard of an output file holding a range of blocks. Heights are zero-padded, so shards sort
+    by height.
+
+    :param shard_dir:   str, the directory the shards are stored in
+    :param name:        str, the name of the output file (one of CSV_FILES)
+    :param start:       int, the first block height of the shard
+    :param end:         int, the block height the shard stops at (exclusive)
+    :param extension:   str, the file extension of the output format
+    :return:            str, the path of the shard
+    """
+    return os.path.join(shard_dir, name + "-%08d-%08d.%s" % (start, end, extension))
+
+
+class ShardSink(RecordSink):
+    """
+    Writes the rows of a chunk to shard files of its own instead of sending them to the writer process. Only the keys of
+    spent outputs and the end of the chunk still go through the queue.
+
+    Shards are written under a temporary name and renamed once the chunk is complete, so shards of failed chunks are
+    never picked up. Output files without any rows get no shard.
+    """
+
+    def __init__(self, queue, chunk, batch_size, shard_dir, end, skip=(), compress=False):
+        """
+        :param queue:       multiprocessing.Queue, the queue read by the writer
+        :param chunk:       int, the block height the chunk starts at
+        :param batch_size:  int, the number of rows written at once
+        :param shard_dir:   str, the directory to store the shards in
+        :param end:         int, the block height the chunk stops at (exclusive)
+        :param skip:        tuple, record kinds whose rows are dropped instead of written
+        :param compress:    bool, whether to write the shards gzip compressed
+        """
+        super().__init__(queue, chunk, batch_size, skip)
+        self.compress = compress
+        self.paths = [shard_path(shard_dir, name, chunk, end, "csv.gz" if compress else "csv") for name in CSV_FILES]
+        self.files = [None] * len(CSV_FILES)
+        self.writers = [None] * len(CSV_FILES)
+
+    def _open(self, kind):
+        """
+        Opens the temporary shard of a record kind
+
+        :param kind:    int, the record kind
+        :return:        the writer of the shard
+        """
+        self.files[kind] = open_csv(self.paths[kind] + ".tmp", 'w', self.compress)
+        return csv.writer(self.files[kind])
+
+    def _finish(self, kind):
+        self.files[kind].close()
+        os.replace(self.paths[kind] + ".tmp", self.paths[kind])
+
+    def _discard(self, kind):
+        self.files[kind].close()
+        os.remove(self.paths[kind] + ".tmp")
+
+    def _send(self, kind):
+        if kind == SPENT or kind in self.skip:
+            super()._send(kind)
+            return
+        if self.writers[kind] is None:
+            self.writers[kind] = self._open(kind)
+        self.writers[kind].writerows(self.rows[kind])
+        self.rows[kind].clear()
+
+    def close(self, stats):
+        for kind, rows in enumerate(self.rows):
+            if rows:
+                self._send(kind)
+        for kind, writer in enumerate(self.writers):
+            if writer is not None:
+                self._finish(kind)
+        self.queue.put((self.chunk, None, stats))
+
+    def abort(self):
+        for kind, writer in enumerate(self.writers):
+            if writer is not None:
+                self._discard(kind)
+        super().abort()
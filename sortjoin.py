@@ -0,0 +1,320 @@
+"""
+Sort-merge join of transaction inputs with the outputs they spend.
+
+Instead of looking up every input in a key-value store, the outputs and inputs of a chunk of blocks are written to
+run files sorted by outpoint. An external k-way merge over all runs then joins each input with its spent output,
+which only requires sequential disk access.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import heapq
+import os
+import struct
+
+from txdb import txid_key, outpoint_key, UNKNOWN_ADDRESS
+
+# Read buffer per run file during the merge
+BUFFER_SIZE = 1024 ** 2
+# Maximum number of runs merged at once. Larger numbers of runs are merged in several passes.
+MAX_FANIN = 256
+# Number of records kept in memory before they are spilled to a sorted run
+RUN_SIZE = 4 * 1024 ** 2
+
+
+class _FixedRun:
+    """
+    Run file of fixed-width records
+    """
+
+    def __init__(self, fmt):
+        self.struct = struct.Struct(fmt)
+
+    def write(self, path, records):
+        pack = self.struct.pack
+        with open(path, 'wb', buffering=BUFFER_SIZE) as f:
+            for record in records:
+                f.write(pack(*record))
+
+    def read(self, path):
+        size = self.struct.size
+        # Read whole multiples of the record size to unpack them in one go
+        block = (BUFFER_SIZE // size) * size
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(block)
+                if not data:
+                    return
+                yield from self.struct.iter_unpack(data)
+
+
+class _OutputRun:
+    """
+    Run file of transaction outputs: outpoint key, value and a length-prefixed receiving address
+    """
+
+    def __init__(self):
+        self.struct = struct.Struct('<36sQB')
+
+    def write(self, path, records):
+        pack = self.struct.pack
+        with open(path, 'wb', buffering=BUFFER_SIZE) as f:
+            for key, value, address in records:
+                f.write(pack(key, value, len(address)))
+                f.write(address)
+
+    def read(self, path):
+        size = self.struct.size
+        unpack_from = self.struct.unpack_from
+        with open(path, 'rb') as f:
+            buf = b''
+            while True:
+                data = f.read(BUFFER_SIZE)
+                buf += data
+                pos = 0
+                end = len(buf)
+                while pos + size <= end:
+                    key, value, length = unpack_from(buf, pos)
+                    if pos + size + length > end:
+                        break
+                    yield key, value, buf[pos + size:pos + size + length]
+                    pos += size + length
+                buf = buf[pos:]
+                if not data:
+                    return
+
+
+class _KeyValueRun:
+    """
+    Run file of database entries: length-prefixed key and value
+    """
+
+    def __init__(self):
+        self.struct = struct.Struct('<HI')
+
+    def write(self, path, records):
+        pack = self.struct.pack
+        with open(path, 'wb', buffering=BUFFER_SIZE) as f:
+            for key, value in records:
+                f.write(pack(len(key), len(value)))
+                f.write(key)
+                f.write(value)
+
+    def read(self, path):
+        size = self.struct.size
+        unpack_from = self.struct.unpack_from
+        with open(path, 'rb') as f:
+            buf = b''
+            while True:
+                data = f.read(BUFFER_SIZE)
+                buf += data
+                pos = 0
+                end = len(buf)
+                while pos + size <= end:
+                    key_length, value_length = unpack_from(buf, pos)
+                    key_end = pos + size + key_length
+                    if key_end + value_length > end:
+                        break
+                    yield buf[pos + size:key_end], buf[key_end:key_end + value_length]
+                    pos = key_end + value_length
+                buf = buf[pos:]
+                if not data:
+                    return
+
+
+class _AddressStatsRun:
+    """
+    Run file of address aggregates: length-prefixed address followed by its counters
+    """
+
+    def __init__(self):
+        self.struct = struct.Struct('<BIIQQII')
+
+    def write(self, path, records):
+        pack = self.struct.pack
+        with open(path, 'wb', buffering=BUFFER_SIZE) as f:
+            for address, *counters in records:
+                f.write(pack(len(address), *counters))
+                f.write(address)
+
+    def read(self, path):
+        size = self.struct.size
+        unpack_from = self.struct.unpack_from
+        with open(path, 'rb') as f:
+            buf = b''
+            while True:
+                data = f.read(BUFFER_SIZE)
+                buf += data
+                pos = 0
+                end = len(buf)
+                while pos + size <= end:
+                    length, *counters = unpack_from(buf, pos)
+                    if pos + size + length > end:
+                        break
+                    yield (buf[pos + size:pos + size + length], *counters)
+                    pos += size + length
+                buf = buf[pos:]
+                if not data:
+                    return
+
+
+# Outputs: outpoint key, value, receiving address
+OUTPUTS = _OutputRun()
+# Inputs: outpoint key of the spent output, raw txid of the spending transaction
+INPUTS = _FixedRun('<36s32s')
+# Transactions: raw txid, date, in-degree, out-degree, out-sum, in-sum of coinbase transactions
+TRANSACTIONS = _FixedRun('<32s10sIIQQ')
+# In-sums: raw txid of the spending transaction, value of one spent output
+INSUMS = _FixedRun('<32sQ')
+# Database entries: key, serialized record
+KEYVALUES = _KeyValueRun()
+# Address aggregates: address, in-degree, out-degree, received, sent, first and last block height
+ADDRESS_STATS = _AddressStatsRun()
+
+
+def run_path(run_dir, kind, start):
+    """
+    Returns the path of the run file of a chunk
+
+    :param run_dir: str, the directory the runs are stored in
+    :param kind:    str, the kind of records in the run (outputs, inputs, transactions)
+    :param start:   int, the block height the chunk starts at
+    :return:        str, the path of the run file
+    """
+    return os.path.join(run_dir, kind + "-" + str(start) + ".run")
+
+
+class ChunkRuns:
+    """
+    Collects the records of a chunk of blocks and writes them as sorted runs
+    """
+
+    def __init__(self, run_dir, start):
+        self.run_dir = run_dir
+        self.start = start
+        self.outputs = []
+        self.inputs = []
+        self.transactions = []
+
+    def add_output(self, txid, vout, value, address):
+        encoded = b'' if address == UNKNOWN_ADDRESS else address.encode('utf-8')
+        self.outputs.append((outpoint_key(txid, vout), value, encoded))
+
+    def add_input(self, txid, vout, spending_txid):
+        self.inputs.append((outpoint_key(txid, vout), txid_key(spending_txid)))
+
+    def add_transaction(self, txid, date, in_degree, out_degree, out_sum, coinbase_sum=0):
+        self.transactions.append((txid_key(txid), date.encode('ascii'), in_degree, out_degree, out_sum, coinbase_sum))
+
+    def close(self):
+        """
+        Sorts the collected records and writes them to disk. The run files are renamed into place once complete, so
+        the runs of aborted chunks are never picked up by the merge.
+        """
+        for kind, fmt, records in (('outputs', OUTPUTS, self.outputs), ('inputs', INPUTS, self.inputs),
+                                   ('transactions', TRANSACTIONS, self.transactions)):
+            records.sort()
+            path = run_path(self.run_dir, kind, self.start)
+            fmt.write(path + ".tmp", records)
+            os.replace(path + ".tmp", path)
+            records.clear()
+
+
+def merge_runs(fmt, paths, run_dir, prefix, key=None):
+    """
+    Returns an iterator over the records of several sorted runs in sorted order. If there are more runs than can be
+    merged at once, they are merged into intermediate runs first. Records that compare equal are returned in the order
+    of their runs. Intermediate runs are removed once the iterator is used up or closed, the given runs are left to the
+    caller.
+
+    :param fmt:     the format of the runs (OUTPUTS, INPUTS, TRANSACTIONS, INSUMS or KEYVALUES)
+    :param paths:   list, the paths of the runs
+    :param run_dir: str, the directory to store intermediate runs in
+    :param prefix:  str, the file name prefix of intermediate runs
+    :param key:     function, extracts the sort key from a record. Defaults to the whole record.
+    :return:        iterator, the merged records
+    """
+    level = 0
+    while len(paths) > MAX_FANIN:
+        merged = []
+        for i in range(0, len(paths), MAX_FANIN):
+            path = os.path.join(run_dir, prefix + "-merge-" + str(level) + "-" + str(i) + ".run")
+            fmt.write(path, heapq.merge(*[fmt.read(p) for p in paths[i:i + MAX_FANIN]], key=key))
+            merged.append(path)
+        if level > 0:
+            # Intermediate runs of the previous level are not needed anymore
+            for p in paths:
+                os.remove(p)
+        paths = merged
+        level += 1
+    records = heapq.merge(*[fmt.read(p) for p in paths], key=key)
+    return _removing(records, paths) if level > 0 else records
+
+
+def _removing(records, paths):
+    # Intermediate runs of the last level are removed when the merge is used up, or when it is closed or garbage
+    # collected because the caller stopped early
+    try:
+        yield from records
+    finally:
+        for p in paths:
+            os.remove(p)
+
+
+def _spill(fmt, records, run_dir, prefix, paths):
+    records.sort()
+    path = os.path.join(run_dir, prefix + "-" + str(len(paths)) + ".run")
+    fmt.write(path, records)
+    paths.append(path)
+    records.clear()
+
+
+def join_runs(run_dir, starts, sends_writer, transactions_writer):
+    """
+    Joins the runs of all chunks and writes the SENDS relationships and the transactions to the csv files
+
+    :param run_dir:             str, the directory the runs are stored in
+    :param starts:              list, the start heights of all chunks
+    :param sends_writer:        csv.writer, writer of the SENDS relationships
+    :param transactions_writer: csv.writer, writer of the transactions
+    :return:                    tuple, the number of joined inputs and the number of inputs that could not be resolved
+    """
+    outputs = merge_runs(OUTPUTS, [run_path(run_dir, 'outputs', s) for s in starts], run_dir, 'outputs')
+    inputs = merge_runs(INPUTS, [run_path(run_dir, 'inputs', s) for s in starts], run_dir, 'inputs')
+
+    # Pass 1: Join inputs with the outputs they spend. Both streams are sorted by outpoint.
+    insums = []
+    insum_paths = []
+    joined = 0
+    unresolved = 0
+    output = next(outputs, None)
+    for key, spending_txid in inputs:
+        while output is not None and output[0] < key:
+            output = next(outputs, None)
+        if output is None or output[0] != key:
+            unresolved += 1
+            continue
+        address = output[2].decode('utf-8') if output[2] else UNKNOWN_ADDRESS
+        sends_writer.writerow([address, output[1], spending_txid.hex(), 'SENDS'])
+        insums.append((spending_txid, output[1]))
+        joined += 1
+        if len(insums) >= RUN_SIZE:
+            _spill(INSUMS, insums, run_dir, 'insums', insum_paths)
+    _spill(INSUMS, insums, run_dir, 'insums', insum_paths)
+
+    # Pass 2: Sum up the spent values per transaction. Both streams are sorted by txid.
+    sums = merge_runs(INSUMS, insum_paths, run_dir, 'insums')
+    transactions = merge_runs(TRANSACTIONS, [run_path(run_dir, 'transactions', s) for s in starts], run_dir,
+                          'transactions')
+    insum = next(sums, None)
+    for txid, date, in_degree, out_degree, out_sum, in_sum in transactions:
+        while insum is not None and insum[0] < txid:
+            insum = next(sums, None)
+        while insum is not None and insum[0] == txid:
+            in_sum += insum[1]
+            insum = next(sums, None)
+        transactions_writer.writerow([txid.hex(), date.decode('ascii'), in_degree, out_degree, in_sum, out_sum])
+
+    for p in insum_paths:
+        os.remove(p)
+    return joined, unresolved
@@ -0,0 +1,45 @@
+"""
+Shared fixtures of the tests. The tests run against a synthetic chain written by fixtures.py, so they need neither a
+node nor a copy of the real blockchain: `python3 -m pytest tests`
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+# The modules of the parser are not installed, they are imported from the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import ChainGenerator, write_fixture, FIXTURE_FILE
+
+# Number of blocks of the synthetic chain
+BLOCKS = 400
+# Size of its blk files. Small, so the chain is spread over several of them.
+FILE_SIZE = 256 * 1024
+
+
+@pytest.fixture(scope='session')
+def chain(tmp_path_factory):
+    """
+    Synthetic chain shared by all tests
+
+    :return:    tuple, the directory of the chain and the summary read from its fixture.json
+    """
+    outdir = str(tmp_path_factory.mktemp('chain'))
+    write_fixture(outdir, BLOCKS, ChainGenerator(txs=30, blocks=BLOCKS, seed=7), FILE_SIZE)
+    with open(os.path.join(outdir, FIXTURE_FILE)) as f:
+        return outdir, json.load(f)
+
+
+@pytest.fixture(scope='session')
+def block_index_path(chain):
+    return os.path.join(chain[0], "block_index.bin")
+
+
+@pytest.fixture(scope='session')
+def block_path(chain):
+    return os.path.join(chain[0], "blocks")
@@ -0,0 +1,145 @@
+"""
+Tests of the lean block reader and of reading blocks ahead against the synthetic chain
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import os
+
+import pytest
+
+import readahead
+from blkreader import iter_blocks, parse_block, parser_block, AddressEncoder, encode_payload, script_payload, \
+    base58check, bech32
+from blockindex import BlockIndex
+from fixtures import ChainGenerator, write_fixture, SCRIPT_TYPES
+from txdb import UNKNOWN_ADDRESS
+
+
+def test_counts_match_fixture(chain, block_index_path, block_path):
+    summary = chain[1]
+    blocks = list(iter_blocks(block_index_path, block_path, 0, summary['blocks']))
+    assert len(blocks) == summary['blocks']
+    assert sum(len(b.transactions) for b in blocks) == summary['transactions']
+    assert sum(len(tx.inputs) for b in blocks for tx in b.transactions if not tx.coinbase) == summary['inputs']
+    assert sum(len(tx.outputs) for b in blocks for tx in b.transactions) == summary['outputs']
+
+
+def test_blocks_form_a_chain(chain, block_index_path, block_path):
+    index = BlockIndex(block_index_path)
+    previous = None
+    for block in iter_blocks(block_index_path, block_path, 0, len(index)):
+        assert block.hash == index.location(block.height)[4]
+        assert block.transactions[0].coinbase
+        assert not any(tx.coinbase for tx in block.transactions[1:])
+        if previous is not None:
+            assert block.height == previous.height + 1
+            assert block.prev_hash == previous.hash
+            assert block.timestamp > previous.timestamp
+        previous = block
+
+
+def test_inputs_spend_earlier_outputs(chain, block_index_path, block_path):
+    created = set()
+    for block in iter_blocks(block_index_path, block_path, 0, chain[1]['blocks']):
+        # Outputs can only be spent from the next block on
+        for tx in block.transactions:
+            if not tx.coinbase:
+                assert all(prevout in created for prevout in tx.inputs)
+        for tx in block.transactions:
+            created.update((tx.txid, o) for o in range(len(tx.outputs)))
+
+
+def test_encoder_matches_decoding(chain, block_index_path, block_path):
+    # Encoding the payloads of a block in one batch yields the addresses decoded output by output
+    end = chain[1]['blocks']
+    decoded = list(iter_blocks(block_index_path, block_path, 0, end))
+    encoded = list(iter_blocks(block_index_path, block_path, 0, end, encoder=AddressEncoder(cache_size=100)))
+    assert encoded == decoded
+
+
+def test_raw_addresses_round_trip(chain, block_index_path, block_path):
+    end = chain[1]['blocks']
+    encoded = list(iter_blocks(block_index_path, block_path, 0, end, encoder=AddressEncoder()))
+    raw = list(iter_blocks(block_index_path, block_path, 0, end, encoder=AddressEncoder(raw=True)))
+    addresses = 0
+    for block, raw_block in zip(encoded, raw):
+        for tx, raw_tx in zip(block.transactions, raw_block.transactions):
+            assert tx.txid == raw_tx.txid and tx.inputs == raw_tx.inputs
+            for (value, address), (raw_value, payload) in zip(tx.outputs, raw_tx.outputs):
+                assert value == raw_value
+                if address == UNKNOWN_ADDRESS:
+                    assert payload == UNKNOWN_ADDRESS
+                else:
+                    assert encode_payload(bytes.fromhex(payload)) == address
+                    addresses += 1
+    assert addresses > 0
+
+
+@pytest.mark.parametrize('script, address', [
+    # P2PKH of the all-zero hash160
+    ('76a914' + '00' * 20 + '88ac', '1111111111111111111114oLvT2'),
+    # P2WPKH example of BIP 173
+    ('0014751e76e8199196d454941c45d1b3a323f1433bd6', 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'),
+    ('6a0401020304', UNKNOWN_ADDRESS),
+])
+def test_known_addresses(script, address):
+    payload = script_payload(bytes.fromhex(script))
+    assert encode_payload(payload) == address
+    assert AddressEncoder(raw=True).encode([payload])[payload] == (payload.hex() if payload else UNKNOWN_ADDRESS)
+
+
+def test_encoding_functions():
+    assert base58check(0, b'\0' * 20) == '1111111111111111111114oLvT2'
+    assert bech32(0, bytes.fromhex('751e76e8199196d454941c45d1b3a323f1433bd6')) == \
+        'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'
+
+
+def test_readahead_matches_mmap(chain, block_index_path, block_path):
+    end = chain[1]['blocks']
+    mapped = list(iter_blocks(block_index_path, block_path, 0, end))
+    assert list(iter_blocks(block_index_path, block_path, 0, end, readahead=readahead.READAHEAD_BYTES)) == mapped
+    # A range that does not start at the first block
+    assert list(iter_blocks(block_index_path, block_path, 123, 321, readahead=readahead.READAHEAD_BYTES)) == \
+        mapped[123:321]
+
+
+def test_readahead_spans(chain, block_index_path, block_path, monkeypatch):
+    # Small spans, so every blk file is read in several of them and the queue fills up
+    monkeypatch.setattr(readahead, 'SPAN_BYTES', 32 * 1024)
+    index = BlockIndex(block_index_path)
+    spans = list(readahead.spans(index, 0, len(index), readahead.SPAN_BYTES))
+    assert [h for span in spans for h, _, _ in span[3]] == list(range(len(index)))
+    assert len({span[0] for span in spans}) == chain[1]['files'] > 1
+    for file_number, offset, size, blocks in spans:
+        for height, block_offset, block_size in blocks:
+            assert index.location(height)[0] == file_number
+            assert offset <= block_offset and block_offset + block_size <= offset + size
+    read = [(height, bytes(view)) for height, view in readahead.ReadAhead(index, block_path, 0, len(index),
+                                                                           2 * readahead.SPAN_BYTES)]
+    assert read == [(height, index.read_block(block_path, height)) for height in range(len(index))]
+
+
+def test_readahead_stops_early(chain, block_index_path, block_path, monkeypatch):
+    monkeypatch.setattr(readahead, 'SPAN_BYTES', 32 * 1024)
+    index = BlockIndex(block_index_path)
+    ahead = readahead.ReadAhead(index, block_path, 0, len(index), 2 * readahead.SPAN_BYTES)
+    blocks = iter(ahead)
+    height, view = next(blocks)
+    assert parse_block(view, height).height == 0
+    # Closing the iterator stops the thread, even though it is waiting for room in the full queue
+    blocks.close()
+    ahead.thread.join(timeout=5)
+    assert not ahead.thread.is_alive()
+
+
+def test_matches_blockchain_parser(tmp_path):
+    pytest.importorskip('blockchain_parser')
+    # Taproot outputs are left out, as not every version of blockchain_parser encodes them
+    script_types = {name: share for name, share in SCRIPT_TYPES.items() if name != 'p2tr'}
+    write_fixture(str(tmp_path), 100, ChainGenerator(txs=20, blocks=100, script_types=script_types, seed=3))
+    index = BlockIndex(os.path.join(str(tmp_path), "block_index.bin"))
+    block_path = os.path.join(str(tmp_path), "blocks")
+    for height in range(len(index)):
+        raw = index.read_block(block_path, height)
+        assert parse_block(memoryview(raw), height) == parser_block(raw, height)
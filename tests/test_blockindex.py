@@ -0,0 +1,69 @@
+"""
+Tests of updating the block index when the chain has grown or been reorganized
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import collections
+
+import pytest
+
+import blockindex
+from blockindex import BlockIndex, load_index, write_index, shared_blocks
+
+# The fields of a DBBlockIndex entry read by build_index
+_Entry = collections.namedtuple('_Entry', 'file data_pos n_tx hash')
+
+
+def _locations(index):
+    return [index.location(h) for h in range(len(index))]
+
+
+@pytest.fixture
+def chain_entries(block_index_path, monkeypatch):
+    """
+    Main chain of the synthetic chain as returned by main_chain, which needs the LevelDB index of Bitcoin Core
+    """
+    entries = [_Entry(f, offset, n_tx, block_hash) for f, offset, _, n_tx, block_hash in
+               _locations(BlockIndex(block_index_path))]
+    monkeypatch.setattr(blockindex, 'main_chain', lambda index_path: entries)
+    return entries
+
+
+def _changed(locations):
+    # Sizes that differ from the blk files show which locations were taken from the previous index
+    return [(f, offset, size + 1, n_tx, block_hash) for f, offset, size, n_tx, block_hash in locations]
+
+
+def test_index_is_extended_to_the_tip(block_index_path, block_path, chain_entries, tmp_path):
+    expected = _locations(BlockIndex(block_index_path))
+    path = str(tmp_path / "block_index.bin")
+    write_index(path, _changed(expected[:300]))
+
+    # Without an end, the index has to reach the tip
+    index = load_index(path, None, block_path)
+    assert _locations(index) == _changed(expected[:300]) + expected[300:]
+
+
+def test_index_is_updated_after_reorg(block_index_path, block_path, chain_entries, tmp_path):
+    expected = _locations(BlockIndex(block_index_path))
+    path = str(tmp_path / "block_index.bin")
+    stale = [(f, offset, size, n_tx, 'ee' * 32) for f, offset, size, n_tx, _ in expected[395:]]
+    write_index(path, _changed(expected[:395]) + stale)
+    assert shared_blocks(BlockIndex(path), chain_entries) == 395
+
+    index = load_index(path, None, block_path, 100)
+    assert _locations(index) == _changed(expected[:395]) + expected[395:]
+
+
+def test_matching_index_is_kept(block_index_path, block_path, chain_entries, tmp_path, monkeypatch):
+    locations = _changed(_locations(BlockIndex(block_index_path)))
+    path = str(tmp_path / "block_index.bin")
+    write_index(path, locations)
+
+    def rebuild(*args):
+        raise AssertionError("The index matches the main chain")
+
+    monkeypatch.setattr(blockindex, 'build_index', rebuild)
+    assert _locations(load_index(path, None, block_path)) == locations
+    assert _locations(load_index(path, None, block_path, 100)) == locations
@@ -0,0 +1,77 @@
+"""
+Tests of the split of the memory budget and of its adjustment while running
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import pytest
+
+pytest.importorskip('psutil')
+
+from budget import MemoryBudget, WORKER_MEMORY, WRITE_BUFFERS, ROW_BYTES, HIGH, LOW, MB
+
+GB = 1024 ** 3
+
+
+@pytest.mark.parametrize('total,cores', [(2 * GB, 4), (16 * GB, 8), (64 * GB, 32), (256 * MB, 2)])
+def test_plan_stays_within_budget(total, cores):
+    budget = MemoryBudget(total, cores, batch_rows=1000)
+    assert 1 <= budget.workers <= cores
+    assert budget.active == budget.workers
+    used = budget.queue_depth * 1000 * ROW_BYTES + budget.workers * (WORKER_MEMORY + budget.worker_cache) + \
+        WRITE_BUFFERS * budget.write_buffer_size + budget.block_cache
+    # The budget only overflows if not even a single worker fits, as at least 64 MB are left to RocksDB
+    assert used <= max(total, budget.queue_depth * 1000 * ROW_BYTES + WORKER_MEMORY + 64 * MB)
+
+
+def test_plan_without_workers():
+    budget = MemoryBudget(8 * GB, 0)
+    assert budget.workers == budget.active == budget.queue_depth == budget.worker_cache == 0
+    assert budget.output_cache > 0 and budget.block_cache > 0
+
+
+def test_plan_fits_workers_into_budget():
+    # Half of the budget goes to the workers, so 8 GB hold 5 workers of 768 MB, not the 8 cores
+    budget = MemoryBudget(8 * GB, 8)
+    assert budget.workers == 5
+
+
+def test_calibrate_lowers_active_only():
+    budget = MemoryBudget(16 * GB, 8)
+    workers, caches = budget.workers, (budget.worker_cache, budget.block_cache, budget.write_buffer_size)
+    # The rows in flight take up a little of the budget, so 2 GB per worker would only fit 3 of them
+    budget.calibrate(2 * GB - 64 * MB)
+    assert budget.worker_memory == 2 * GB - 64 * MB
+    assert budget.active == 4
+    # Worker processes and caches have been set up already
+    assert budget.workers == workers
+    assert (budget.worker_cache, budget.block_cache, budget.write_buffer_size) == caches
+
+
+def test_calibrate_ignores_smaller_and_later_measurements():
+    budget = MemoryBudget(16 * GB, 8)
+    budget.calibrate(WORKER_MEMORY // 2)
+    assert budget.worker_memory == WORKER_MEMORY
+    assert budget.active == 8
+    for _ in range(budget.workers - 1):
+        budget.calibrate(WORKER_MEMORY)
+    # Every worker has been measured, so later chunks whose block cache has filled up no longer count
+    budget.calibrate(8 * GB)
+    assert budget.worker_memory == WORKER_MEMORY
+    assert budget.active == 8
+
+
+def test_adjust_follows_memory():
+    budget = MemoryBudget(16 * GB, 8)
+    budget.calibrate(4 * GB - 64 * MB)
+    assert budget.active == 2
+    # Below LOW more chunks are run at once again, up to the number of workers
+    for expected in range(3, 9):
+        assert budget.adjust(int(budget.total * LOW) - 1) == expected
+    assert budget.adjust(0) == 8
+    # Between LOW and HIGH nothing changes
+    assert budget.adjust(int(budget.total * (LOW + HIGH) / 2)) == 8
+    # Above HIGH fewer, but always at least one
+    for expected in range(7, 0, -1):
+        assert budget.adjust(budget.total) == expected
+    assert budget.adjust(budget.total) == 1
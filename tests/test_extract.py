@@ -0,0 +1,140 @@
+"""
+Tests of the secondary indexes and of the hop by hop expansion of extract.py against the synthetic chain
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import pytest
+
+rocksdb = pytest.importorskip('rocksdb')
+pytest.importorskip('tqdm')
+
+import extract
+from blkreader import iter_blocks, AddressEncoder
+from blockindex import BlockIndex
+from follow import REORG_DEPTH
+from txdb import UNKNOWN_ADDRESS
+from txindex import indexed_height, indexed_hash, postings
+
+
+class Collector:
+    """
+    Stands in for Extraction: records the transactions of every hop and returns the addresses taking part in them
+    """
+
+    def __init__(self, participants):
+        self.participants = participants
+        self.hops = []
+
+    def write(self, selected):
+        self.hops.append(dict(selected))
+        touched = set()
+        for txid in selected:
+            touched |= self.participants[txid]
+        return touched
+
+
+@pytest.fixture(scope='module')
+def indexed(chain, block_index_path, block_path, tmp_path_factory):
+    """
+    Index database of the synthetic chain and, for every indexed transaction, its height and the addresses taking
+    part in it
+
+    :return:    tuple, the index database, the height of every transaction and the addresses of every transaction
+    """
+    index = BlockIndex(block_index_path)
+    index_db = rocksdb.DB(str(tmp_path_factory.mktemp('index')), extract.index_options(create=True))
+    # Indexed in two runs, the second continues where the first stopped
+    extract.build_index(index_db, index, block_index_path, block_path, 150, 2, 500)
+    extract.build_index(index_db, index, block_index_path, block_path, len(index), 2, 500)
+
+    heights = {}
+    participants = {}
+    outputs = {}
+    for block in iter_blocks(block_index_path, block_path, 0, indexed_height(index_db), encoder=AddressEncoder()):
+        for tx in block.transactions:
+            heights[tx.txid] = block.height
+            addresses = {address for _, address in tx.outputs}
+            if not tx.coinbase:
+                addresses |= {outputs[prevout] for prevout in tx.inputs}
+            addresses.discard(UNKNOWN_ADDRESS)
+            participants[tx.txid] = addresses
+            outputs.update(((tx.txid, o), address) for o, (_, address) in enumerate(tx.outputs))
+    return index_db, heights, participants
+
+
+def expected_hops(participants, addresses, txids, hops):
+    """
+    Expands a set of addresses and transactions hop by hop by scanning all transactions
+    """
+    result = []
+    selected = set()
+    visited = set()
+    frontier = set(addresses)
+    for hop in range(hops):
+        queried = frontier - visited
+        found = {txid for txid, taking_part in participants.items() if taking_part & queried}
+        if hop == 0:
+            found |= set(txids)
+        visited |= frontier
+        new = found - selected
+        result.append(new)
+        selected |= new
+        frontier = set()
+        for txid in new:
+            frontier |= participants[txid]
+        if not new:
+            break
+    return result
+
+
+def test_tip_is_not_indexed(chain, block_index_path, indexed):
+    index_db = indexed[0]
+    index = BlockIndex(block_index_path)
+    assert indexed_height(index_db) == chain[1]['blocks'] - REORG_DEPTH
+    assert indexed_hash(index_db) == index.location(indexed_height(index_db) - 1)[4]
+    extract.check_indexed(index_db, index)
+
+
+def test_postings(indexed):
+    index_db, heights, participants = indexed
+    receivers = {}
+    for txid, addresses in participants.items():
+        for address in addresses:
+            receivers.setdefault(address, set())
+    address = sorted(receivers)[0]
+    found = postings(index_db, address)
+    assert found and [p[0] for p in found] == sorted(p[0] for p in found)
+    assert all(heights[txid] == height for height, txid, _, _ in found)
+
+
+@pytest.mark.parametrize('hops', [1, 3])
+def test_hops_match_scan(indexed, hops):
+    index_db, heights, participants = indexed
+    # Addresses of an early coinbase, which take part in transactions all along the chain
+    seeds = sorted(participants[min(heights, key=lambda t: (heights[t], t))])[:2]
+    collector = Collector(participants)
+    done = extract.extract(index_db, collector, set(seeds), set(), hops, 0)
+    expected = expected_hops(participants, seeds, [], hops)
+    assert done == len(expected)
+    assert [set(hop) for hop in collector.hops] == expected
+    assert all(heights[txid] == height for hop in collector.hops for txid, height in hop.items())
+    # No transaction is extracted twice
+    assert sum(len(hop) for hop in collector.hops) == len(set().union(*collector.hops))
+
+
+def test_seed_transactions(indexed):
+    index_db, heights, participants = indexed
+    txid = sorted(heights)[0]
+    collector = Collector(participants)
+    extract.extract(index_db, collector, set(), {txid}, 2, 0)
+    assert collector.hops[0] == {txid: heights[txid]}
+    assert [set(hop) for hop in collector.hops] == expected_hops(participants, [], [txid], 2)
+
+
+def test_max_tx_stops_after_hop(indexed):
+    index_db, heights, participants = indexed
+    seeds = sorted(participants[min(heights, key=lambda t: (heights[t], t))])[:2]
+    collector = Collector(participants)
+    assert extract.extract(index_db, collector, set(seeds), set(), 5, 1) == 1
+    assert len(collector.hops) == 1
@@ -0,0 +1,182 @@
+"""
+Tests of the follow mode: committing blocks with undo records, rolling them back after a reorganization of the chain
+and the Cypher statements that remove the rolled back blocks from Neo4j
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import csv
+import json
+import os
+
+import pytest
+
+from cypher import write_delta_cypher, BATCH_SIZE
+from follow import new_state, load_state, save_state, find_fork, rollback, BlockBatch, REORG_DEPTH, STATE_KEY, \
+    undo_key
+
+
+class _Batch:
+    def __init__(self):
+        self.ops = []
+
+    def put(self, key, value):
+        self.ops.append((key, value))
+
+    def delete(self, key):
+        self.ops.append((key, None))
+
+
+class _DictDB:
+    """
+    Transaction database held in a dict, offering the methods of ShardedDB used in follow mode
+    """
+
+    def __init__(self):
+        self.records = {}
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def put(self, key, value):
+        self.records[key] = value
+
+    def delete(self, key):
+        self.records.pop(key, None)
+
+    def batch(self):
+        return _Batch()
+
+    def write(self, batch):
+        for key, value in batch.ops:
+            if value is None:
+                self.records.pop(key, None)
+            else:
+                self.records[key] = value
+
+
+class _Index:
+    """
+    Block index of a chain given by its block hashes
+    """
+
+    def __init__(self, hashes):
+        self.hashes = hashes
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def location(self, height):
+        return None, None, None, None, self.hashes[height]
+
+
+def _key(n):
+    return n.to_bytes(32, 'big') + b'\0\0\0\0'
+
+
+def _block_hash(height, branch='a'):
+    return branch * 8 + '%056x' % height
+
+
+def _commit_block(db, state, height, branch='a'):
+    """
+    Commits a block that spends the output created two blocks before, creates two outputs and spends one of them itself
+    """
+    batch = BlockBatch(db, state, undo=True)
+    if height >= 2:
+        batch.delete(_key(height - 2))
+    batch.put(_key(height), (branch + str(height)).encode())
+    batch.put(_key(1000 + height), b'spent in the same block')
+    assert batch.get(_key(1000 + height)) == b'spent in the same block'
+    batch.delete(_key(1000 + height))
+    # Replaces an output that exists before the first block
+    batch.put(_key(5000), (branch + str(height)).encode())
+    batch.commit(height, _block_hash(height, branch))
+
+
+def _snapshot(db):
+    records = dict(db.records)
+    state = json.loads(records.pop(STATE_KEY).decode('utf-8'))
+    return records, state
+
+
+def test_rollback_restores_database_and_state():
+    db = _DictDB()
+    db.put(_key(5000), b'before')
+    state = new_state(0)
+    save_state(db, state)
+    for height in range(4):
+        _commit_block(db, state, height)
+    records, saved = _snapshot(db)
+
+    for height in range(4, 8):
+        _commit_block(db, state, height)
+    assert db.get(_key(1004)) is None and db.get(_key(7)) == b'a7'
+    index = _Index([_block_hash(h) for h in range(4)] + [_block_hash(h, 'b') for h in range(4, 9)])
+    assert find_fork(state, index) == 3
+
+    assert rollback(db, state, 3) == 4
+    assert state == load_state(db)
+    assert state['removed'] == [_block_hash(h) for h in range(7, 3, -1)]
+    rolled_back, after = _snapshot(db)
+    assert rolled_back == records
+    after['removed'] = []
+    assert after == saved
+
+    # The blocks of the new branch are committed on top of the fork
+    for height in range(4, 9):
+        _commit_block(db, state, height, 'b')
+    assert find_fork(state, index) == 8
+    assert db.get(_key(5000)) == b'b8'
+
+
+def test_fork_beyond_reorg_depth_is_refused():
+    db = _DictDB()
+    state = new_state(0)
+    blocks = REORG_DEPTH + 10
+    for height in range(blocks):
+        _commit_block(db, state, height)
+    # Undo records and hashes are only kept for the most recent blocks
+    assert len(state['hashes']) == REORG_DEPTH
+    assert db.get(undo_key(blocks - REORG_DEPTH - 1)) is None
+    assert db.get(undo_key(blocks - REORG_DEPTH)) is not None
+
+    deepest = blocks - REORG_DEPTH
+    index = _Index([_block_hash(h) for h in range(deepest)] + [_block_hash(h, 'b') for h in range(deepest, blocks)])
+    with pytest.raises(ValueError):
+        find_fork(state, index)
+    index = _Index([_block_hash(h) for h in range(deepest + 1)] +
+                   [_block_hash(h, 'b') for h in range(deepest + 1, blocks)])
+    assert find_fork(state, index) == deepest
+    # Every block with a hash in the follow state can be rolled back, but not the ones below
+    assert rollback(db, state, deepest - 1) == REORG_DEPTH
+    with pytest.raises(ValueError):
+        rollback(db, state, deepest - 2)
+
+
+def test_delta_cypher_removes_rolled_back_blocks(tmp_path):
+    csv_dir = str(tmp_path)
+    rows = {name: [] for name in ('addresses', 'blocks', 'transactions', 'before-rel', 'belongs-rel',
+                                  'receives-rel', 'sends-rel')}
+    rows['blocks'] = [['00ff', '1', '2009-01-03T18:15']]
+    rows['sends-rel'] = [['1Address', str(i), 'tx' + str(i % 3), 'SENDS'] for i in range(BATCH_SIZE + 1)]
+    for name, data in rows.items():
+        with open(os.path.join(csv_dir, name + ".csv"), 'w', newline='') as f:
+            csv.writer(f).writerows(data)
+    path = os.path.join(csv_dir, "delta.cypher")
+
+    write_delta_cypher(csv_dir, path, ['aa', 'bb'])
+    with open(path) as f:
+        statements = f.read().splitlines()
+    # Rolled back blocks are deleted before the rows of the delta are merged
+    assert statements[0].startswith("MATCH (b:Block) WHERE b.hash IN [\"aa\", \"bb\"]")
+    assert "DETACH DELETE t, b" in statements[0]
+    # The SENDS relationships of a transaction are cleared once, then created in batches
+    clear = [s for s in statements if "DELETE x" in s]
+    assert len(clear) == 1 and json.dumps(['tx0', 'tx1', 'tx2']) in clear[0]
+    creates = [s for s in statements if "CREATE (a)-[:SENDS" in s]
+    assert len(creates) == 2 and statements.index(clear[0]) < statements.index(creates[0])
+
+    write_delta_cypher(csv_dir, path)
+    with open(path) as f:
+        assert "DETACH DELETE" not in f.read()
@@ -0,0 +1,103 @@
+"""
+Tests of resuming an interrupted run from the journal of its last checkpoint
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import csv
+import gzip
+import json
+import os
+
+import pytest
+
+import gzipstream
+from gzipstream import open_csv
+from journal import new_journal, load_journal, write_journal, JOURNAL_FILE
+
+CONFIG = {'endblock': 1000, 'prune': False, 'engine': 'lookup', 'output': 'single', 'compress': True}
+
+
+def _rows(start, end):
+    return [['%064x' % n, n * 1000, n % 7, 'addr,with "quotes"' if n % 5 == 0 else 'addr' + str(n), 'RECEIVES']
+            for n in range(start, end)]
+
+
+def _read(path, compress):
+    with (gzip.open(path, 'rt', newline='') if compress else open(path, newline='')) as f:
+        return list(csv.reader(f))
+
+
+def _checkpoint(base_path, journal, files):
+    # Like checkpoint() of btc_parallel.py
+    for f in files.values():
+        f.flush()
+        os.fsync(f.fileno())
+    journal['offsets'] = {name: f.tell() for name, f in files.items()}
+    write_journal(base_path, journal)
+
+
+def test_changed_config_is_rejected(tmp_path):
+    base_path = str(tmp_path)
+    with pytest.raises(ValueError):
+        load_journal(base_path, CONFIG)
+    journal = new_journal(CONFIG)
+    journal['chunks'] = [[0, 100]]
+    write_journal(base_path, journal)
+    assert load_journal(base_path, dict(CONFIG)) == journal
+    assert not os.path.exists(os.path.join(base_path, JOURNAL_FILE + ".tmp"))
+
+    for key, value in (('endblock', 2000), ('engine', 'join'), ('compress', False)):
+        with pytest.raises(ValueError):
+            load_journal(base_path, dict(CONFIG, **{key: value}))
+    # A setting the journal does not know about yet
+    with pytest.raises(ValueError):
+        load_journal(base_path, dict(CONFIG, rawaddresses=True))
+
+    with open(os.path.join(base_path, JOURNAL_FILE), 'w') as f:
+        json.dump(dict(journal, version=journal['version'] + 1), f)
+    with pytest.raises(ValueError):
+        load_journal(base_path, CONFIG)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_resume_restores_output(tmp_path, monkeypatch, compress):
+    # Small members, so compressed rows are written before the next flush like in a long run
+    monkeypatch.setattr(gzipstream, 'BLOCK_SIZE', 4096)
+    extension = "csv.gz" if compress else "csv"
+    base_path = str(tmp_path / "run")
+    os.makedirs(base_path)
+    names = ('receives', 'sends')
+    paths = {name: os.path.join(base_path, name + "." + extension) for name in names}
+
+    # The interrupted run: a checkpoint after the first 300 rows, rows written after it and a torn write
+    journal = new_journal(CONFIG)
+    files = {name: open_csv(paths[name], 'w', compress) for name in names}
+    writers = {name: csv.writer(f) for name, f in files.items()}
+    for name in names:
+        writers[name].writerows(_rows(0, 300))
+    _checkpoint(base_path, journal, files)
+    for name in names:
+        writers[name].writerows(_rows(300, 450))
+        files[name].flush()
+        files[name].close()
+        with open(paths[name], 'ab') as f:
+            f.write(b'\x1f\x8b\x08 torn')
+
+    # The resumed run cuts off everything after the checkpoint and writes the rows from there again
+    journal = load_journal(base_path, CONFIG)
+    files = {}
+    for name in names:
+        os.truncate(paths[name], journal['offsets'][name])
+        files[name] = open_csv(paths[name], 'a', compress)
+        csv.writer(files[name]).writerows(_rows(300, 1000))
+        files[name].close()
+
+    # The same rows as an uninterrupted run
+    complete = str(tmp_path / ("complete." + extension))
+    f = open_csv(complete, 'w', compress)
+    csv.writer(f).writerows(_rows(0, 1000))
+    f.close()
+    for name in names:
+        assert _read(paths[name], compress) == _read(complete, compress)
+        assert _read(paths[name], compress) == [[str(v) for v in row] for row in _rows(0, 1000)]
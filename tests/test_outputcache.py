@@ -0,0 +1,185 @@
+"""
+Tests of the write-behind cache of the single-threaded exporter
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import random
+
+from outputcache import OutputCache, ENTRY_OVERHEAD
+
+
+class _Batch:
+    def __init__(self):
+        self.ops = []
+
+    def put(self, key, value):
+        self.ops.append((key, value))
+
+    def delete(self, key):
+        self.ops.append((key, None))
+
+
+class _DictDB:
+    """
+    Transaction database held in a dict, counting the reads that reach it
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.reads = 0
+
+    def get(self, key):
+        self.reads += 1
+        return self.records.get(key)
+
+    def batch(self):
+        return _Batch()
+
+    def write(self, batch):
+        for key, value in batch.ops:
+            if value is None:
+                self.records.pop(key, None)
+            else:
+                self.records[key] = value
+
+
+def _key(n):
+    return n.to_bytes(32, 'big') + b'\0\0\0\0'
+
+
+def _size(key, value):
+    return len(key) + len(value) + ENTRY_OVERHEAD
+
+
+def test_output_created_and_spent_before_flush():
+    db = _DictDB()
+    cache = OutputCache(db, 1024 ** 2, flush_blocks=10)
+    cache.put(_key(1), b'created')
+    cache.put(_key(2), b'kept')
+    assert cache.get(_key(1)) == b'created'
+    cache.delete(_key(1))
+    assert cache.get(_key(1)) is None
+    cache.end_block()
+    assert db.records == {}
+    cache.flush()
+    assert db.records == {_key(2): b'kept'}
+    assert list(cache.recent) == [_key(2)]
+    assert db.reads == 0
+
+
+def test_spent_outputs_leave_the_cache():
+    db = _DictDB()
+    db.records[_key(1)] = b'written before'
+    cache = OutputCache(db, 1024 ** 2)
+    cache.put(_key(2), b'written by the cache')
+    cache.flush()
+    assert cache.recent_bytes == _size(_key(2), b'written by the cache')
+
+    # Both the output only in the database and the one in the cache are answered as spent right away
+    cache.delete(_key(1))
+    cache.delete(_key(2))
+    assert cache.get(_key(1)) is None and cache.get(_key(2)) is None
+    assert not cache.recent and cache.recent_bytes == 0
+    cache.flush()
+    assert db.records == {}
+    assert cache.get(_key(1)) is None and cache.get(_key(2)) is None
+
+
+def test_duplicate_transaction_replaces_outputs():
+    # BIP 30: a transaction with the txid of an earlier one replaces its outputs
+    db = _DictDB()
+    cache = OutputCache(db, 1024 ** 2)
+    cache.put(_key(1), b'first')
+    cache.flush()
+    cache.put(_key(1), b'duplicate')
+    assert cache.get(_key(1)) == b'duplicate'
+    cache.flush()
+    assert cache.get(_key(1)) == b'duplicate'
+    assert db.records == {_key(1): b'duplicate'}
+    assert list(cache.recent.items()) == [(_key(1), b'duplicate')]
+    assert cache.recent_bytes == _size(_key(1), b'duplicate')
+
+
+def test_least_recently_used_outputs_are_evicted():
+    db = _DictDB()
+    value = b'x' * 50
+    # Room for 10 outputs
+    cache = OutputCache(db, 10 * _size(_key(0), value))
+    for n in range(10):
+        cache.put(_key(n), value)
+    cache.flush()
+    assert len(cache.recent) == 10
+    # Output 0 is used again, so output 1 is the least recently used one
+    assert cache.get(_key(0)) == value
+    cache.put(_key(10), value)
+    cache.flush()
+    assert _key(0) in cache.recent and _key(1) not in cache.recent
+    assert cache.recent_bytes <= cache.cache_bytes
+    # Evicted outputs are read from the database
+    reads = db.reads
+    assert cache.get(_key(1)) == value
+    assert db.reads == reads + 1 and cache.misses == 1
+
+
+def test_changes_are_written_early_when_large():
+    db = _DictDB()
+    value = b'x' * 100
+    cache = OutputCache(db, 8 * _size(_key(0), value), flush_blocks=100)
+    cache.put(_key(1), value)
+    cache.end_block()
+    assert db.records == {}
+    for n in range(2, 4):
+        cache.put(_key(n), value)
+    cache.end_block()
+    assert len(db.records) == 3 and not cache.staged
+
+
+def test_interrupted_run_writes_all_blocks():
+    # An interrupt stops the run at the end of a block in the middle of a flush window, after which btc-to-csv.py
+    # flushes the cache. A new run from the next block finds every output of the blocks exported so far.
+    rng = random.Random(3)
+    db = _DictDB()
+    cache = OutputCache(db, 1024 ** 2, flush_blocks=100)
+    expected = {}
+    for block in range(37):
+        for n in range(block * 10, block * 10 + 10):
+            cache.put(_key(n), b'%d' % n)
+            expected[_key(n)] = b'%d' % n
+        for key in rng.sample(sorted(expected), 4):
+            cache.delete(key)
+            del expected[key]
+        cache.end_block()
+    assert db.records == {}
+    cache.flush()
+    assert db.records == expected
+
+    resumed = OutputCache(db, 1024 ** 2)
+    assert all(resumed.get(key) == value for key, value in expected.items())
+
+
+def test_get_never_returns_deleted_outputs():
+    rng = random.Random(5)
+    db = _DictDB()
+    value_size = 20
+    cache = OutputCache(db, 30 * (36 + value_size + ENTRY_OVERHEAD), flush_blocks=3)
+    expected = {}
+    for block in range(300):
+        for _ in range(rng.randrange(1, 8)):
+            key = _key(rng.randrange(60))
+            if key in expected and rng.random() < 0.6:
+                cache.delete(key)
+                del expected[key]
+            else:
+                # Also replaces unspent outputs, like a duplicate transaction
+                value = bytes([rng.randrange(256)]) * value_size
+                cache.put(key, value)
+                expected[key] = value
+            probe = _key(rng.randrange(60))
+            assert cache.get(probe) == expected.get(probe)
+        cache.end_block()
+        assert cache.recent_bytes == sum(_size(k, v) for k, v in cache.recent.items())
+        assert cache.recent_bytes <= cache.cache_bytes
+        assert all(db.records[k] == v for k, v in cache.recent.items())
+    cache.flush()
+    assert db.records == expected
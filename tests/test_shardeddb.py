@@ -0,0 +1,134 @@
+"""
+Tests of the routing of keys to the shards of the transaction database
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import gc
+import hashlib
+import os
+
+import pytest
+
+rocksdb = pytest.importorskip('rocksdb')
+
+from shardeddb import ShardedDB, shard_of, shard_paths, partition_count, MAX_SHARDS
+from txdb import LAYOUT_KEY, LAYOUT_TRANSACTIONS, LAYOUT_OUTPOINTS, txid_key, outpoint_key, check_layout
+
+
+def _options():
+    opts = rocksdb.Options()
+    opts.create_if_missing = True
+    return opts
+
+
+def _txids(n):
+    return [hashlib.sha256(b'%d' % i).hexdigest() for i in range(n)]
+
+
+@pytest.mark.parametrize('shards', [1, 2, 3, 7, 16, MAX_SHARDS])
+def test_shards_get_equal_key_ranges(shards):
+    counts = [0] * shards
+    for first in range(256):
+        counts[shard_of(bytes([first]) + b'\0' * 31, shards)] += 1
+    assert max(counts) - min(counts) <= 1
+
+
+@pytest.mark.parametrize('shards', [1, 2, 3, 7, 16, MAX_SHARDS])
+def test_key_ranges_belong_to_one_shard(shards):
+    # SST files are cut into key ranges by the first key byte and ingested by the shard of their key range
+    partitions = partition_count(shards, 64)
+    assert partitions % shards == 0 and partitions >= 64
+    for first in range(256):
+        key = bytes([first]) + b'\0' * 31
+        assert (first * partitions // 256) * shards // partitions == shard_of(key, shards)
+
+
+def test_outputs_of_a_transaction_share_a_shard():
+    for txid in _txids(100):
+        assert {shard_of(outpoint_key(txid, vout), 16) for vout in range(5)} == {shard_of(txid_key(txid), 16)}
+    # Keys shorter than a txid are kept in the first shard
+    assert shard_of(LAYOUT_KEY, 16) == 0
+
+
+def test_shard_paths(tmp_path):
+    directories = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+    assert shard_paths(directories[:1], 1) == directories[:1]
+    paths = shard_paths(directories, 4)
+    assert [os.path.dirname(p) for p in paths] == [directories[0], directories[1]] * 2
+    assert len(set(paths)) == 4
+
+
+def test_keys_are_routed_to_their_shard(tmp_path):
+    shards = 4
+    db = ShardedDB(shard_paths([str(tmp_path)], shards), _options)
+    check_layout(db, LAYOUT_TRANSACTIONS, create=True)
+    txids = _txids(200)
+    batch = db.batch()
+    for txid in txids[:100]:
+        batch.put(txid_key(txid), txid.encode())
+    db.write(batch)
+    for txid in txids[100:]:
+        db.put(txid_key(txid), txid.encode())
+    for txid in txids:
+        key = txid_key(txid)
+        for shard, shard_db in enumerate(db.dbs):
+            assert shard_db.get(key) == (txid.encode() if shard == shard_of(key, shards) else None)
+    assert db.dbs[0].get(LAYOUT_KEY) == LAYOUT_TRANSACTIONS
+
+    missing = txid_key('ff' * 32)
+    found = db.multi_get([txid_key(t) for t in txids] + [missing])
+    assert found[missing] is None
+    assert all(found[txid_key(t)] == t.encode() for t in txids)
+
+    batch = db.batch()
+    for txid in txids[:50]:
+        batch.delete(txid_key(txid))
+    db.write(batch)
+    assert all(db.get(txid_key(t)) is None for t in txids[:50])
+    assert all(db.get(txid_key(t)) == t.encode() for t in txids[50:])
+
+
+def test_shard_count_is_checked(tmp_path):
+    paths = shard_paths([str(tmp_path)], 4)
+    db = ShardedDB(paths, _options)
+    check_layout(db, LAYOUT_TRANSACTIONS, create=True)
+    del db
+    with pytest.raises(ValueError):
+        ShardedDB(shard_paths([str(tmp_path)], 2), _options)
+    with pytest.raises(ValueError):
+        ShardedDB([str(tmp_path)], _options)
+    # Releases the locks of the shards opened by the failed attempts
+    gc.collect()
+    assert ShardedDB(paths, _options).shards == 4
+
+    # A database with a single shard, e.g. converted by migrate-db.py, is not opened with several
+    single = str(tmp_path / 'single')
+    db = ShardedDB([single], _options)
+    del db
+    gc.collect()
+    with pytest.raises(ValueError):
+        ShardedDB(shard_paths([single], 4), _options)
+    with pytest.raises(ValueError):
+        ShardedDB(shard_paths([str(tmp_path / 'other'), single], 2), _options)
+    assert not os.path.exists(os.path.join(single, 'shard-000'))
+    assert ShardedDB([single], _options).shards == 1
+
+
+def test_layout_is_only_recorded_for_empty_databases(tmp_path):
+    db = ShardedDB([str(tmp_path / 'empty')], _options)
+    assert not db.holds_records()
+    check_layout(db, LAYOUT_OUTPOINTS, create=True)
+    assert db.get(LAYOUT_KEY) == LAYOUT_OUTPOINTS
+    assert not db.holds_records()
+
+    # A database of transactions that does not record its layout, e.g. built by an earlier version
+    db = ShardedDB([str(tmp_path / 'legacy')], _options)
+    db.put(txid_key(_txids(1)[0]), b'record')
+    assert db.holds_records()
+    for create in (False, True):
+        with pytest.raises(ValueError):
+            check_layout(db, LAYOUT_OUTPOINTS, create=create)
+    assert db.get(LAYOUT_KEY) is None
+    check_layout(db, LAYOUT_TRANSACTIONS, create=True)
+    assert db.get(LAYOUT_KEY) is None
@@ -0,0 +1,193 @@
+"""
+Tests of the sort-merge join of inputs with the outputs they spend, against the lookups of the transaction database
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import os
+import time
+
+import pytest
+
+import sortjoin
+from blkreader import iter_blocks
+from blockindex import BlockIndex
+from sortjoin import ChunkRuns, join_runs, merge_runs, run_path, INPUTS
+from txdb import UNKNOWN_ADDRESS, txid_key, encode_outputs, lookup_outputs
+
+
+class _Rows:
+    """
+    Collects the rows written by join_runs instead of a csv.writer
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(list(row))
+
+
+class _DictDB:
+    """
+    Transaction database held in a dict, offering the multi_get used by lookup_outputs
+    """
+
+    def __init__(self):
+        self.records = {}
+
+    def multi_get(self, keys):
+        return {key: self.records.get(key) for key in keys}
+
+
+def _chunks(block_index_path, count):
+    # Chunks of about the same number of blocks, so inputs spend the outputs of earlier chunks
+    blocks = len(BlockIndex(block_index_path))
+    bounds = [blocks * i // count for i in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _spill(block_index_path, block_path, run_dir, chunks):
+    """
+    Writes the runs of every chunk like spill_chunk of btc_parallel.py
+    """
+    for start, end in chunks:
+        runs = ChunkRuns(run_dir, start)
+        for block in iter_blocks(block_index_path, block_path, start, end):
+            block_date = time.strftime('%Y-%m-%d', time.gmtime(block.timestamp))
+            for tx in block.transactions:
+                out_sum = 0
+                for o, (val, addr) in enumerate(tx.outputs):
+                    out_sum += val
+                    runs.add_output(tx.txid, o, val, addr)
+                if not tx.coinbase:
+                    for in_hash, in_index in tx.inputs:
+                        runs.add_input(in_hash, in_index, tx.txid)
+                    runs.add_transaction(tx.txid, block_date, len(tx.inputs), len(tx.outputs), out_sum)
+                else:
+                    runs.add_transaction(tx.txid, block_date, 1, len(tx.outputs), out_sum, out_sum)
+        runs.close()
+
+
+def _lookup(block_index_path, block_path, end):
+    """
+    Returns the SENDS and transaction rows of the lookup engine, i.e. of generate_csv of btc_parallel.py, which looks up
+    the spent outputs in a transaction database holding all transactions of the chain
+    """
+    db = _DictDB()
+    blocks = list(iter_blocks(block_index_path, block_path, 0, end))
+    for block in blocks:
+        for tx in block.transactions:
+            db.records[txid_key(tx.txid)] = encode_outputs(tx.outputs)
+    sends = []
+    transactions = []
+    for block in blocks:
+        block_date = time.strftime('%Y-%m-%d', time.gmtime(block.timestamp))
+        for tx in block.transactions:
+            out_sum = sum(val for val, _ in tx.outputs)
+            if tx.coinbase:
+                transactions.append([tx.txid, block_date, 1, len(tx.outputs), out_sum, out_sum])
+                continue
+            resolved, _ = lookup_outputs(db, tx.inputs)
+            in_sum = 0
+            for prevout in tx.inputs:
+                in_value, in_address = resolved[prevout]
+                sends.append([in_address, in_value, tx.txid, 'SENDS'])
+                in_sum += in_value
+            transactions.append([tx.txid, block_date, len(tx.inputs), len(tx.outputs), in_sum, out_sum])
+    return sends, transactions
+
+
+def _join(run_dir, chunks):
+    sends = _Rows()
+    transactions = _Rows()
+    joined, unresolved = join_runs(run_dir, [start for start, _ in chunks], sends, transactions)
+    return joined, unresolved, sends.rows, transactions.rows
+
+
+@pytest.mark.parametrize('fanin', [sortjoin.MAX_FANIN, 2])
+def test_join_matches_lookups(chain, block_index_path, block_path, tmp_path, monkeypatch, fanin):
+    # A fan-in of 2 merges the runs of 7 chunks in several levels of intermediate runs
+    monkeypatch.setattr(sortjoin, 'MAX_FANIN', fanin)
+    # Several runs of in-sums, so they are merged like the runs of the chunks
+    monkeypatch.setattr(sortjoin, 'RUN_SIZE', 500)
+    chunks = _chunks(block_index_path, 7)
+    run_dir = str(tmp_path)
+    _spill(block_index_path, block_path, run_dir, chunks)
+    runs = sorted(os.listdir(run_dir))
+
+    joined, unresolved, sends, transactions = _join(run_dir, chunks)
+    expected_sends, expected_transactions = _lookup(block_index_path, block_path, chunks[-1][1])
+    assert (joined, unresolved) == (chain[1]['inputs'], 0)
+    assert sorted(sends) == sorted(expected_sends)
+    assert sorted(transactions) == sorted(expected_transactions)
+    assert any(row[0] == UNKNOWN_ADDRESS for row in sends)
+    # Intermediate runs and in-sums are removed, the runs of the chunks are left to the caller
+    assert sorted(os.listdir(run_dir)) == runs
+
+
+def test_inputs_spend_other_chunks(chain, block_index_path, block_path, tmp_path):
+    chunks = _chunks(block_index_path, 4)
+    run_dir = str(tmp_path)
+    _spill(block_index_path, block_path, run_dir, chunks)
+    # The join is only needed for inputs whose outputs were created by an earlier chunk
+    created = {start: {key for key, _, _ in sortjoin.OUTPUTS.read(run_path(run_dir, 'outputs', start))}
+               for start, _ in chunks}
+    for start, _ in chunks[1:]:
+        spent = [key for key, _ in INPUTS.read(run_path(run_dir, 'inputs', start))]
+        assert any(key not in created[start] for key in spent)
+
+    # Without the first chunk, the inputs spending its outputs cannot be resolved and are left out
+    first = chunks[0][0]
+    missing = [key for start, _ in chunks[1:] for key, _ in INPUTS.read(run_path(run_dir, 'inputs', start))
+               if key in created[first]]
+    first_inputs = len(list(INPUTS.read(run_path(run_dir, 'inputs', first))))
+    joined, unresolved, sends, _ = _join(run_dir, chunks[1:])
+    assert unresolved == len(missing) > 0
+    assert joined == len(sends) == chain[1]['inputs'] - first_inputs - unresolved
+
+
+def test_unresolved_inputs_and_coinbase(tmp_path):
+    run_dir = str(tmp_path)
+    coinbase, spending, orphan = 'aa' * 32, 'bb' * 32, 'cc' * 32
+    runs = ChunkRuns(run_dir, 0)
+    runs.add_output(coinbase, 0, 5000, '1Coinbase')
+    runs.add_output(coinbase, 1, 7, UNKNOWN_ADDRESS)
+    runs.add_transaction(coinbase, '2009-01-03', 1, 2, 5007, 5007)
+    runs.close()
+    runs = ChunkRuns(run_dir, 1)
+    runs.add_output(spending, 0, 5007, '1Spending')
+    runs.add_input(coinbase, 0, spending)
+    runs.add_input(coinbase, 1, spending)
+    runs.add_transaction(spending, '2009-01-04', 2, 1, 5007)
+    # Spends an output that does not exist in any chunk
+    runs.add_output(orphan, 0, 1, '1Orphan')
+    runs.add_input('dd' * 32, 3, orphan)
+    runs.add_transaction(orphan, '2009-01-04', 1, 1, 1)
+    runs.close()
+
+    joined, unresolved, sends, transactions = _join(run_dir, [(0, 1), (1, 2)])
+    assert (joined, unresolved) == (2, 1)
+    assert sorted(sends) == [['1Coinbase', 5000, spending, 'SENDS'], [UNKNOWN_ADDRESS, 7, spending, 'SENDS']]
+    # The in-sum of a coinbase transaction is the value it creates, the in-sum of the orphan stays 0
+    assert transactions == [[coinbase, '2009-01-03', 1, 2, 5007, 5007], [spending, '2009-01-04', 2, 1, 5007, 5007],
+                            [orphan, '2009-01-04', 1, 1, 0, 1]]
+
+
+def test_merge_removes_intermediate_runs_when_closed(tmp_path, monkeypatch):
+    monkeypatch.setattr(sortjoin, 'MAX_FANIN', 2)
+    run_dir = str(tmp_path)
+    paths = []
+    for start in range(5):
+        path = run_path(run_dir, 'insums', start)
+        sortjoin.INSUMS.write(path, [(bytes([i]) * 32, start) for i in range(start, 10, 2)])
+        paths.append(path)
+    merged = merge_runs(sortjoin.INSUMS, paths, run_dir, 'insums')
+    assert len(os.listdir(run_dir)) > len(paths)
+    first = next(merged)
+    assert first == (b'\0' * 32, 0)
+    # The caller stops early
+    merged.close()
+    assert sorted(os.listdir(run_dir)) == sorted(os.path.basename(p) for p in paths)
+    assert list(merge_runs(sortjoin.INSUMS, paths, run_dir, 'insums')) == \
+        sorted(record for p in paths for record in sortjoin.INSUMS.read(p))
@@ -0,0 +1,200 @@
+"""
+Binary record format of the transaction output database.
+
+Two layouts are supported:
+
+* transactions: Transactions are stored under their raw 32-byte txid. The value is a versioned record holding one
+  fixed-width entry per output (value and a reference into an address blob at the end of the record), so that a single
+  output can be decoded without unpacking the rest of the transaction. Outputs are never removed, the database grows
+  with the entire history of the chain.
+* outpoints: Every output is stored under its outpoint (raw txid and output number) and deleted as soon as it is
+  spent, so the database only holds the set of unspent transaction outputs (UTXO pruning).
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import struct
+
+# Version of the output record format. Stored as first byte of every record.
+RECORD_VERSION = 1
+# Placeholder for outputs whose script does not resolve to an address (non-standard scripts, OP_RETURN, ...)
+UNKNOWN_ADDRESS = 'unknown'
+
+# Database layouts
+LAYOUT_TRANSACTIONS = b'transactions'
+LAYOUT_OUTPOINTS = b'outpoints'
+# Key under which the layout of a database is recorded. Cannot collide with txid (32 bytes) or outpoint (36 bytes) keys.
+LAYOUT_KEY = b'__layout__'
+# Key under which it is recorded how the addresses in a database are identified: encoded, or as hex string of script
+# type and hash (--rawaddresses)
+ADDRESSES_KEY = b'__addresses__'
+ADDRESSES_ENCODED = b'encoded'
+ADDRESSES_RAW = b'raw'
+
+# Record header: format version, number of outputs
+_HEADER = struct.Struct('<BI')
+# Output entry: value in satoshi, offset and length of the receiving address within the address blob
+_ENTRY = struct.Struct('<QIH')
+# Outpoint record: format version, value in satoshi. Followed by the receiving address.
+_OUTPOINT = struct.Struct('<BQ')
+# Output number within an outpoint key. Big endian, so outputs of a transaction are stored next to each other.
+_VOUT = struct.Struct('>I')
+
+
+def check_layout(db, layout, create=False, raw=False):
+    """
+    Makes sure that a database uses the expected layout and identifies addresses the expected way. The addresses of
+    the spent outputs end up in the SENDS rows, so a database with raw addresses would mix them with encoded ones.
+
+    :param db:      ShardedDB, the transaction database
+    :param layout:  bytes, the expected layout (LAYOUT_TRANSACTIONS or LAYOUT_OUTPOINTS)
+    :param create:  bool, whether to record layout and addresses if the database is empty
+    :param raw:     bool, whether addresses are expected as hex string of script type and hash instead of encoded
+    """
+    found = db.get(LAYOUT_KEY)
+    if found is None and db.holds_records():
+        # Databases built before the layout was recorded only know the transactions layout. The layout is never
+        # recorded for a database that already holds records, as they may not match the one requested.
+        found = LAYOUT_TRANSACTIONS
+    addresses = ADDRESSES_RAW if raw else ADDRESSES_ENCODED
+    found_addresses = db.get(ADDRESSES_KEY)
+    if found_addresses is None and not (create and found is None):
+        # Databases built before the addresses were recorded hold encoded addresses
+        found_addresses = ADDRESSES_ENCODED
+    if found is None and create:
+        db.put(LAYOUT_KEY, layout)
+        db.put(ADDRESSES_KEY, addresses)
+    elif found is not None and found != layout:
+        raise ValueError("Transaction database uses the " + found.decode() + " layout, but " + layout.decode() +
+                         " was requested. Use a different --dbdir.")
+    if found_addresses is not None and found_addresses != addresses:
+        raise ValueError("Transaction database holds " + found_addresses.decode() + " addresses, but " +
+                         addresses.decode() + " addresses were requested. Use the same --rawaddresses setting the "
+                         "database was built with or a different --dbdir.")
+
+
+def txid_key(txid):
+    """
+    Converts a transaction id into a database key
+
+    :param txid:    str, the transaction id as hex string
+    :return:        bytes, the raw 32-byte transaction id
+    """
+    return bytes.fromhex(txid)
+
+
+def outpoint_key(txid, vout):
+    """
+    Converts an outpoint into a database key
+
+    :param txid:    str, the transaction id as hex string
+    :param vout:    int, the output number
+    :return:        bytes, the raw 32-byte transaction id followed by the output number
+    """
+    return bytes.fromhex(txid) + _VOUT.pack(vout)
+
+
+def encode_outputs(outputs):
+    """
+    Serializes the outputs of a transaction into a binary record
+
+    :param outputs: list, a list of (value, address) pairs in output order
+    :return:        bytes, the serialized record
+    """
+    entries = bytearray(_HEADER.pack(RECORD_VERSION, len(outputs)))
+    blob = bytearray()
+    for value, address in outputs:
+        # Unknown addresses are not stored at all, an empty reference marks them
+        encoded = b'' if address == UNKNOWN_ADDRESS else address.encode('utf-8')
+        entries += _ENTRY.pack(value, len(blob), len(encoded))
+        blob += encoded
+    return bytes(entries + blob)
+
+
+def _check_header(record):
+    version, count = _HEADER.unpack_from(record)
+    if version != RECORD_VERSION:
+        raise ValueError("Unsupported output record version " + str(version) + ". Run migrate-db.py first.")
+    return count
+
+
+def decode_output(record, index):
+    """
+    Decodes a single output of a serialized transaction
+
+    :param record:  bytes, the serialized record as returned by the database
+    :param index:   int, the output number
+    :return:        tuple, value and receiving address of the output
+    """
+    count = _check_header(record)
+    if not 0 <= index < count:
+        raise IndexError("Output " + str(index) + " does not exist in a transaction with " + str(count) + " outputs")
+    value, offset, length = _ENTRY.unpack_from(record, _HEADER.size + index * _ENTRY.size)
+    if length == 0:
+        return value, UNKNOWN_ADDRESS
+    start = _HEADER.size + count * _ENTRY.size + offset
+    return value, record[start:start + length].decode('utf-8')
+
+
+def decode_outputs(record):
+    """
+    Decodes all outputs of a serialized transaction
+
+    :param record:  bytes, the serialized record as returned by the database
+    :return:        list, a list of (value, address) pairs in output order
+    """
+    return [decode_output(record, i) for i in range(_check_header(record))]
+
+
+def encode_outpoint(value, address):
+    """
+    Serializes a single output for the outpoints layout
+
+    :param value:   int, the value in satoshi
+    :param address: str, the receiving address
+    :return:        bytes, the serialized record
+    """
+    encoded = b'' if address == UNKNOWN_ADDRESS else address.encode('utf-8')
+    return _OUTPOINT.pack(RECORD_VERSION, value) + encoded
+
+
+def decode_outpoint(record):
+    """
+    Decodes a single output stored in the outpoints layout
+
+    :param record:  bytes, the serialized record as returned by the database
+    :return:        tuple, value and receiving address of the output
+    """
+    version, value = _OUTPOINT.unpack_from(record)
+    if version != RECORD_VERSION:
+        raise ValueError("Unsupported output record version " + str(version) + ".")
+    if len(record) == _OUTPOINT.size:
+        return value, UNKNOWN_ADDRESS
+    return value, record[_OUTPOINT.size:].decode('utf-8')
+
+
+def lookup_outputs(db, prevouts, prune=False):
+    """
+    Resolves a batch of spent outputs with a single multi_get. Outputs referenced several times are looked up once.
+
+    :param db:          ShardedDB, the transaction database
+    :param prevouts:    list, a list of (txid, output number) tuples
+    :param prune:       bool, whether the database uses the outpoints layout
+    :return:            tuple, a dict mapping each resolvable (txid, output number) tuple to a (value, address) tuple
+                        and the number of keys that were looked up
+    """
+    if prune:
+        keys = {prevout: outpoint_key(prevout[0], prevout[1]) for prevout in prevouts}
+    else:
+        keys = {prevout: txid_key(prevout[0]) for prevout in prevouts}
+    records = db.multi_get(list(set(keys.values())))
+    resolved = {}
+    for prevout, key in keys.items():
+        record = records.get(key)
+        if record is None:
+            continue
+        try:
+            resolved[prevout] = decode_outpoint(record) if prune else decode_output(record, prevout[1])
+        except (ValueError, IndexError) as e:
+            print(e)
+    return resolved, len(records)
@@ -0,0 +1,173 @@
+"""
+Secondary indexes for the extraction of the transactions around a set of addresses.
+
+The transaction database only maps txids to their outputs. The index database built by `extract.py index` adds three
+kinds of entries, each under a key prefix of its own:
+
+* postings: address, block height, txid and output number of every output that pays to the address. The value is the
+  value of the output in satoshi. All postings of an address are stored next to each other in order of height.
+* spends: outpoint (txid and output number) -> txid and block height of the transaction spending it
+* transactions: txid -> block height of the transaction
+
+All entries are derived from the blocks alone, so the index can be built without the transaction database. Together,
+they lead from an address to every transaction it received or sent coins in. Entries are never removed, so only blocks
+that can no longer be replaced by a reorg are indexed. The hash of the last indexed block is recorded with its height,
+so a deeper reorg is detected.
+
+(c) 2019 Jochen Schäfer for Südwestrundfunk AdöR
+"""
+
+import struct
+
+from txdb import UNKNOWN_ADDRESS
+
+# Key prefixes of the kinds of entries
+POSTING_PREFIX = b'a'
+SPEND_PREFIX = b's'
+TX_PREFIX = b't'
+# Key under which the height up to which blocks have been indexed and the hash of the last indexed block are stored.
+# Cannot collide with other keys, as they start with one of the prefixes above.
+HEIGHT_KEY = b'__height__'
+
+# Ends the address within a posting key. Does not occur in addresses.
+_SEPARATOR = b'\x00'
+_HEIGHT = struct.Struct('>I')
+_VOUT = struct.Struct('>I')
+_VALUE = struct.Struct('<Q')
+
+
+def posting_prefix(address):
+    """
+    Returns the common prefix of the keys of all postings of an address
+
+    :param address: str, the address
+    :return:        bytes, the prefix
+    """
+    return POSTING_PREFIX + address.encode('utf-8') + _SEPARATOR
+
+
+def spend_key(txid, vout):
+    """
+    Returns the key of the spend of an outpoint
+
+    :param txid:    str, the transaction id as hex string
+    :param vout:    int, the output number
+    :return:        bytes, the key
+    """
+    return SPEND_PREFIX + bytes.fromhex(txid) + _VOUT.pack(vout)
+
+
+def tx_key(txid):
+    """
+    Returns the key of the height of a transaction
+
+    :param txid:    str, the transaction id as hex string
+    :return:        bytes, the key
+    """
+    return TX_PREFIX + bytes.fromhex(txid)
+
+
+def block_entries(block):
+    """
+    Returns the index entries of a block
+
+    :param block:   blkreader.Block, the decoded block
+    :return:        list, a list of (key, value) tuples
+    """
+    entries = []
+    height = _HEIGHT.pack(block.height)
+    for tx in block.transactions:
+        raw_txid = bytes.fromhex(tx.txid)
+        entries.append((TX_PREFIX + raw_txid, height))
+        for o, (value, address) in enumerate(tx.outputs):
+            # Outputs without an address cannot be reached from an address
+            if address != UNKNOWN_ADDRESS:
+                entries.append((posting_prefix(address) + height + raw_txid + _VOUT.pack(o), _VALUE.pack(value)))
+        if not tx.coinbase:
+            for in_hash, in_index in tx.inputs:
+                entries.append((spend_key(in_hash, in_index), raw_txid + height))
+    return entries
+
+
+def postings(db, address):
+    """
+    Returns the outputs received by an address
+
+    :param db:      rocksdb.DB, the index database
+    :param address: str, the address
+    :return:        list, a (block height, txid, output number, value) tuple per output in order of height
+    """
+    prefix = posting_prefix(address)
+    it = db.iteritems()
+    it.seek(prefix)
+    found = []
+    for key, value in it:
+        if not key.startswith(prefix):
+            break
+        # Height, raw txid and output number follow the address
+        pos = len(prefix)
+        found.append((_HEIGHT.unpack_from(key, pos)[0], key[pos + 4:pos + 36].hex(),
+                      _VOUT.unpack_from(key, pos + 36)[0], _VALUE.unpack(value)[0]))
+    return found
+
+
+def spenders(db, outpoints):
+    """
+    Looks up the transactions spending several outputs
+
+    :param db:          rocksdb.DB, the index database
+    :param outpoints:   list, a list of (txid, output number) tuples
+    :return:            dict, (txid, block height) of the spending transaction by outpoint. Unspent outputs are left
+                        out.
+    """
+    keys = {outpoint: spend_key(*outpoint) for outpoint in outpoints}
+    records = db.multi_get(list(keys.values()))
+    return {outpoint: (records[key][:32].hex(), _HEIGHT.unpack_from(records[key], 32)[0])
+            for outpoint, key in keys.items() if records.get(key) is not None}
+
+
+def tx_heights(db, txids):
+    """
+    Looks up the block heights of several transactions
+
+    :param db:      rocksdb.DB, the index database
+    :param txids:   list, the transaction ids as hex strings
+    :return:        dict, the block height by txid. Transactions that have not been indexed are left out.
+    """
+    keys = {txid: tx_key(txid) for txid in txids}
+    records = db.multi_get(list(keys.values()))
+    return {txid: _HEIGHT.unpack(records[key])[0] for txid, key in keys.items() if records.get(key) is not None}
+
+
+def indexed_height(db):
+    """
+    Returns the height up to which blocks have been indexed
+
+    :param db:  rocksdb.DB, the index database
+    :return:    int, the first block height that has not been indexed
+    """
+    record = db.get(HEIGHT_KEY)
+    return _HEIGHT.unpack_from(record)[0] if record is not None else 0
+
+
+def indexed_hash(db):
+    """
+    Returns the hash of the last indexed block
+
+    :param db:  rocksdb.DB, the index database
+    :return:    str, the block hash as hex string. None if no block has been indexed.
+    """
+    record = db.get(HEIGHT_KEY)
+    return record[_HEIGHT.size:].hex() if record is not None and len(record) > _HEIGHT.size else None
+
+
+def height_entry(height, block_hash):
+    """
+    Returns the entry recording the height up to which blocks have been indexed. Written together with the entries of
+    the last block below it.
+
+    :param height:      int, the first block height that has not been indexed
+    :param block_hash:  str, the hash of the last indexed block (at height - 1) as hex string
+    :return:            tuple, key and value
+    """
+    return HEIGHT_KEY, _HEIGHT.pack(height) + bytes.fromhex(block_hash)